@@ -36,6 +36,9 @@ function run_appetite {
     appetite_call "apps"
 
     appetite_call "deployment_apps"
+
+    # Or deploy all manifests in a single run using profiles
+    # appetite_call "all_apps"
 }
 
 run_appetite
@@ -8,14 +8,12 @@ Parent appetite class
 import os
 import sys
 import traceback
-import csv
 import shutil
-import tarfile
 import json
 import time
-import re
-from distutils.dir_util import copy_tree
-from multiprocessing import Pool
+import copy
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
 import argparse
 
 import modules.logger as Logger
@@ -24,9 +22,19 @@ import modules.conn_manager as ConnManager
 import modules.app_versioning as AppVersioning
 import modules.helpers as Helpers
 import modules.appetite_args as AppetiteArgs
-from modules.appetite_core import AppetiteHosts, AppetiteHost
+import modules.manifest as Manifest
+import modules.incremental as Incremental
+import modules.app_diff as AppDiff
+import modules.app_delta as AppDelta
+import modules.payload_cache as PayloadCache
+import modules.payload_groups as PayloadGroups
+import modules.payload_codec as PayloadCodec
+import modules.state_store as StateStore
+from modules.appetite_core import AppetiteHosts, AppetiteHost, AppetiteProfile
 from modules.repo_manager import RepoManager
 from modules.deployment_methods import DeploymentMethodsManager
+from modules.app_assignment import AppAssignment
+from modules.bootstrap_planner import BootstrapPlanner
 
 
 def parse_args():
@@ -118,22 +126,27 @@ class Appetite(object):
         self.repo_name = self.args.repo_url.split('/')[-1].split('.')[0]
 
         self.repo_path = os.path.join(self.scratch_location, self.repo_name)
-        self.apps_folder = os.path.join(self.repo_path, self.args.apps_folder)
-        self.manifest_path = os.path.join(
-            self.repo_path, Consts.CONFIG_PATH_NAME, self.args.apps_manifest)
         self.tmp_folder = os.path.join(self.scratch_location, self.args.tmp_folder)
         self.meta_folder = os.path.join(self.scratch_location, 'meta')
+        self.state_store = StateStore.StateStore(StateStore.get_store_path(self.meta_folder))
+        self.cache_folder = os.path.join(self.scratch_location, Consts.CACHE_DIR)
+        self.incremental_state_path = Incremental.get_state_path(self.scratch_location)
 
         self.tars_folder = os.path.join(self.tmp_folder, 'tars')
         self.hosts_folder = os.path.join(self.tmp_folder, 'hosts')
+        self.fragments_folder = os.path.join(self.tmp_folder, 'fragments')
+        self.builds_folder = os.path.join(self.tmp_folder, 'builds')
+        self.commits_folder = os.path.join(self.tmp_folder, 'commits')
         self.remote_apps_path = os.path.normpath(self.args.app_folder)
         self.base_location, self.base_name = os.path.split(self.remote_apps_path)
         self.name_formatting = self.args.name_formatting.strip('"\'')
-        self.meta_name = "%s%s" % (Consts.APPS_METADATE_FILENAME, self.args.refname)
         self.meta_remote_folder = os.path.join(self.remote_apps_path, Consts.META_DIR)
         self.meta_remote_logs_folder = os.path.join(
             self.meta_remote_folder, Consts.HOST_LOGS_FOLDER_NAME)
-        self.meta_remote_file = "%s.json" % os.path.join(self.meta_remote_folder, self.meta_name)
+
+        # Each profile is a manifest and apps folder deployed within this run
+        self.profiles = [AppetiteProfile(self, profile['refname'], profile['apps_manifest'], profile['apps_folder'])
+                         for profile in AppetiteArgs.get_profiles(self.args)]
 
         if self.args.clean:
             Helpers.delete_path(self.scratch_location)
@@ -143,13 +156,42 @@ class Appetite(object):
                                         self.args.repo_branch,
                                         "",
                                         self.scratch_location,
-                                        self.args.apps_manifest)
+                                        [profile.apps_manifest for profile in self.profiles],
+                                        self.args.partial_clone,
+                                        [Consts.CONFIG_PATH_NAME] +
+                                        sorted(set(os.path.relpath(profile.apps_folder, self.repo_path)
+                                                   for profile in self.profiles)))
 
         Logger.debug_on(self.args.debug)
 
+        # Parsed configs kept between the runs of a daemon, keyed by the
+        # checksums of their files
+        self.parsed_configs = {}
+
+        self.reset_run_state()
+
+    def reset_run_state(self):
+        """Reset the values set within a run
+
+        The repo manager, state store and parsed configs are kept between
+        the runs of a daemon.
+        """
+        self.appetite_hosts = AppetiteHosts()
         self.ssh_app_commands = None
         self.deployment_manager = None
+        self.run_hosts = []
+        self.settings_key = None
         self.template_values = {}
+        self.template_refs = {}
+        self.payload_cache = None
+        self.payload_codec = None
+        self.head_commit_id = None
+
+        # Hosts not fully updated within the run, checked again next run
+        self.pending_hostnames = set()
+
+        # (hostname, meta name) -> files meta loaded from the host
+        self.remote_files_metas = {}
 
     @property
     def is_running(self):
@@ -162,6 +204,9 @@ class Appetite(object):
 
         # Deleting the tmp folder to keep installs clean
         Helpers.delete_path(self.tmp_folder)
+        self.repo_manager.clear_staged_commits()
+
+        self.payload_codec = PayloadCodec.get_codec(self.args.payload_codec)
 
         try:
             if self.args.template_files:
@@ -171,7 +216,7 @@ class Appetite(object):
                 if isinstance(self.args.template_files, basestring):
                     template_paths = self.args.template_files.split(' ')
 
-                self.template_values = Helpers.load_templating(template_paths)
+                self.template_values = self.load_templating(template_paths)
         except Exception as exception:
             Logger.errorout("No templating problem: %s" % exception.message)
 
@@ -189,7 +234,8 @@ class Appetite(object):
                                 self.args.ssh_port,
                                 self.args.app_folder,
                                 self.args.app_binary,
-                                self.args.dryrun)
+                                self.args.dryrun,
+                                self.args.daemon)
 
         # Load any files reference to appetite scripts folder before this
         # Working directories change with repo management
@@ -200,6 +246,9 @@ class Appetite(object):
 
         repo_check_status = self.repo_manager.check_for_update(dry_run=self.args.dryrun)
 
+        if repo_check_status['failed']:
+            Logger.errorout('Repo Error, Look at logs for details')
+
         Logger.add_track_info(self.repo_manager.track)
 
         triggered = repo_check_status['triggered'] or repo_status == 1
@@ -214,9 +263,7 @@ class Appetite(object):
         self.repo_manager.set_commit_id()
 
         # Load in deploymentmethods.conf
-        self.deployment_manager = DeploymentMethodsManager(self.repo_name, "",
-                                                           self.scratch_location,
-                                                           self.args.deployment_methods_file)
+        self.deployment_manager = self.load_deployment_methods()
 
         # Generate hosts
         if self.args.hosts:
@@ -251,10 +298,37 @@ class Appetite(object):
             sys.exit(1)
 
         if self.args.clean_metas:
+            self.state_store.close()
             Helpers.delete_path(self.meta_folder)
 
-        # Only update if a manifest file is not found
-        self.update_manifests(check_if_exists=True)
+        self.load_manifests()
+
+        # Hosts that are checked and packaged within this run
+        self.run_hosts = self.appetite_hosts.hosts
+
+        # Templating values are extended with host info later in the run
+        self.settings_key = self.get_settings_key()
+
+        if self.args.incremental:
+            affected_hosts = Incremental.get_affected_hosts(self.repo_manager,
+                                                            self.deployment_manager,
+                                                            self.profiles,
+                                                            self.appetite_hosts.hosts,
+                                                            Incremental.load_state(self.incremental_state_path),
+                                                            self.settings_key)
+            if affected_hosts is not None:
+                self.run_hosts = affected_hosts
+
+            if len(self.run_hosts) < 1:
+                Logger.info("No hosts affected by changes")
+                self.write_run_state()
+                self.print_track_info(False)
+                Logger.info("Appetite complete", complete=True, changes=False)
+                return
+
+        # Checks the hosts and gets their manifests
+        self.update_manifests(self.run_hosts)
+        self.sync_state_store(self.run_hosts)
 
         Logger.info("appetite started", use_templating=self.args.templating,
                     firstrun=self.args.firstrun)
@@ -269,140 +343,189 @@ class Appetite(object):
         if changes_found:
             Logger.info("Start host updates")
 
+            # Host groups are available to the commands run on each host
+            self.template_values = self.appetite_hosts.build_meta(self.template_values)
+
             self.update_hosts()
 
             Logger.info("End host updates")
 
+            # Records the changes made to the hosts
+            self.sync_state_store(self.run_hosts)
+
+        self.write_run_state()
+
         self.print_track_info(changes_found)
         Logger.info("Appetite complete", complete=True, changes=changes_found)
 
+    def get_parsed_config(self, name, file_paths, parse_funct):
+        """Parsed config, only parsed again if its files changed
+
+        :param name: Name the parsed config is kept under
+        :param file_paths: Files the config is parsed from
+        :param parse_funct: Function parsing the config
+        """
+        checksums = [Helpers.get_file_checksum(file_path) for file_path in file_paths]
+
+        prev_checksums, parsed_config = self.parsed_configs.get(name, (None, None))
+        if checksums != prev_checksums:
+            parsed_config = parse_funct()
+            self.parsed_configs[name] = (checksums, parsed_config)
+
+        return parsed_config
+
+    def load_deployment_methods(self):
+        """Deployment methods of the repo, shared between runs while unchanged"""
+        dm_filepath = os.path.join(self.scratch_location, self.repo_name,
+                                   Consts.CONFIG_PATH_NAME, self.args.deployment_methods_file)
+
+        return self.get_parsed_config('deployment_methods', [dm_filepath],
+                                      lambda: DeploymentMethodsManager(self.repo_name, "",
+                                                                       self.scratch_location,
+                                                                       self.args.deployment_methods_file))
+
+    def load_templating(self, template_paths):
+        """Templating values of the template files
+
+        Values are extended within a run, each run gets its own copy.
+        """
+        template_files = [os.path.abspath(os.path.expandvars(path)) for path in template_paths]
+
+        return copy.deepcopy(self.get_parsed_config('templating', template_files,
+                                                    lambda: Helpers.load_templating(template_paths)))
+
+    def run_daemon(self):
+        """Run appetite each poll interval until stopped
+
+        The lock is held while running so other instances are skipped.  Runs
+        end early if no manifest changed.  The repo, commit logs, parsed
+        configs, local metas and the ssh connections of this process are kept
+        warm between runs.
+        """
+        Logger.info("Appetite daemon started", poll_interval=self.args.poll_interval)
+
+        num_connections = self.args.num_connections
+
+        try:
+            while True:
+                try:
+                    self.process_hosts()
+                except SystemExit as e:
+                    # Runs exit when there is no repo update or errors are found
+                    if e.code:
+                        Logger.error("Appetite daemon run failed", code=e.code)
+                except Exception as e:
+                    Logger.error("Appetite daemon run failed", err_message=e.message,
+                                 trace=str(traceback.format_exc()))
+
+                # Cleaning is only done for the first run
+                self.args.clean_repo = False
+                self.args.clean_metas = False
+                self.args.num_connections = num_connections
+
+                self.reset_run_state()
+                self.repo_manager.track = Helpers.get_track()
+
+                time.sleep(self.args.poll_interval)
+        finally:
+            ConnManager.close_connections()
+
+    def get_settings_key(self):
+        """Key for the settings that affect every host
+
+        A change in these settings forces a full run when running incrementally.
+        """
+        settings = {'profiles': [[profile.refname, profile.apps_manifest, profile.apps_folder]
+                                 for profile in self.profiles],
+                    'app_folder': self.remote_apps_path,
+                    'templating': self.args.templating,
+                    'template_values': self.template_values}
+
+        # Templated apps can reference the host groups
+        if self.args.templating:
+            settings['hosts'] = sorted(host.hostname for host in self.appetite_hosts)
+
+        return Incremental.get_settings_key(settings)
+
+    def write_run_state(self):
+        """Store the state of this run used by incremental runs"""
+        Incremental.write_state(self.incremental_state_path,
+                                self.track["push_commit_id"],
+                                self.settings_key,
+                                [host.hostname for host in self.run_hosts
+                                 if host.can_connect is False or host.metas_read_failed or
+                                 host.hostname in self.pending_hostnames])
+
+    def load_manifests(self):
+        """Load the manifest for each profile"""
+
+        for profile in self.profiles:
+            profile.manifest = Manifest.load_manifest(profile.manifest_path,
+                                                      self.deployment_manager.paths['dm_filepath'],
+                                                      self.deployment_manager.name_filter,
+                                                      profile.manifest_cache_file)
+
+            Logger.debug("Manifest loaded", manifest=profile.apps_manifest, cached=profile.manifest['cached'],
+                         rows=len(profile.manifest['rows']))
+
     def populate_apps_to_hosts(self):
         """Parses the manifest and adds apps to hosts
 
         :return: None
         """
 
-        Helpers.check_file(self.manifest_path)
-
-        with open(self.manifest_path, 'rU') as csvfile:
-            mreader = csv.reader(csvfile, delimiter=',', quotechar='"')
-            first_row = True
-
-            # Go though each app
-            for row in mreader:
-                # Remove header if it exists
-                if first_row:
-                    # Defines column headers in manifest
-                    column_headers = {col_name: -1
-                                      for col_name in
-                                      Consts.DEFAULT_COLUMN_HEADER}
-
-                    # Get indexes for headers from the first row
-                    num_columns = len(row)
-                    for k in column_headers:
-                        value_index = next((index for index in range(0, num_columns)
-                                            if row[index].lower() == k), -1)
-                        if value_index < 0:
-                            Logger.errorout("Manifest header is missing", header=k)
-                        column_headers[k] = value_index
-
-                    first_row = False
-                    continue
-
-                if len(row) > 1:
-                    row_values = Helpers.create_obj({
-                        "commit_id": row[column_headers['commitid']],
-                        "app_clean": self.deployment_manager.name_filter.sub("", row[
-                            column_headers['application']]),
-                        "app": row[column_headers['application']],
-                        "deployment": row[column_headers['deploymentmethod']],
-                        "white_list": row[column_headers['whitelist']].split(','),
-                        "black_list": row[column_headers['blacklist']].split(',')
-                    })
-
-                    app_folder = os.path.join(self.apps_folder, row_values.app)
-
-                    if self.args.build_test_apps:
-                        # for testing - create test folders for apps
-                        if not os.path.exists(app_folder):
-                            Helpers.create_path(os.path.join(app_folder, "folder"), True)
-                            app_test_file = "%s/%s.txt" % (app_folder, row_values.app_clean)
-                            with open(app_test_file, 'wb') as touch:
-                                touch.write("")
-
-                    if len(row_values.commit_id) > 0 and \
-                            re.match(Consts.COMMIT_ID_REGEX_CHECK, row_values.commit_id) is None:
-                        Logger.critical("Commit ID does not match regex check: " % Consts.COMMIT_ID_REGEX_CHECK,
-                                        commit_id=row_values.commit_id)
-
-                    # Go through each host and see
-                    # if the app is needed for the host
-                    for host in self.appetite_hosts:
-                        self.add_to_host(host, row_values)
-                        self.bootstrap_firstrun_hosts(host, row_values)
-
-            if self.args.new_host_brakes and next((True for host in self.appetite_hosts if host.bootstrap), False):
-                self.args.num_connections = 1
-
-            if self.appetite_hosts.is_empty():
-                Logger.errorout("Manifest misconfiguration, "
-                                "no apps for any hosts")
+        app_assignment = AppAssignment(self.run_hosts, self.plan_bootstrap())
 
-    def get_host_from_app_class(self, app_class):
-        return next((host.hostname for host in self.appetite_hosts if host.app_class == app_class), "")
+        for profile in self.profiles:
+            manifest = profile.manifest
 
-    def bootstrap_firstrun_hosts(self, host, row_values):
-        """Function used to bootstrap apps on the first run"""
+            if self.args.build_test_apps:
+                for row_values in manifest['rows']:
+                    app_folder = os.path.join(profile.apps_folder, row_values.app)
 
-        first_run = self.is_bootstrap(host)
+                    # for testing - create test folders for apps
+                    if not os.path.exists(app_folder):
+                        Helpers.create_path(os.path.join(app_folder, "folder"), True)
+                        app_test_file = "%s/%s.txt" % (app_folder, row_values.app_clean)
+                        with open(app_test_file, 'wb') as touch:
+                            touch.write("")
 
-        if first_run:
-            # For the special case when instance is new,
-            # start up apps have to be included
-            if first_run['update_method'] == row_values.deployment:
-                if not host.bootstrap:
-                    host.bootstrap = True
-                    Logger.info("Bootstrapping host", host=host.hostname)
+            # Go through each row and see which hosts need the app
+            for row_values, assignments in app_assignment.assign(manifest['rows']):
+                for host, deployment, ref_hostname, is_firstrun in assignments:
+                    self.add_app(host, profile, row_values, deployment, is_firstrun, ref_hostname)
 
-                # get host name to check againt
-                check_hostname = next((host.hostname for host in self.appetite_hosts
-                                       if host.app_class == first_run['app_class']), "")
+        if self.args.new_host_brakes and next((True for host in self.appetite_hosts if host.bootstrap), False):
+            self.args.num_connections = 1
 
-                return self.add_to_host(host, row_values, check_hostname,
-                                        first_run['ref_method'],
-                                        True)
-        return False
+        if self.appetite_hosts.is_empty():
+            Logger.errorout("Manifest misconfiguration, "
+                            "no apps for any hosts")
 
-    def is_bootstrap(self, host):
-        """Check if host is bootstrapped"""
+    def get_host_from_app_class(self, app_class):
+        hosts = self.appetite_hosts.get_hosts('app_class', app_class)
+        return hosts[0].hostname if hosts else ""
 
-        # Only run if the manifest is not found on the host (new app instance)
-        if self.args.firstrun and not host.manifest_found:
-            first_run = next((su_bootstrap for su_bootstrap in
-                              self.deployment_manager.startup_bootstrap if
-                              su_bootstrap['ref_class'] == host.app_class and
-                              Helpers.check_name_formatting(
-                                  self.name_formatting, host.hostname)), None)
-            host.restart = True
+    def plan_bootstrap(self):
+        """Create the bootstrap plan for new hosts
 
-            return first_run
+        Only used with firstrun, new hosts are restarted after the install.
+        """
+        if not self.args.firstrun:
+            return {}
 
-    def add_to_host(self, host, row_values, check_hostname=None, deployment=None, is_firstrun=False):
-        """Check and add app to host"""
+        bootstrap_plans = BootstrapPlanner(self.deployment_manager.startup_bootstrap,
+                                           self.name_formatting).plan(self.appetite_hosts, self.run_hosts)
 
-        check_hn = check_hostname if check_hostname else host.hostname
+        for hostname in bootstrap_plans:
+            self.appetite_hosts.get_host(hostname).restart = True
 
-        if Helpers.check_host(check_hn,
-                              row_values.black_list,
-                              row_values.white_list):
-            self.add_app(host, row_values, deployment, is_firstrun, check_hn)
-            return True
-        return False
+        return bootstrap_plans
 
-    def add_app(self, host, row_values, deployment, is_firstrun, ref_hostname=None):
+    def add_app(self, host, profile, row_values, deployment, is_firstrun, ref_hostname=None):
         """Add app to host"""
 
-        host.add_app(self.args.refname,
+        host.add_app(profile.refname,
                      AppetiteHost.create_app(
                          self.repo_manager,
                          self.deployment_manager,
@@ -420,305 +543,209 @@ class Appetite(object):
           1. Validate app data and configurations
           2. Create tmp directories for each host with loaded apps and manifest
           3. Package (tar) up host tmp directories for distribution
+
+        Apps from all profiles are packaged into a single payload per host.
         """
 
         Helpers.delete_path(self.tmp_folder)
+        self.repo_manager.clear_staged_commits()
         Helpers.create_path(self.tars_folder, True)
+        Helpers.create_path(self.fragments_folder, True)
 
         self.repo_manager.set_commit_id()
         master_commit_log = self.repo_manager.get_commit_log()
+        self.head_commit_id = master_commit_log['app_commit_id']
 
         errors_found = False
         changes_found = False
+        dups = []
+        packages = []
+
+        # Packaged apps are shared between hosts and, if the cache is on, runs
+        cache_size_cap = self.args.payload_cache_size * 1024 * 1024
+        self.template_refs = {}
+        self.payload_cache = PayloadCache.PayloadCache(
+            os.path.join(self.cache_folder, 'payloads') if cache_size_cap > 0 else
+            os.path.join(self.fragments_folder, 'payloads'),
+            cache_size_cap,
+            [self.args.repo_url, self.base_name, self.args.install_ignore,
+             bool(self.template_values and self.args.templating), self.args.template_regex,
+             self.deployment_manager.inclusion_filename,
+             Helpers.get_file_checksum(self.deployment_manager.paths['dm_filepath'])])
+        Helpers.create_path(self.payload_cache.cache_folder, True)
+
+        for host in self.run_hosts:
+            # Per host and profile, compare apps against the remote meta
+            profile_metas = []
+            host_has_apps = False
+
+            for profile in self.profiles:
+                apps_meta, profile_dups, profile_errors = self.diff_host_apps(host, profile, master_commit_log)
+
+                dups += profile_dups
+                errors_found = errors_found or profile_errors
+                host_has_apps = host_has_apps or len(apps_meta) > 0
+
+                # Only do something if there has been a change
+                if next((True for app in apps_meta if not app.is_unchanged), False):
+                    profile_metas.append((profile, apps_meta))
+
+            if not host_has_apps:
+                Logger.warn("Host with no apps", hostname=host.hostname)
+                continue
 
-        for host in self.appetite_hosts:  # pylint: disable=too-many-nested-blocks
-            # Per host build apps folder and tar up based on class
-            hostname = host.hostname
-            apps = host.get_apps(self.args.refname)
-            tarname = host.tarname
+            if len(profile_metas) < 1:
+                continue
 
-            apps = sorted(apps, key=lambda app: app.commit_id)
+            # No point continuing if there is no connection to the host
+            if not self.check_host_connection(host):
+                continue
 
-            tmp_hostname_dir = os.path.join(self.hosts_folder, hostname)
-            tmp_hostname_meta = os.path.join(tmp_hostname_dir, Consts.META_DIR)
+            if not self.args.skip_payload:
+                self.set_host_codec(host)
 
-            apps_meta = []
+            packages.append((host, profile_metas))
 
-            if len(apps) < 1:
-                Logger.warn("Host with no apps", hostname=hostname)
-                continue
+        # Apps for all hosts are built before the host payloads are packaged
+        app_fragments = self.build_payload_apps(packages)
 
-            # Parse the remote meta file from the host
-            # This file might not exist
-            remote_meta_file = host.local_meta_file
-            remote_metas_loaded = False
-            if os.path.exists(remote_meta_file):
-                try:
-                    with open(remote_meta_file) as remote_data_file:
-                        remote_metas_master = json.load(remote_data_file)
-                        remote_metas_content = remote_metas_master['content'] \
-                            if 'content' in remote_metas_master else remote_metas_master
-                        remote_metas = [
-                            AppetiteHost.create_app_from_object(self.repo_manager,
-                                                                self.deployment_manager,
-                                                                meta_data)
-                            for meta_data in remote_metas_content]
-
-                        remote_metas_loaded = True
-                except Exception as exception:
-                    Logger.error("Problems loading meta file",
-                                 error=exception.message,
-                                 path=remote_meta_file)
-            elif not self.args.dryrun:
-                Logger.warn("Local version of remote meta not found", file=remote_meta_file)
-
-            ordered_unique_apps = sorted(list(set(apps)), key=lambda single_app:
-            (single_app.name,
-             single_app.commit_id,
-             single_app.method_name))
-
-            for iapp in ordered_unique_apps:
-                app_occurrences = apps.count(iapp)
-                if app_occurrences > 1:
-                    Logger.warn("Dup app found", host=host.hostname,
-                                app_info=iapp.app_key,
-                                occurences=app_occurrences)
-
-            # Validate app data and configurations
-
-            # Go through the apps and checks to see if there are any errors
-            # This is where the remote meta is compared to the newly generated
-            # lists of apps from the manifest
-            for app in ordered_unique_apps:
-                if host.hostname == 'splunk-ds001-0c' and app.app == 'App06':
-                    print "found Host"
-
-                # Make sure commit id has value
-                if not app.commit_id:
-                    # pylint: disable=else-if-used
-                    if self.args.strict_commitids:
-                        Logger.error("Application with missing commit Id", hostname=hostname,
-                                     app=app.name)
-                        errors_found = True
-                        continue
-                    else:
-                        app.default_commit_id = master_commit_log['app_commit_id']
-
-                meta_to_append = None
-                app.refresh_version_info(self.args.refname, Consts.META_APP_UNCHANGED)
-                remote_meta = None
-
-                # Check to see what has changed
-                if remote_metas_loaded:
-                    # Searches remote meta to see if application already exists
-                    remote_meta = next((rmeta for rmeta in remote_metas
-                                        if app.check_names(rmeta)), None)
-
-                    if remote_meta:
-                        check_commit_id = remote_meta.commit_id.startswith(app.commit_id) or\
-                                          app.commit_id.startswith(remote_meta.commit_id)
-
-                        if check_commit_id:
-                            # meta has not changed so use existing meta
-                            meta_to_append = app.clone
-                            meta_to_append.update_app_version(app)
-                        else:
-                            # If app does exist on system, have the commit ids changed
-                            meta_to_append = app.set_status_changed()
-
-                        # to track if an app is removed from the remote meta
-                        remote_metas.remove(remote_meta)
-
-                if not meta_to_append:
-                    # There is no remote meta so all files should be added
-                    meta_to_append = app.set_status_added()
-
-                if remote_meta and meta_to_append:
-                    meta_outcome = Helpers.debug_app_versions(meta_to_append,
-                                                              remote_meta,
-                                                              meta_to_append.status)
-
-                    if meta_to_append.has_changed:
-                        Logger.info("App change", logic=meta_outcome)
-
-                if meta_to_append:
-                    apps_meta.append(meta_to_append)
-
-            if remote_metas_loaded and len(remote_metas) > 0:
-                # Any apps left in the remote meta do not exist in the current
-                # manifest and should be deleted
-                delete_list = []
-                for deleted_app in remote_metas:
-                    if deleted_app.method_info:
-                        deleted_app.set_status_deleted()
-                        # Added logic check to catch method changes
-                        added_app_found = next((app for app in apps_meta
-                                                if app.status == Consts.META_APP_ADDED
-                                                and app.name == deleted_app.name and
-                                                app.method_info['path'] ==
-                                                deleted_app.method_info['path']), None)
-                        if added_app_found:
-                            added_app_found.set_status_changed()
-                        else:
-                            delete_list.append(deleted_app)
-                    else:
-                        Logger.error(
-                            "Problems with method info for deleted app.",
-                            hostname=hostname, app=deleted_app.name)
+        for host, profile_metas in packages:
+            host.updates = self.package_host(host, profile_metas, app_fragments[host.hostname])
+            changes_found = True
 
-                apps_meta += delete_list
+        # Duplicates for all hosts are reported together
+        if dups:
+            Logger.warn("Dup app found", dups=dups)
 
-            # Only do something if there has been a change
-            if len([app for app in apps_meta if not app.is_unchanged]) < 1:
-                continue
+        if not self.args.skip_payload:
+            Logger.info("Payload cache", hits=self.payload_cache.hits, misses=self.payload_cache.misses)
+            self.payload_cache.evict()
 
-            # No point continuing if there is no connection to the host
-            if not self.check_host_connection(host):
-                continue
+        if errors_found:
+            sys.exit(1)
 
-            # Clean command lines for auth params
-            # This data is ingested so creds should be removed
-            # apps_meta = [updated_app.clone for updated_app in apps_meta]
+        return changes_found
 
-            if not self.args.disable_logging:
-                for updated_app in apps_meta:
-                    Logger.log_event(updated_app.to_dict)
+    def diff_host_apps(self, host, profile, master_commit_log):
+        """Compare apps from the manifest against the remote meta of a host
 
-            # Applications that actually needs to be updated
-            tar_apps = sorted([updated_app for updated_app in apps_meta if updated_app.updated],
-                              key=lambda tar_app: tar_app.app)
+        :return: (apps_meta, dups, errors_found)
+        """
+        hostname = host.hostname
+        apps = host.get_apps(profile.refname)
+        errors_found = False
 
-            use_templating = self.template_values and self.args.templating
+        apps = sorted(apps, key=lambda app: app.commit_id)
+
+        apps_meta = []
+
+        if len(apps) < 1:
+            return apps_meta, [], errors_found
+
+        # Remote meta from the host, synced into the state store
+        # This meta might not exist
+        remote_metas_content = self.state_store.get_metas(hostname, profile.meta_name)
+        remote_metas_loaded = remote_metas_content is not None
+        if remote_metas_loaded:
+            remote_metas = [
+                AppetiteHost.create_app_from_object(self.repo_manager,
+                                                    self.deployment_manager,
+                                                    meta_data)
+                for meta_data in remote_metas_content]
+        elif not self.args.dryrun:
+            Logger.warn("Local version of remote meta not found",
+                        file=host.get_local_meta_file(profile.meta_name))
+
+        self.remote_files_metas[(hostname, profile.meta_name)] = \
+            self.load_files_meta(host.get_local_meta_file(profile.files_meta_name)) if remote_metas_loaded else {}
+
+        ordered_unique_apps, dup_apps = AppDiff.count_apps(apps)
+
+        dups = [{'hostname': hostname, 'app_info': app.app_key, 'occurences': occurrences}
+                for app, occurrences in dup_apps]
+
+        # Validate app data and configurations
+
+        # Go through the apps and checks to see if there are any errors
+        valid_apps = []
+        for app in ordered_unique_apps:
+            # Make sure commit id has value
+            if not app.commit_id:
+                # pylint: disable=else-if-used
+                if self.args.strict_commitids:
+                    Logger.error("Application with missing commit Id", hostname=hostname,
+                                 app=app.name)
+                    errors_found = True
+                    continue
+                else:
+                    app.default_commit_id = master_commit_log['app_commit_id']
 
-            # Checking will allow templating otherwise will skip steps
-            Helpers.create_path(os.path.join(tmp_hostname_meta, Consts.HOST_LOGS_FOLDER_NAME), True)
-            if len(tar_apps) > 0:
-                # All error checks have been done above, build out
-                # the hosts directory and tar up
-                for updated_app in tar_apps:
-                    app_path = os.path.join(tmp_hostname_dir, updated_app.method_info['path'])
-                    Helpers.create_path(app_path, True)
-                    raw_app_path = os.path.join(self.apps_folder, updated_app.name)
-
-                    if updated_app.update_method_is_copy:
-                        app_dest = os.path.join(app_path, updated_app.app_clean)
-                    else:
-                        app_dest = app_path
+            valid_apps.append(app)
 
-                    if self.args.skip_payload:
-                        updated_app.update_commit_log(updated_app.commit_id)
-                        continue
+        # This is where the remote meta is compared to the newly generated
+        # lists of apps from the manifest
+        apps_meta = AppDiff.diff_apps(valid_apps,
+                                      remote_metas if remote_metas_loaded else None,
+                                      profile.refname,
+                                      hostname)
 
-                    # Checkout app and check commit Id for problems
-                    self.repo_manager.set_commit_id(updated_app.commit_id)
-                    updated_app.update_commit_log()
-
-                    # Checks if app exists with the correct commit id
-                    if not Helpers.check_path(raw_app_path):
-                        Logger.error("Missing application",
-                                     hostname=hostname,
-                                     app=updated_app.name,
-                                     path=raw_app_path,
-                                     commit_id=updated_app.commit_id)
-
-                        # Remove app from change list since it is not being updated
-                        for app_meta_obj in apps_meta:
-                            if app_meta_obj.app == updated_app.name:
-                                app_meta_obj.set_status_skipped()
-                        continue
+        return apps_meta, dups, errors_found
+
+    @staticmethod
+    def load_files_meta(files_meta_file):
+        """Load the file hashes of the apps installed on a host
+
+        Hosts updated before the files meta was added do not have one.
+        """
+        if not os.path.exists(files_meta_file):
+            return {}
+
+        try:
+            with open(files_meta_file) as f:
+                return json.load(f)
+        except Exception as exception:
+            Logger.error("Problems loading files meta file",
+                         error=exception.message,
+                         path=files_meta_file)
+        return {}
+
+    def get_delta_base(self, host, profile, updated_app):
+        """Remote file hashes a changed app can be sent as a delta against
+
+        :return: {relative path: sha1} or None if the whole app is sent
+        """
+        if self.args.full_payloads or not updated_app.is_changed or \
+                not updated_app.update_method_is_copy or updated_app.method_info['delete_first']:
+            return None
+
+        remote_files = self.remote_files_metas.get((host.hostname, profile.meta_name), {}).get(
+            AppDelta.get_files_key(updated_app))
 
-                    copy_tree(raw_app_path, app_dest)
-
-                    lookups_inclusion_location = os.path.join(app_dest,
-                                                              self.deployment_manager.
-                                                              inclusion_filename)
-
-                    ignore_dir = os.path.join(app_dest, Consts.TMP_IGNORE_DIR)
-
-                    # Ignore files/folders set in the global configurations
-                    if self.args.install_ignore:
-                        content_ignored_results = Helpers.move_regexed_files(self.args.install_ignore.split(';'),
-                                                                             app_dest,
-                                                                             ignore_dir)
-                        files_included = content_ignored_results['files_moved']
-
-                        if len(files_included) > 0:
-                            Logger.error("Globally these files should not exist in the App. "
-                                         "The files have been removed from the install.",
-                                         files=files_included,
-                                         hostname=hostname,
-                                         app=updated_app.name)
-
-                    # Users should not have the capability to include files from the
-                    # global ignore.
-                    Helpers.delete_path(ignore_dir)
-
-                    # Defined folders/files are to move out of application.
-                    # This is defined in the deploymentmethods.conf
-                    # If an app is installed for the first time, all files should be included
-                    if 'install_ignore' in updated_app.method_info and not updated_app.is_added:
-                        Helpers.move_regexed_files(updated_app.method_info['install_ignore'],
-                                                   app_dest,
-                                                   ignore_dir)
-
-                        # If there is a inclusion file, include files back into app.
-                        # This is defined on a per app basis
-                        if os.path.isfile(lookups_inclusion_location):
-                            with open(lookups_inclusion_location, "r") as f:
-                                lines = [l.strip() for l in f.readlines()]
-
-                            lookup_inclusion_results = Helpers.move_regexed_files(lines,
-                                                                                  ignore_dir,
-                                                                                  app_dest)
-
-                            if lookup_inclusion_results['errors_found']:
-                                Logger.warn("Lookup inclusion error found",
-                                            paths=lookup_inclusion_results['path_errors'],
-                                            hostname=hostname,
-                                            app=updated_app.name,
-                                            todo="Remove file/path from inclusion..")
-                                # Problem with host inclusion,
-                                # move to next host
-                                continue
-
-                            updated_app.method_info['inclusions'] = \
-                                lookup_inclusion_results['files_moved']
-
-                            # Update objects with inclusions
-                            updated_app.copy_value_to_method_info('inclusions', apps_meta)
-                            os.remove(lookups_inclusion_location)
-
-                    Helpers.delete_path(ignore_dir)
-
-                    _template_vars = [self.template_values,
-                                      host.to_dict,
-                                      updated_app.to_dict]
-
-                    _template_vars_merged = Helpers.merge_templates(_template_vars)
-
-                    # Should only change access and create version file if a whole app is copied
-                    if updated_app.update_method_is_copy:
-                        if use_templating and not updated_app.method_info['skip_templating']:
-                            # Can template based on vars from templated
-                            # values, hosts vars and app vars
-                            Helpers.template_directory(app_dest,
-                                                       _template_vars_merged,
-                                                       self.args.template_regex
-                                                       )
-
-                        for host_path, host_dir, host_files in os.walk(app_dest):  # pylint: disable=unused-variable
-                            for host_file in host_files:
-                                # Splunk apps can have active binaries in multiple languages
-                                # This is a catch all to make sure apps have all the required
-                                # permissions.
-                                chmod = 0755
-                                os.chmod(os.path.join(host_path, host_file), chmod)
-
-                        # Only update app version file if doing a full copy
-                        if not updated_app.method_info['no_appetite_changes']:
-                            AppVersioning.create_app_version(app_dest,
-                                                             updated_app.commit_log['app_abbrev_commit_id'])
+        # App has to be installed at the same path
+        if not remote_files or remote_files.get('path') != AppDelta.get_app_path(updated_app):
+            return None
 
+        return remote_files['files']
+
+    def package_host(self, host, profile_metas, app_fragments):
+        """Build the payload for a single host
+
+        Meta files for every changed profile are added to the host tmp
+        directory and packaged (tar) with the host app fragments into a
+        single payload.
+
+        :return: Combined updates for the host
+        """
+        hostname = host.hostname
+        tmp_hostname_dir = os.path.join(self.hosts_folder, hostname)
+        tmp_hostname_meta = os.path.join(tmp_hostname_dir, Consts.META_DIR)
+
+        profile_updates = []
+
+        # Checking will allow templating otherwise will skip steps
+        Helpers.create_path(os.path.join(tmp_hostname_meta, Consts.HOST_LOGS_FOLDER_NAME), True)
+
+        for profile, apps_meta in profile_metas:
             host_updates = Helpers.content_process(apps_meta,
                                                    Consts.META_UPDATED,
                                                    hostname,
@@ -735,14 +762,13 @@ class Appetite(object):
                                                   self.track)
 
             # Meta file used as source of truth on instance
-            master_meta = self.create_meta_files(tmp_hostname_meta, '', apps_distro)
+            master_meta = self.create_meta_files(tmp_hostname_meta, profile.meta_name, '', apps_distro)
 
             # check be used to update and test manifest changes locally
             if self.args.dryrun:
-                Helpers.create_path(host.local_meta_file)
-                shutil.copy(master_meta, host.local_meta_file)
-
-            host.updates = host_updates
+                local_meta_file = host.get_local_meta_file(profile.meta_name)
+                Helpers.create_path(local_meta_file)
+                shutil.copy(master_meta, local_meta_file)
 
             if not self.args.skip_payload:
                 # Always want clean logs ingested
@@ -750,38 +776,446 @@ class Appetite(object):
                                                                Consts.META_CURRENT,
                                                                False)
 
-                self.create_meta_log(tmp_hostname_meta, '', selected_apps, Helpers.get_utc())
+                self.create_meta_log(tmp_hostname_meta, profile.meta_name, '', selected_apps, Helpers.get_utc())
 
                 # Create the meta change file
                 self.create_meta_files(tmp_hostname_meta,
+                                       profile.meta_name,
                                        '_update',
-                                       Helpers.content_convert(host.updates))
+                                       Helpers.content_convert(host_updates))
 
                 # Clean updates file for logging
                 selected_apps = Helpers.select_and_update_apps(apps_meta,
                                                                Consts.META_UPDATED,
                                                                True)
 
-                self.create_meta_log(tmp_hostname_meta, '_update', selected_apps, Helpers.get_utc())
+                self.create_meta_log(tmp_hostname_meta, profile.meta_name, '_update', selected_apps,
+                                     Helpers.get_utc())
+
+                # Hashes of the installed files, changed apps are sent as deltas against them
+                files_meta = self.create_meta_files(tmp_hostname_meta, profile.files_meta_name, '',
+                                                    AppDelta.get_files_meta(
+                                                        apps_meta,
+                                                        self.remote_files_metas.get((hostname, profile.meta_name),
+                                                                                    {})),
+                                                    compact=True)
 
-                # Package (tar) up host tmp directories for distribution
-                tar = tarfile.open(os.path.join(self.tars_folder, "%s.tar.gz" % tarname), "w:gz")
-                tar.add(tmp_hostname_dir, arcname=os.path.basename(self.base_name))
-                tar.close()
+                if self.args.dryrun:
+                    shutil.copy(files_meta, host.get_local_meta_file(profile.files_meta_name))
 
             Logger.info("Changes found", updates=Helpers.content_wrapper(apps_meta,
                                                                          Consts.META_UPDATED,
                                                                          hostname,
                                                                          self.track,
                                                                          True))
-            changes_found = True
+            profile_updates.append(host_updates)
 
-        if errors_found:
-            sys.exit(1)
+        if not self.args.skip_payload:
+            # Package (tar) up host tmp directories for distribution
+            arcname = os.path.basename(self.base_name)
 
-        self.repo_manager.set_commit_id()
+            meta_fragment = os.path.join(self.fragments_folder, "%s_meta%s" % (host.tarname,
+                                                                            host.payload_codec.extension))
+            Helpers.create_tar_fragment([(meta_fragment, host.payload_codec)], tmp_hostname_meta,
+                                        os.path.join(arcname, Consts.META_DIR), end_archive=True)
 
-        return changes_found
+            Helpers.concat_files(host.tar_file, app_fragments + [meta_fragment])
+
+        return Helpers.merge_content_updates(profile_updates)
+
+    def build_payload_apps(self, packages):
+        """Build and package (tar) the apps of every host
+
+        Apps found in the payload cache are not built again.  The other apps
+        are built once per cache key by a pool of processes and the results
+        are copied back into the apps of every host, in host order.
+
+        Apps found in the payload cache from a previous run are not added to
+        the host tmp directory.
+
+        Each build is packaged once for every payload codec of its hosts, as
+        a whole app and as a delta against every remote version its hosts
+        have.
+
+        :param packages: [(host, profile_metas)]
+        :return: {hostname: [app fragments]} in payload order
+        """
+        app_fragments = {}
+
+        # Identical app builds of every host, built once
+        payload_groups = PayloadGroups.PayloadGroups()
+
+        # (host, app path, fragment) of the apps sent as deltas
+        delta_apps = []
+
+        for host, profile_metas in packages:
+            host_fragments = app_fragments[host.hostname] = []
+            codec = host.payload_codec
+
+            for profile, apps_meta in profile_metas:
+                # Clean command lines for auth params
+                # This data is ingested so creds should be removed
+                # apps_meta = [updated_app.clone for updated_app in apps_meta]
+
+                if not self.args.disable_logging:
+                    for updated_app in apps_meta:
+                        Logger.log_event(updated_app.to_dict)
+
+                # All error checks have been done above, build out
+                # the apps that actually needs to be updated
+                for updated_app in PayloadGroups.get_build_apps(apps_meta):
+                    if self.args.skip_payload:
+                        updated_app.update_commit_log(self.repo_manager, updated_app.commit_id)
+                        continue
+
+                    cache_key = self.get_cache_key(host, profile, updated_app)
+
+                    # Changed apps are sent as the files that differ from the remote
+                    base_files = self.get_delta_base(host, profile, updated_app)
+                    base_key = PayloadCache.hash_key(base_files) if base_files else None
+                    fragment_key = PayloadCache.get_delta_key(cache_key, base_key) if cache_key else None
+
+                    build_info = self.payload_cache.get(fragment_key, codec.fragment_ext) \
+                        if fragment_key and cache_key not in payload_groups else None
+                    if build_info:
+                        self.copy_build_info(host, profile, updated_app, apps_meta, build_info)
+                        fragment = self.payload_cache.get_path(fragment_key, codec.fragment_ext)
+                    else:
+                        # Replaced by the fragment once built
+                        fragment = payload_groups.add(cache_key, codec, base_key, base_files,
+                                                      host, profile, updated_app, apps_meta)
+
+                    host_fragments.append(fragment)
+                    if base_key:
+                        delta_apps.append((host, updated_app.path(self.args.app_folder), fragment))
+
+        build_fragments = self.build_package_apps(payload_groups) if payload_groups else {}
+
+        for hostname, host_fragments in app_fragments.items():
+            app_fragments[hostname] = [build_fragments.get(fragment, fragment) for fragment in host_fragments
+                                       if build_fragments.get(fragment, fragment)]
+
+        for host, app_path, fragment in delta_apps:
+            if build_fragments.get(fragment, fragment):
+                host.delta_apps.append(app_path)
+
+        return app_fragments
+
+    def build_package_apps(self, payload_groups):
+        """Build and package (tar) apps missing from the payload cache
+
+        :param payload_groups: PayloadGroups of the apps to build
+        :return: {(build id, base key, codec name): fragment or None if skipped}
+        """
+        builds = payload_groups.groups
+
+        # Apps are exported once for each commit id they are built from
+        commit_paths = payload_groups.get_commit_paths()
+
+        staged_paths = sum(self.repo_manager.stage_commit(commit_id, paths, self.commits_folder)
+                           for commit_id, paths in commit_paths.items())
+
+        Logger.info("Commits staged", commits=len(commit_paths), paths=staged_paths, builds=len(builds))
+
+        num_builds = self.args.num_builds if self.args.num_builds > 0 else cpu_count()
+        iter_builds = [(self, 'build_package_app', build_num, build['codecs'].values(), build['bases']) +
+                       build['apps'][0]
+                       for build_num, build in enumerate(builds.values())]
+
+        if num_builds == 1 or len(iter_builds) < 2:
+            results = [Helpers.call_func(iter_build) for iter_build in iter_builds]
+        else:
+            build_pool = Pool(processes=min(num_builds, len(iter_builds)),
+                              initializer=ConnManager.release_connections)
+            results = build_pool.map(Helpers.call_func, iter_builds)
+            build_pool.close()
+            build_pool.join()
+
+        build_fragments = {}
+        for build_id, result in zip(builds.keys(), results):
+            build = builds[build_id]
+
+            for base_key in build['bases']:
+                if result['complete'] and build['cache_key']:
+                    fragment_key = PayloadCache.get_delta_key(build['cache_key'], base_key)
+                    self.payload_cache.add(fragment_key,
+                                           [(result['fragments'][(base_key, codec_name)], codec.fragment_ext)
+                                            for codec_name, codec in build['codecs'].items()],
+                                           result['build_info'])
+
+                    for codec_name, codec in build['codecs'].items():
+                        result['fragments'][(base_key, codec_name)] = \
+                            self.payload_cache.get_path(fragment_key, codec.fragment_ext)
+
+                for codec_name in build['codecs']:
+                    build_fragments[(build_id, base_key, codec_name)] = None if result['skipped'] else \
+                        result['fragments'][(base_key, codec_name)]
+
+            # First app is the one built, its logs are already written
+            for build_num, (host, profile, updated_app, apps_meta) in enumerate(build['apps']):
+                self.copy_build_info(host, profile, updated_app, apps_meta, result['build_info'],
+                                     build_num > 0)
+
+                if not updated_app.is_skipped:
+                    Helpers.link_tree(result['build_dir'], os.path.join(self.hosts_folder, host.hostname))
+
+        return build_fragments
+
+    def build_package_app(self, build_num, codecs, bases, host, profile, updated_app, apps_meta):
+        """Build and package (tar) a single app
+
+        Apps are built on their own so the fragment only has the app.
+
+        :param codecs: Payload codecs to package the app with
+        :param bases: OrderedDict base key -> remote file hashes to package
+                      a delta against, None key for the whole app
+        :return: build result
+        """
+        build_dir = os.path.join(self.builds_folder, str(build_num))
+        Helpers.create_path(build_dir, True)
+
+        ignored_files = self.build_app(host, profile, updated_app, apps_meta, build_dir)
+
+        build_info = updated_app.build_info
+        build_info['ignored_files'] = ignored_files if ignored_files else []
+        build_info['skipped'] = updated_app.is_skipped
+
+        result = {'build_info': build_info,
+                  'build_dir': build_dir,
+                  'skipped': updated_app.is_skipped,
+                  'complete': ignored_files is not None,
+                  'fragments': {}}
+
+        if updated_app.is_skipped:
+            return result
+
+        arcname = os.path.basename(self.base_name)
+        app_path = AppDelta.get_app_path(updated_app)
+        app_dest = os.path.join(build_dir, app_path)
+
+        if updated_app.update_method_is_copy:
+            build_info['file_hashes'] = AppDelta.hash_files(app_dest)
+
+        for base_num, (base_key, base_files) in enumerate(bases.items()):
+            fragment_name = "%s_%s" % (build_num, base_num)
+            fragments = [(os.path.join(self.fragments_folder, "%s%s" % (fragment_name, codec.fragment_ext)), codec)
+                         for codec in codecs]
+
+            if base_key is None:
+                Helpers.create_tar_fragment(fragments, build_dir, arcname)
+            else:
+                delta_dir = os.path.join(self.builds_folder, fragment_name)
+                changed_files, deleted_files = AppDelta.create_delta(
+                    app_dest, os.path.join(delta_dir, app_path), base_files, build_info['file_hashes'],
+                    updated_app.method_info.get('install_ignore') or [])
+
+                Logger.info("App delta", app=updated_app.name, changed=len(changed_files),
+                            deleted=len(deleted_files), files=len(build_info['file_hashes']))
+
+                Helpers.create_tar_fragment(fragments, delta_dir, arcname)
+
+            for fragment_path, codec in fragments:
+                result['fragments'][(base_key, str(codec))] = fragment_path
+
+        return result
+
+    def get_cache_key(self, host, profile, updated_app):
+        """Payload cache key of an app
+
+        :return: cache key or None if the app has to be built for every host
+        """
+        build_key = PayloadGroups.get_build_key(profile, updated_app)
+        commit_id = updated_app.commit_id or self.head_commit_id
+
+        # Templates that can not be checked are built for every host
+        template_refs = self.get_template_refs(profile, updated_app, build_key, commit_id)
+        if template_refs is None:
+            return None
+
+        template_key = PayloadCache.get_template_key(template_refs, [updated_app.to_dict, host.to_dict,
+                                                                     self.template_values]) \
+            if template_refs else []
+
+        return self.payload_cache.get_key(build_key, commit_id, template_key)
+
+    def copy_build_info(self, host, profile, updated_app, apps_meta, build_info, log_build=True):
+        """Copy the info of an identical app build into an app
+
+        :param log_build: Log errors found in the build for the host
+        """
+        updated_app.copy_build_info(build_info)
+
+        if build_info['skipped']:
+            self.skip_missing_app(host, profile, updated_app, apps_meta, log_build)
+        elif log_build:
+            self.log_ignored_files(host, updated_app, build_info['ignored_files'])
+
+    def skip_missing_app(self, host, profile, updated_app, apps_meta, log_build=True):
+        """Skip an app missing from the repo, the host is checked again next run"""
+        self.pending_hostnames.add(host.hostname)
+
+        if log_build:
+            Logger.error("Missing application",
+                         hostname=host.hostname,
+                         app=updated_app.name,
+                         path=os.path.join(profile.apps_folder, updated_app.name),
+                         commit_id=updated_app.commit_id)
+
+        # Remove app from change list since it is not being updated
+        for app_meta_obj in apps_meta:
+            if app_meta_obj.app == updated_app.name:
+                app_meta_obj.set_status_skipped()
+
+    @staticmethod
+    def log_ignored_files(host, updated_app, ignored_files):
+        """Log files removed from an app by the global install ignore"""
+        if len(ignored_files) > 0:
+            Logger.error("Globally these files should not exist in the App. "
+                         "The files have been removed from the install.",
+                         files=ignored_files,
+                         hostname=host.hostname,
+                         app=updated_app.name)
+
+    def get_template_refs(self, profile, app, build_key, commit_id):
+        """Template variables referenced by an app
+
+        :return: set of variables or None if the templates can not be checked
+        """
+        if not (self.template_values and self.args.templating) or \
+                not app.update_method_is_copy or app.method_info['skip_templating']:
+            return set()
+
+        template_key = (profile.apps_folder, app.name, commit_id)
+        if template_key not in self.template_refs:
+            template_refs = self.payload_cache.get_refs(build_key, commit_id)
+
+            if template_refs is None:
+                raw_app_path = os.path.join(profile.apps_folder, app.name)
+
+                template_refs = Helpers.get_files_template_vars(
+                    self.repo_manager.read_files(app.commit_id, raw_app_path, self.args.template_regex))
+
+                if template_refs is not None:
+                    self.payload_cache.set_refs(build_key, commit_id, template_refs)
+
+            self.template_refs[template_key] = template_refs
+
+        return self.template_refs[template_key]
+
+    def build_app(self, host, profile, updated_app, apps_meta, tmp_hostname_dir):
+        """Copy, filter and template a single app into the host tmp directory
+
+        :return: files removed by the global install ignore or None if the app
+                 was not completely built
+        """
+        hostname = host.hostname
+        use_templating = self.template_values and self.args.templating
+
+        app_path = os.path.join(tmp_hostname_dir, updated_app.method_info['path'])
+        Helpers.create_path(app_path, True)
+        raw_app_path = os.path.join(profile.apps_folder, updated_app.name)
+
+        if updated_app.update_method_is_copy:
+            app_dest = os.path.join(app_path, updated_app.app_clean)
+        else:
+            app_dest = app_path
+
+        # Copy app from the repo, check commit Id for problems
+        commit_log, app_found = self.repo_manager.export_path(updated_app.commit_id, raw_app_path, app_dest)
+        updated_app.set_commit_log(commit_log)
+
+        # Checks if app exists with the correct commit id
+        if not app_found:
+            self.skip_missing_app(host, profile, updated_app, apps_meta)
+            return None
+
+        lookups_inclusion_location = os.path.join(app_dest,
+                                                  self.deployment_manager.
+                                                  inclusion_filename)
+
+        ignore_dir = os.path.join(app_dest, Consts.TMP_IGNORE_DIR)
+
+        # Ignore files/folders set in the global configurations
+        ignored_files = []
+        if self.args.install_ignore:
+            content_ignored_results = Helpers.move_regexed_files(self.args.install_ignore.split(';'),
+                                                                 app_dest,
+                                                                 ignore_dir)
+            ignored_files = content_ignored_results['files_moved']
+            self.log_ignored_files(host, updated_app, ignored_files)
+
+        # Users should not have the capability to include files from the
+        # global ignore.
+        Helpers.delete_path(ignore_dir)
+
+        # Defined folders/files are to move out of application.
+        # This is defined in the deploymentmethods.conf
+        # If an app is installed for the first time, all files should be included
+        if 'install_ignore' in updated_app.method_info and not updated_app.is_added:
+            Helpers.move_regexed_files(updated_app.method_info['install_ignore'],
+                                       app_dest,
+                                       ignore_dir)
+
+            # If there is a inclusion file, include files back into app.
+            # This is defined on a per app basis
+            if os.path.isfile(lookups_inclusion_location):
+                with open(lookups_inclusion_location, "r") as f:
+                    lines = [l.strip() for l in f.readlines()]
+
+                lookup_inclusion_results = Helpers.move_regexed_files(lines,
+                                                                      ignore_dir,
+                                                                      app_dest)
+
+                if lookup_inclusion_results['errors_found']:
+                    Logger.warn("Lookup inclusion error found",
+                                paths=lookup_inclusion_results['path_errors'],
+                                hostname=hostname,
+                                app=updated_app.name,
+                                todo="Remove file/path from inclusion..")
+                    # Problem with host inclusion,
+                    # move to next app
+                    return None
+
+                updated_app.method_info['inclusions'] = \
+                    lookup_inclusion_results['files_moved']
+
+                # Update objects with inclusions
+                updated_app.copy_value_to_method_info('inclusions', apps_meta)
+                os.remove(lookups_inclusion_location)
+
+        Helpers.delete_path(ignore_dir)
+
+        _template_vars = [self.template_values,
+                          host.to_dict,
+                          updated_app.to_dict]
+
+        _template_vars_merged = Helpers.merge_templates(_template_vars)
+
+        # Should only change access and create version file if a whole app is copied
+        if updated_app.update_method_is_copy:
+            if use_templating and not updated_app.method_info['skip_templating']:
+                # Can template based on vars from templated
+                # values, hosts vars and app vars
+                Helpers.template_directory(app_dest,
+                                           _template_vars_merged,
+                                           self.args.template_regex
+                                           )
+
+            for host_path, host_dir, host_files in os.walk(app_dest):  # pylint: disable=unused-variable
+                for host_file in host_files:
+                    # Splunk apps can have active binaries in multiple languages
+                    # This is a catch all to make sure apps have all the required
+                    # permissions.
+                    chmod = 0755
+                    if not os.path.islink(os.path.join(host_path, host_file)):
+                        os.chmod(os.path.join(host_path, host_file), chmod)
+
+            # Only update app version file if doing a full copy
+            if not updated_app.method_info['no_appetite_changes']:
+                AppVersioning.create_app_version(app_dest,
+                                                 updated_app.commit_log['app_abbrev_commit_id'])
+
+        return ignored_files
 
     @property
     def track(self):
@@ -799,10 +1233,11 @@ class Appetite(object):
         print(json.dumps(ref_track, sort_keys=True, indent=4,
                          separators=(',', ': ')))
 
-    def update_manifests(self, hosts=None, check_if_exists=False):
+    def update_manifests(self, hosts=None):
         """Loads local manifest
 
-        Tries to get the remote manifest from the host
+        Tries to get the remote manifest from the host.  Nothing is changed
+        on the hosts so more connections are used than for updates.
         """
 
         if not hosts:
@@ -811,7 +1246,7 @@ class Appetite(object):
         if isinstance(hosts, AppetiteHost):
             hosts = [hosts]
 
-        results = self._thread_hosts('update_manifest', hosts, check_if_exists)
+        results = self._pool_hosts(self.args.prefetch_connections, 'update_manifest', hosts)
 
         # Since threading does not share variables, the results are copied back into the
         # host objects
@@ -820,53 +1255,126 @@ class Appetite(object):
                 if not host.from_dict(results[i]):
                     Logger.warn("Threading host mismatch")
 
-    def update_manifest(self, host, check_if_exists=False):
-        """Loads local manifest for a host for local host"""
+    def update_manifest(self, host):
+        """Loads local manifest for a host for local host
+
+        A manifest is kept for each profile, the host is seen as having a
+        manifest if any of them are found.  The connection check, the metas
+        and the binaries used by the payload codec are all done in a single
+        session.
+        """
+
+        meta_files = []
+        for profile in self.profiles:
+            meta_files.append((profile.meta_remote_file, host.get_local_meta_file(profile.meta_name)))
+            meta_files.append((profile.files_meta_remote_file, host.get_local_meta_file(profile.files_meta_name)))
+
+        binaries = [self.payload_codec.binary] \
+            if self.payload_codec.binary and host.remote_binaries is None else []
+
+        prefetched = ConnManager.prefetch(host, meta_files, binaries, True)
+
+        host.can_connect = prefetched['can_connect']
+        if not host.can_connect:
+            Logger.error("Can not connect to host",
+                         host=host.hostname)
+            return host.get_threaded_values
+
+        if host.remote_binaries is None:
+            host.remote_binaries = prefetched['binaries']
+
+        read_errors = prefetched['read_errors']
+        host.metas_read_failed = bool(read_errors)
+        if read_errors:
+            Logger.error("Problem reading host metas, local copies kept", hostname=host.hostname,
+                         files=read_errors)
+
+        manifests_found = []
+        for (meta_remote_file, local_meta_file), (files_meta_remote_file, local_files_meta_file) in \
+                zip(meta_files[::2], meta_files[1::2]):
+            # Local metas are used if the files were not read (dry run or read error)
+            manifest_found = prefetched['files'][meta_remote_file]
+            if manifest_found is None:
+                manifest_found = os.path.isfile(local_meta_file)
+            elif not manifest_found:
+                Helpers.delete_path(local_meta_file)
+
+            # Older hosts only have the meta file, without current file hashes apps are sent whole
+            if not manifest_found or prefetched['files'][files_meta_remote_file] is False or \
+                    files_meta_remote_file in read_errors:
+                Helpers.delete_path(local_files_meta_file)
+
+            # Without any copy of its meta the host is not seen as new
+            if meta_remote_file in read_errors and not manifest_found:
+                host.can_connect = False
+
+            manifests_found.append(manifest_found)
+
+        host.manifest_found = any(manifests_found)
 
-        host.manifest_found = os.path.isfile(host.local_meta_file)
-        if not check_if_exists or not host.manifest_found:
-            if self.check_host_connection(host):
-                host.manifest_found = ConnManager.get_json_file(host, self.meta_remote_file,
-                                                                host.local_meta_file, True)
         return host.get_threaded_values
 
-    def create_meta_filename(self, host_meta_path, postfix, extension, timestamp=None):
+    def sync_state_store(self, hosts):
+        """Sync the local metas of hosts into the state store"""
+        changes = 0
+        for host in hosts:
+            for profile in self.profiles:
+                changes += self.state_store.sync_meta(host.hostname, profile.meta_name,
+                                                      host.get_local_meta_file(profile.meta_name))
+
+        Logger.info("State store synced", hosts=len(hosts), changes=changes)
+
+    def find_app(self):
+        """Print the hosts with an app installed and the history of the app
+
+        Uses the state store from the last run, no hosts are checked.
+        """
+        app, _sep, commit_id = self.args.find_app.strip("'\"").partition(':')
+
+        print(json.dumps({'app': app,
+                          'commit_id': commit_id,
+                          'hosts': self.state_store.find_hosts(app, commit_id),
+                          'history': self.state_store.get_history(app=app)},
+                         sort_keys=True, indent=4, separators=(',', ': ')))
+
+    @staticmethod
+    def create_meta_filename(host_meta_path, meta_name, postfix, extension, timestamp=None):
         """create file name for the meta content"""
 
         if timestamp:
             filtered_timestamp = Helpers.filter_timestamp(timestamp)
             return "%s%s_%s.%s" % (os.path.join(host_meta_path,
                                                 Consts.HOST_LOGS_FOLDER_NAME,
-                                                self.meta_name),
+                                                meta_name),
                                    postfix, filtered_timestamp, extension)
         else:
             return "%s%s.%s" % (os.path.join(host_meta_path,
                                              host_meta_path,
-                                             self.meta_name),
+                                             meta_name),
                                 postfix, extension)
 
-    def create_meta_files(self, host_meta_path, postfix, content, timestamp=None):
+    def create_meta_files(self, host_meta_path, meta_name, postfix, content, timestamp=None, compact=False):
         """Creates a meta json file
 
         Create a single json file with a host meta object
         """
 
-        created_meta = self.create_meta_filename(host_meta_path, postfix, 'json', timestamp)
+        created_meta = self.create_meta_filename(host_meta_path, meta_name, postfix, 'json', timestamp)
         with open(created_meta, "w") as f:
-            if timestamp:
+            if timestamp or compact:
                 f.write(json.dumps(content))
             else:
                 f.write(json.dumps(content, sort_keys=True, indent=4, separators=(',', ': ')))
         return created_meta
 
-    def create_meta_log(self, host_meta_path, postfix, content, timestamp=None):
+    def create_meta_log(self, host_meta_path, meta_name, postfix, content, timestamp=None):
         """Creates a meta json log file
 
         Create file with multiple entries for content.
         This is used for logging
         """
 
-        created_meta_log = self.create_meta_filename(host_meta_path, postfix, 'log', timestamp)
+        created_meta_log = self.create_meta_filename(host_meta_path, meta_name, postfix, 'log', timestamp)
         with open(created_meta_log, "a") as f:
             for entry in content:
                 f.write("%s\n" % entry.to_json)
@@ -882,8 +1390,7 @@ class Appetite(object):
         changed_hosts = [host for host in self.appetite_hosts if host.updates]
 
         # Lists Sites
-        host_sites = list(set([host.site for host in self.appetite_hosts]))
-        host_sites.sort()
+        host_sites = self.appetite_hosts.get_values('site')
 
         # Organize scripts to run in order
         for script_seq in Consts.DM_COMMANDS_SEQUENCE:
@@ -895,7 +1402,8 @@ class Appetite(object):
                     if len(host_group) > 0:
                         Logger.info("Starting script run hosts", site='all', boot_group=boot_group,
                                     script_level=script_seq)
-                        self._thread_hosts('update_host', host_group, script_seq)
+                        self.add_pending_hosts(host_group,
+                                               self._thread_hosts('update_host', host_group, script_seq))
                     continue
 
                 # By default will use sites to break up installs
@@ -904,18 +1412,28 @@ class Appetite(object):
                     if len(host_site_group) > 0:
                         Logger.info("Starting script run hosts", site=str(host_site), boot_group=boot_group,
                                     script_level=script_seq)
-                        self._thread_hosts('update_host', host_site_group, script_seq)
+                        self.add_pending_hosts(host_site_group,
+                                               self._thread_hosts('update_host', host_site_group, script_seq))
+
+    def add_pending_hosts(self, hosts, results):
+        """Keep the hosts that were not fully updated"""
+        for host, updated in zip(hosts, results):
+            if not updated:
+                Logger.warn("Host not fully updated, checked again next run", hostname=host.hostname)
+                self.pending_hostnames.add(host.hostname)
 
     def _thread_hosts(self, update_funct, hosts, *args):
         """Helper function to set up threading for hosts"""
+        return self._pool_hosts(self.args.num_connections, update_funct, hosts, *args)
+
+    def _pool_hosts(self, num_processes, update_funct, hosts, *args):
+        """Run a function for each host with up to num_processes at once"""
 
         # If single thread/host is used, no threading is needed
-        if self.args.num_connections == 1 or len(hosts) < 2:
-            for host in hosts:
-                Helpers.call_func((self, update_funct, host) + args)
-            return
+        if num_processes == 1 or len(hosts) < 2:
+            return [Helpers.call_func((self, update_funct, host) + args) for host in hosts]
 
-        host_pool = Pool(processes=self.args.num_connections)
+        host_pool = Pool(processes=num_processes, initializer=ConnManager.release_connections)
         iter_hosts = [(self, update_funct, host) + args for host in hosts]
         results = host_pool.map(Helpers.call_func, iter_hosts)
         host_pool.close()
@@ -923,6 +1441,15 @@ class Appetite(object):
 
         return results
 
+    def set_host_codec(self, host):
+        """Set the payload codec of a host, falls back if the host can not use it"""
+        remote_binaries = host.remote_binaries
+        if remote_binaries is None:
+            remote_binaries = ConnManager.find_binaries(host, [self.payload_codec.binary]) \
+                if self.payload_codec.binary else []
+
+        host.set_payload_codec(PayloadCodec.get_host_codec(self.payload_codec, remote_binaries, host.hostname))
+
     @staticmethod
     def check_host_connection(host):
         """Checks to see if appetite can connect to the host"""
@@ -938,15 +1465,15 @@ class Appetite(object):
         """Update function for host
 
         Separate function used to update a single host
+
+        :return: True if every step of the update succeeded
         """
 
         if not self.check_host_connection(host):
-            return
+            return False
 
         commands = []
 
-        self.template_values = self.appetite_hosts.build_meta(self.template_values)
-
         # Run commands if specified
         if len(host.updates[update_method]) > 0:
             commands = self.ssh_app_commands.enhance_commands(host,
@@ -955,11 +1482,11 @@ class Appetite(object):
 
         not_update_command = update_method != Consts.DM_COMMANDS_SEQUENCE[1]
 
-        self.run_commands(commands, host, not_update_command, True)
+        updated = self.run_commands(commands, host, not_update_command, True)
 
         # If just running a script, should ignore all function related to app deployment
         if not_update_command:
-            return
+            return updated
 
         apps = host.updates['content']
 
@@ -969,18 +1496,31 @@ class Appetite(object):
                                  app.status == Consts.META_APP_DELETED]))
 
         for delete_app in deleted_apps:
-            ConnManager.delete(host, delete_app, True)
+            updated &= ConnManager.delete(host, delete_app, True)
 
-        # Clear old version files
+        # Clear old version files, apps sent as deltas delete their own
         changed_apps = list(set([app.path(self.args.app_folder) for app in apps if
-                                 app.status == Consts.META_APP_CHANGED]))
+                                 app.status == Consts.META_APP_CHANGED]) - set(host.delta_apps))
 
         for changed_app in changed_apps:
-            ConnManager.clear_files(host, changed_app,
-                                    "%s*" % Consts.VERSIONS_FILENAME, True)
+            updated &= ConnManager.clear_files(host, changed_app,
+                                               "%s*" % Consts.VERSIONS_FILENAME, True)
 
         # Install apps and new manifests
-        ConnManager.untar(host, self.base_location, True)
+        updated &= ConnManager.untar(host, self.base_location, True)
+
+        failed_deltas = [delta_app for delta_app in host.delta_apps
+                         if not ConnManager.apply_delta(host, delta_app, True)]
+
+        if failed_deltas:
+            updated = False
+            Logger.error("Problem applying app delta", hostname=host.hostname, app_paths=failed_deltas)
+
+            # Without the file hashes the next changes are sent as whole apps
+            for profile in self.profiles:
+                ConnManager.delete(host, profile.files_meta_remote_file, True)
+
+            self.invalidate_remote_apps(host, failed_deltas)
 
         # In case the command already has a restart in it
         restart_notfound = next((False for command in commands if command['command'].name == "restart"), True)
@@ -991,25 +1531,70 @@ class Appetite(object):
                 [ConnManager.COMMAND_RESTART_NAME], [self.template_values,
                                                      host.to_dict])[0])
 
-        self.run_commands(commands, host)
+        updated &= self.run_commands(commands, host)
 
         # Get latest manifest since host has been updated
         self.update_manifest(host)
+        updated &= bool(host.can_connect) and not host.metas_read_failed
 
         # Clean up old manifest files
         ConnManager.rotate_logs(host, self.meta_remote_logs_folder,
                                 Consts.DEFAULT_LOG_RETENTION, True)
 
+        return updated
+
+    def invalidate_remote_apps(self, host, app_paths):
+        """Remove apps that could not be updated from the remote metas
+
+        The extracted metas have the apps at the new version, without them
+        the apps are seen as added and sent whole next run.
+        """
+        host_meta_path = os.path.join(self.hosts_folder, host.hostname, Consts.META_DIR)
+
+        for profile in self.profiles:
+            meta_file = self.create_meta_filename(host_meta_path, profile.meta_name, '', 'json')
+            if not os.path.isfile(meta_file):
+                continue
+
+            with open(meta_file) as f:
+                metas_master = json.load(f)
+
+            content = [meta_data for meta_data in metas_master['content']
+                       if AppetiteHost.create_app_from_object(None, None, meta_data).path(
+                           self.args.app_folder) not in app_paths]
+
+            if len(content) == len(metas_master['content']):
+                continue
+
+            metas_master['content'] = content
+
+            invalid_meta_path = os.path.join(self.tmp_folder, Consts.INVALID_META_DIR, host.hostname)
+            Helpers.create_path(invalid_meta_path, True)
+            invalid_meta = self.create_meta_files(invalid_meta_path, profile.meta_name, '', metas_master)
+
+            if not ConnManager.copy_to_host(host, profile.meta_remote_file, invalid_meta, True):
+                Logger.error("Problem removing apps from the host meta", hostname=host.hostname,
+                             meta=profile.meta_remote_file, app_paths=app_paths)
+
     def run_commands(self, commands, host, run_commands=False, pre_install=False):
-        """Run listed commands"""
+        """Run listed commands
+
+        :return: False if a command failed
+        """
+        success = True
 
         for command in commands:
             command_object = command['command']
             if run_commands or command_object.pre_install == pre_install:
-                if self.ssh_app_commands.run_command(command, host) and not self.args.dryrun \
-                        and command_object.delay > 0:
+                command_ran = self.ssh_app_commands.run_command(command, host)
+                if command_ran is False:
+                    success = False
+
+                if command_ran is not None and not self.args.dryrun and command_object.delay > 0:
                     time.sleep(command_object.delay)
 
+        return success
+
 
 def call_func(args):
     """Call a class function with a single param"""
@@ -1021,11 +1606,17 @@ def main():
 
     if not appetite.is_running:
         try:
-            appetite.process_hosts()
+            if appetite.args.find_app:
+                appetite.find_app()
+            elif appetite.args.daemon:
+                appetite.run_daemon()
+            else:
+                appetite.process_hosts()
         except Exception as e:
             Logger.exception("Catch all", e, err_message=e.message, trace=str(traceback.format_exc()))
             sys.exit(1)
         finally:
+            appetite.repo_manager.object_reader.close()
             appetite.run_check.unlock()
 
 if __name__ == "__main__":
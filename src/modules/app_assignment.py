@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#pylint: disable=relative-import,invalid-name
+"""AppAssignment
+
+Assigns manifest rows to hosts.
+
+Hosts are indexed by hostname so a row only checks the hosts its white list
+can match.  Rows naming the class or site, i.e. 'splunk-(cm|ds).*', only
+check the hosts of those classes.  Bootstrapped hosts are grouped by the
+deployment method they take apps from so each manifest row only checks the
+hosts that can use it.
+"""
+
+import os
+from bisect import bisect_left
+from collections import OrderedDict
+
+import logger
+
+
+class AppAssignment(object):
+    """Class to build the host x manifest row assignment table"""
+
+    def __init__(self, appetite_hosts, bootstrap_plans):
+        """Init of the assignment engine
+        :param appetite_hosts: Hosts to assign apps to
+        :param bootstrap_plans: Bootstrap plan per hostname (BootstrapPlanner)
+        """
+        self.hosts = list(appetite_hosts)
+        self.host_indexes = {host.hostname: index for index, host in enumerate(self.hosts)}
+        self.hostnames = sorted(self.host_indexes)
+
+        # Every hostname starts with the name formatting prefix, a row regex
+        # starting with it can only match at the start of the hostname,
+        # unless the prefix is found again within the hostname
+        self.common_prefix = os.path.commonprefix(self.hostnames)
+        self.irregular_hostnames = [hostname for hostname in self.hostnames
+                                    if not self.common_prefix or hostname.find(self.common_prefix, 1) > -1]
+
+        # Bootstrapped hosts grouped by the deployment method they replace
+        # update_method -> [(host, plan)]
+        self.bootstrap_hosts = OrderedDict()
+        for host in self.hosts:
+            plan = bootstrap_plans.get(host.hostname)
+            if plan and plan['stanza']:
+                self.bootstrap_hosts.setdefault(plan['stanza']['update_method'], []).append((host, plan))
+
+    def get_candidates(self, row_values):
+        """Hosts the white list of a row can match, in host order"""
+        white_prefixes = row_values.host_matcher.get_white_prefixes()
+
+        if white_prefixes is None:
+            return self.hosts
+
+        hostnames = set(self.irregular_hostnames)
+        for prefixes, is_anchored in white_prefixes:
+            for prefix in prefixes:
+                # Matches could be anywhere within the hostname
+                if not is_anchored and not prefix.startswith(self.common_prefix):
+                    return self.hosts
+
+                index = bisect_left(self.hostnames, prefix)
+                while index < len(self.hostnames) and self.hostnames[index].startswith(prefix):
+                    hostnames.add(self.hostnames[index])
+                    index += 1
+
+        return [self.hosts[index] for index in sorted(self.host_indexes[hostname] for hostname in hostnames)]
+
+    def assign_row(self, row_values):
+        """Assign a single manifest row
+
+        :return: [(host, deployment, ref_hostname, is_firstrun)]
+        """
+        assignments = [(host, None, host.hostname, False) for host in self.get_candidates(row_values)
+                       if row_values.host_matcher.check(host.hostname)]
+
+        # For the special case when instance is new,
+        # start up apps have to be included
+        for host, plan in self.bootstrap_hosts.get(row_values.deployment, []):
+            if not host.bootstrap:
+                host.bootstrap = True
+                logger.info("Bootstrapping host", host=host.hostname)
+
+            # Reference host is the same for the whole class, the matcher
+            # caches the result.  Hosts without a reference host check
+            # against their own hostname.
+            ref_hostname = plan['ref_hostname'] or host.hostname
+
+            if row_values.host_matcher.check(ref_hostname):
+                assignments.append((host, plan['stanza']['ref_method'], ref_hostname, True))
+
+        return assignments
+
+    def assign(self, rows):
+        """Build the assignment table for all manifest rows
+
+        :return: [(row_values, [(host, deployment, ref_hostname, is_firstrun)])]
+        """
+        return [(row_values, self.assign_row(row_values)) for row_values in rows]
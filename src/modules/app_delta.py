@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#pylint: disable=relative-import,invalid-name
+"""AppDelta
+
+File level deltas of changed apps.
+
+The host meta keeps a hash of every file installed for each app.  A changed
+app is sent as the files that differ from the remote hashes and a list of
+the files to delete.  Files moved out by the install ignore of the
+deployment method are never deleted since the remote keeps its own copy.
+
+On the remote the delta is staged next to the app and swapped in as a
+whole (ConnManager.apply_delta).
+"""
+
+import os
+import re
+import hashlib
+
+import consts
+
+
+def get_files_key(app):
+    """Key of an app in the files meta"""
+    return "%s:%s" % (app.app, app.method_name)
+
+
+def get_app_path(app):
+    """Install path of an app relative to the app folder"""
+    return os.path.join(app.method_info['path'], app.app_clean)
+
+
+def hash_files(path):
+    """Hash of every file in a directory
+
+    :return: {relative path: sha1}
+    """
+    file_hashes = {}
+    path_len = len(path) + 1
+
+    for root, _dirs, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+
+            file_hash = hashlib.sha1()  # nosec
+            if os.path.islink(file_path):
+                file_hash.update("link:%s" % os.readlink(file_path))
+            else:
+                with open(file_path, 'rb') as f:
+                    for chunk in iter(lambda f=f: f.read(1024 * 1024), b''):
+                        file_hash.update(chunk)
+
+            file_hashes[file_path[path_len:]] = file_hash.hexdigest()
+
+    return file_hashes
+
+
+def is_ignored(path, regex_lines):
+    """Check if a file would be moved out by install ignore lines
+
+    Lines are the same as Helpers.move_regexed_files, a folder followed by
+    an optional regex of the names in it.
+    """
+    for line in regex_lines:
+        folder, name_regex = os.path.split(line)
+        folder = folder.rstrip('/')
+
+        if folder and not path.startswith(folder + '/'):
+            continue
+
+        # Whole folders are ignored if there is no regex
+        name = path[len(folder) + 1:] if folder else path
+        if not name_regex or re.search(name_regex, name.split('/')[0]):
+            return True
+
+    return False
+
+
+def is_safe_path(path):
+    """Only relative paths within the app can be deleted"""
+    return not os.path.isabs(path) and '..' not in path.split('/')
+
+
+def get_delta(base_hashes, new_hashes, regex_lines):
+    """Files changed between two versions of an app
+
+    :param regex_lines: Install ignore lines of the deployment method
+    :return: (files to send, files to delete)
+    """
+    changed_files = sorted(path for path, file_hash in new_hashes.items()
+                           if base_hashes.get(path) != file_hash)
+
+    deleted_files = sorted(path for path in base_hashes
+                           if path not in new_hashes and is_safe_path(path) and
+                           not is_ignored(path, regex_lines))
+
+    return changed_files, deleted_files
+
+
+def create_delta(app_path, delta_path, base_hashes, new_hashes, regex_lines):
+    """Create the delta of an app to be packaged
+
+    Changed files are linked into the delta folder and the files to delete
+    are listed, null separated, in the delete file next to it.
+
+    :param app_path: Built app
+    :param delta_path: Path of the app in the delta
+    :return: (files sent, files deleted)
+    """
+    changed_files, deleted_files = get_delta(base_hashes, new_hashes, regex_lines)
+
+    delta_folder = "%s%s" % (delta_path, consts.DELTA_DIR_POSTFIX)
+    os.makedirs(delta_folder)
+
+    for changed_file in changed_files:
+        dest_path = os.path.join(delta_folder, changed_file)
+        dest_folder = os.path.dirname(dest_path)
+        if not os.path.isdir(dest_folder):
+            os.makedirs(dest_folder)
+        os.link(os.path.join(app_path, changed_file), dest_path)
+
+    with open("%s%s" % (delta_path, consts.DELTA_DELETE_POSTFIX), 'wb') as f:
+        f.write(''.join("%s\0" % deleted_file for deleted_file in deleted_files))
+
+    return changed_files, deleted_files
+
+
+def get_files_meta(apps_meta, remote_files_meta):
+    """Files meta of the apps installed on a host
+
+    Built apps have new hashes, other installed apps keep the remote ones.
+    """
+    files_meta = {}
+
+    for app in apps_meta:
+        if not app.currently_installed:
+            continue
+
+        files_key = get_files_key(app)
+
+        if app.file_hashes is not None:
+            files_meta[files_key] = {'path': get_app_path(app),
+                                     'commit_id': app.commit_id,
+                                     'files': app.file_hashes}
+        elif not app.updated and files_key in remote_files_meta:
+            files_meta[files_key] = remote_files_meta[files_key]
+
+    return files_meta
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#pylint: disable=relative-import,invalid-name
+"""AppDiff
+
+Compares the apps from the manifest against the remote meta of a host.
+
+Remote metas are indexed by (app, method name) and added apps by
+(app, path) so the diff is linear in the number of apps.
+"""
+
+from collections import OrderedDict, Counter, deque
+
+import consts
+import helpers
+import logger
+
+
+def index_apps(apps, key_funct):
+    """Index apps in order by key
+
+    :return: OrderedDict key -> deque of apps
+    """
+    index = OrderedDict()
+    for app in apps:
+        index.setdefault(key_funct(app), deque()).append(app)
+    return index
+
+
+def name_key(app):
+    """Key used to find the remote version of an app"""
+    return app.app, app.method_name
+
+
+def path_key(app):
+    """Key used to find an app installed to the same path"""
+    return app.app, app.method_info['path']
+
+
+def count_apps(apps):
+    """Unique apps and the apps found more than once
+
+    Apps are hashed once, equal apps keep the first one found.
+
+    :return: (unique apps ordered by app, commit id and method name,
+              [(app, occurrences)] for duplicated apps)
+    """
+    app_counts = Counter(apps)
+
+    unique_apps = sorted(app_counts, key=lambda app: app.unique_key)
+
+    return unique_apps, [(app, app_counts[app]) for app in unique_apps if app_counts[app] > 1]
+
+
+def diff_apps(apps, remote_metas, repo_source, hostname):
+    """Diff the apps for a host against its remote meta
+
+    Sets the status (added, changed, unchanged or deleted) of each app.
+    Remote apps are matched in order, an app that changed method but kept
+    its path is seen as changed instead of deleted and added.
+
+    :param apps: Ordered unique apps from the manifest
+    :param remote_metas: Apps from the remote meta or None if not loaded
+    :param repo_source: Ref name of the apps
+    :param hostname: Host used for logging
+    :return: apps meta, apps from the manifest followed by deleted apps
+    """
+    apps_meta = []
+
+    remote_index = index_apps(remote_metas, name_key) if remote_metas else {}
+    matched_remote = set()
+
+    for app in apps:
+        app.refresh_version_info(repo_source, consts.META_APP_UNCHANGED)
+
+        # Searches remote meta to see if application already exists
+        remote_versions = remote_index.get(name_key(app))
+        remote_meta = remote_versions.popleft() if remote_versions else None
+
+        if remote_meta:
+            check_commit_id = remote_meta.commit_id.startswith(app.commit_id) or\
+                              app.commit_id.startswith(remote_meta.commit_id)
+
+            if check_commit_id:
+                # meta has not changed so use existing meta
+                meta_to_append = app.clone
+                meta_to_append.update_app_version(app)
+            else:
+                # If app does exist on system, have the commit ids changed
+                meta_to_append = app.set_status_changed()
+
+            # to track if an app is removed from the remote meta
+            matched_remote.add(id(remote_meta))
+        else:
+            # There is no remote meta so all files should be added
+            meta_to_append = app.set_status_added()
+
+        if remote_meta and meta_to_append.has_changed:
+            meta_outcome = helpers.debug_app_versions(meta_to_append,
+                                                      remote_meta,
+                                                      meta_to_append.status)
+            logger.info("App change", logic=meta_outcome)
+
+        apps_meta.append(meta_to_append)
+
+    if not remote_metas:
+        return apps_meta
+
+    # Any apps left in the remote meta do not exist in the current
+    # manifest and should be deleted
+    added_index = index_apps((app for app in apps_meta if app.status == consts.META_APP_ADDED), path_key)
+
+    delete_list = []
+    for deleted_app in remote_metas:
+        if id(deleted_app) in matched_remote:
+            continue
+
+        if deleted_app.method_info:
+            deleted_app.set_status_deleted()
+
+            # Added logic check to catch method changes
+            added_apps = added_index.get(path_key(deleted_app))
+            if added_apps:
+                added_apps.popleft().set_status_changed()
+            else:
+                delete_list.append(deleted_app)
+        else:
+            logger.error("Problems with method info for deleted app.",
+                         hostname=hostname, app=deleted_app.name)
+
+    return apps_meta + delete_list
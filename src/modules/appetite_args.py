@@ -77,7 +77,8 @@ def check_default(dest, value):
 def args_check(args):
     """Function to check if arg params are valid"""
 
-    if not args.hosts:
+    # Finding apps only reads the local state
+    if not args.hosts and not args.find_app:
         print "--hosts needs to be defined"
         sys.exit(1)
 
@@ -96,6 +97,40 @@ def args_check(args):
             print "--repo-url needed"
             sys.exit(1)
 
+def get_profiles(args):
+    """Get the profiles (refname, manifest and apps folder) to deploy
+
+    Profiles are defined as 'refname:apps_manifest:apps_folder'.  If no
+    profiles are given, a single profile is created from --ref-name,
+    --apps-manifest and --apps-folder.
+    """
+
+    if not args.profiles:
+        return [{"refname": args.refname,
+                 "apps_manifest": args.apps_manifest,
+                 "apps_folder": args.apps_folder}]
+
+    # Incase one long string is entered
+    profile_strs = args.profiles.split(" ") if isinstance(args.profiles, basestring) else args.profiles
+
+    profiles = []
+    for profile_str in profile_strs:
+        profile_split = profile_str.strip("'\"").split(':')
+        if len(profile_split) != 3 or not all(profile_split):
+            print "--profiles needs to be formatted as refname:apps_manifest:apps_folder: %s" % profile_str
+            sys.exit(1)
+
+        profiles.append({"refname": profile_split[0],
+                         "apps_manifest": profile_split[1],
+                         "apps_folder": profile_split[2]})
+
+    refnames = [profile["refname"] for profile in profiles]
+    if len(set(refnames)) != len(refnames):
+        print "--profiles refnames need to be unique: %s" % " ".join(refnames)
+        sys.exit(1)
+
+    return profiles
+
 # Load in config file that can over write cmd args
 add_arg('--config-file', metavar='cf',
         default=None, dest='config_file',
@@ -126,6 +161,16 @@ add_arg('--scratch-dir', metavar='dir', type=str,
         default="appetite_tmp", dest="scratch_dir",
         help='Location where repo and tmp folder is created')
 
+add_arg('--payload-cache-size', metavar='mb', type=int,
+        default=consts.DEFAULT_PAYLOAD_CACHE_SIZE, dest="payload_cache_size",
+        help='Size cap in MB of the packaged apps kept in the scratch dir '
+             'between runs, 0 turns off the cache')
+
+add_arg('--payload-codec', metavar='codec', type=str,
+        default=consts.DEFAULT_PAYLOAD_CODEC, dest="payload_codec",
+        help='Compression of host payloads: gzip, zstd, lz4 or none, '
+             'with an optional level i.e., zstd:3')
+
 add_arg('--apps-folder', metavar='f', type=str,
         default="base_apps", dest="apps_folder",
         help='location of applications for deployment '
@@ -149,6 +194,13 @@ add_arg('--ref-name', metavar='p', dest="refname", type=str,
         help='Repo location and reference name'
              'used to tag apps.')
 
+add_arg('--profiles', metavar='refname:manifest:folder', nargs='*', type=str,
+        default=[], dest="profiles",
+        help='Deploy multiple manifests in a single run. '
+             'Each profile is refname:apps_manifest:apps_folder. '
+             'The repo, host connections and payload are shared '
+             'and each host is restarted at most once.')
+
 add_arg('--template-files', metavar='f', nargs='*', type=str,
         default=None, dest="template_files",
         help='templating key value files'
@@ -204,6 +256,18 @@ add_arg('--num-conns', metavar='t', type=int,
         default=consts.DEFAULT_THREAD_POOL_SIZE,
         help='Number of concurrent connections used')
 
+add_arg('--prefetch-conns', metavar='t', type=int,
+        dest="prefetch_connections",
+        default=consts.DEFAULT_PREFETCH_POOL_SIZE,
+        help='Number of concurrent connections used to check hosts '
+             'and fetch their metas')
+
+add_arg('--num-builds', metavar='b', type=int,
+        dest="num_builds",
+        default=consts.DEFAULT_BUILD_POOL_SIZE,
+        help='Number of processes used to build apps, '
+             '0 uses the number of cpus')
+
 add_arg('--new-host-brakes', action='store_true',
         default=False, dest="new_host_brakes",
         help='If a new host if found, override thread count to 1.')
@@ -243,11 +307,21 @@ add_arg('--clean-repo', action='store_true',
         default=False, dest="clean_repo",
         help='Remove repo which will force a repo pull')
 
+add_arg('--partial-clone', action='store_true',
+        default=False, dest="partial_clone",
+        help='Clone the repo without blobs and only check out configs '
+             'and the apps folders')
+
 add_arg('--clean-metas', action='store_true',
         default=False, dest="clean_metas",
         help='Remove metas forcing a re-download when'
              'initializing')
 
+add_arg('--incremental', action='store_true',
+        default=False, dest="incremental",
+        help='Only check and package hosts affected by manifest '
+             'changes since the last completed run.')
+
 add_arg('--build-test-apps', action='store_true',
         default=False, dest="build_test_apps",
         help='Build test app directories')
@@ -286,4 +360,24 @@ add_arg('--template-regex', metavar='t', type=str,
 add_arg('--skip-payload', action='store_true',
         default=False, dest="skip_payload",
         help='Skip creating payloads speeding up run-time. '
-             'Used for testing and dryrun.')
\ No newline at end of file
+             'Used for testing and dryrun.')
+
+add_arg('--full-payloads', action='store_true',
+        default=False, dest="full_payloads",
+        help='Send changed apps whole instead of only the files '
+             'that changed.')
+
+add_arg('--find-app', metavar='app[:commit_id]',
+        default='', dest="find_app",
+        help='Print the hosts with an app installed, optionally at a '
+             'commit id, from the local state of the last run.')
+
+add_arg('--daemon', action='store_true',
+        default=False, dest="daemon",
+        help='Keep running and check the repo for changes '
+             'each poll interval')
+
+add_arg('--poll-interval', metavar='s', type=int,
+        dest="poll_interval",
+        default=consts.DEFAULT_POLL_INTERVAL,
+        help='Seconds between repo checks in daemon mode')
\ No newline at end of file
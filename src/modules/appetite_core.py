@@ -10,51 +10,107 @@ import sys
 import os
 import traceback
 import json
+import bisect
+from collections import OrderedDict
+
 import logger
 import consts
 import helpers
 import deployment_methods
+import payload_codec
 
 
 class AppetiteHosts(object):
-    """Class to store a working list of hosts"""
-    hosts = []
-    meta_info = {"host_groups": {"app_class": {}, "all": [], "ref": {}}}
+    """Class to store a working list of hosts
+
+       Hosts are indexed by hostname, app class, site and host index so
+       lookups and groups do not need to scan the host list.
+    """
+
+    INDEX_KEYS = ["app_class", "site", "host_index"]
+
+    def __init__(self):
+        """Init of the host registry"""
+        self.hosts = []
+        self.hostnames = {}
+        self.indexes = {index_key: OrderedDict() for index_key in self.INDEX_KEYS}
+
+        # Host groups used for templating, kept sorted as hosts are added
+        self.meta_info = {"host_groups": {"app_class": {}, "all": [], "ref": {}}}
 
     def add_host(self, _source, _hostname, host_data, _ssh_hostname=None, _tarname=None):
         """Add host to list"""
-        host_classes = self.meta_info["host_groups"]["app_class"]
-        host_all = self.meta_info["host_groups"]["all"]
-        host_ref = self.meta_info["host_groups"]["ref"]
-        if next((False for host in self.hosts if host.hostname == _hostname), True):
-            app_host = AppetiteHost(_source, _hostname, host_data, _ssh_hostname, _tarname)
-            self.hosts.append(app_host)
-
-            # Create vars used for templating cmd
-            if app_host.app_class not in host_classes:
-                host_classes[app_host.app_class] = []
-            host_classes[app_host.app_class].append(app_host.hostname)
-            host_all.append(app_host.hostname)
-            host_ref[app_host.hostname] = app_host.ssh_hostname
+        if _hostname in self.hostnames:
+            return self.hostnames[_hostname]
+
+        app_host = AppetiteHost(_source, _hostname, host_data, _ssh_hostname, _tarname)
+        self.hosts.append(app_host)
+        self.hostnames[_hostname] = app_host
+
+        for index_key, index in self.indexes.items():
+            index.setdefault(getattr(app_host, index_key), []).append(app_host)
+
+        # Create vars used for templating cmd
+        host_groups = self.meta_info["host_groups"]
+        bisect.insort(host_groups["app_class"].setdefault(app_host.app_class, []), app_host.hostname)
+        bisect.insort(host_groups["all"], app_host.hostname)
+        host_groups["ref"][app_host.hostname] = app_host.ssh_hostname
+
+        return app_host
+
+    def get_host(self, hostname):
+        """Get host by hostname"""
+        return self.hostnames.get(hostname)
+
+    def get_hosts(self, index_key, value):
+        """Get hosts with the value for the index key (app_class, site or host_index)"""
+        return self.indexes[index_key].get(value, [])
+
+    def get_values(self, index_key):
+        """Get the sorted values for an index key, i.e. the sites"""
+        return sorted(self.indexes[index_key])
 
     def is_empty(self):
         """Host empty check"""
         return len(self.hosts) < 1
 
+    def __len__(self):
+        return len(self.hosts)
+
+    def __contains__(self, hostname):
+        return hostname in self.hostnames
+
     def __iter__(self):
         for host in self.hosts:
             yield host
 
     def build_meta(self, template_values):
-        host_classes = self.meta_info["host_groups"]["app_class"]
-        host_all = self.meta_info["host_groups"]["all"]
+        """Merge the host groups into the templating values"""
+        return helpers.merge_templates([template_values, self.meta_info])
 
-        for appclass in host_classes:
-            sorted(appclass)
 
-        sorted(host_all)
+class AppetiteProfile(object):
+    """Class to store a deployment profile
 
-        return helpers.merge_templates([template_values, self.meta_info])
+       A profile is a manifest, the apps folder it references and the ref name
+       used to tag the apps.  Multiple profiles can be deployed in a single
+       run, sharing the repo checkout and the host connections.
+    """
+
+    def __init__(self, _source, refname, apps_manifest, apps_folder):
+        """Init of a profile object"""
+        self.refname = refname
+        self.apps_manifest = apps_manifest
+        self.apps_folder = os.path.join(_source.repo_path, apps_folder)
+        self.manifest_path = os.path.join(_source.repo_path, consts.CONFIG_PATH_NAME, apps_manifest)
+        self.manifest_cache_file = os.path.join(_source.cache_folder, "%s.json" % apps_manifest)
+        self.meta_name = "%s%s" % (consts.APPS_METADATE_FILENAME, refname)
+        self.meta_remote_file = "%s.json" % os.path.join(_source.meta_remote_folder, self.meta_name)
+        self.files_meta_name = "%s%s" % (self.meta_name, consts.FILES_META_POSTFIX)
+        self.files_meta_remote_file = "%s.json" % os.path.join(_source.meta_remote_folder, self.files_meta_name)
+
+        # Parsed manifest, loaded once per run
+        self.manifest = None
 
 
 class AppetiteHost(object):
@@ -64,6 +120,13 @@ class AppetiteHost(object):
        source types.
     """
 
+    FIELDS = ['hostname', 'app_class', 'site', 'host_index', 'tarname', 'ssh_hostname',
+              'local_meta_folder', 'tar_file', 'manifest_found', 'restart', 'can_connect',
+              'bootstrap', 'updates', 'payload_codec', 'delta_apps', 'remote_binaries',
+              'metas_read_failed']
+
+    __slots__ = FIELDS + ['_app_sources']
+
     def __init__(self, _source, _hostname, host_data, _ssh_hostname, _tarname):
         """Init of a host object"""
         self.hostname = _hostname
@@ -72,18 +135,27 @@ class AppetiteHost(object):
         self.host_index = host_data[consts.NAME_FORMATTING[2]['name']]
         self.tarname = _tarname if _tarname else _hostname
         self.ssh_hostname = _ssh_hostname if _ssh_hostname else _hostname
-        self.local_meta_file = os.path.join(_source.meta_folder,
-                                            _hostname,
-                                            consts.META_DIR,
-                                            "%s.json" % _source.meta_name)
-        self.tar_file = os.path.join(_source.tars_folder, "%s.tar.gz" % self.tarname)
+        self.local_meta_folder = os.path.join(_source.meta_folder,
+                                              _hostname,
+                                              consts.META_DIR)
+        self.payload_codec = payload_codec.PayloadCodec(payload_codec.FALLBACK_CODEC)
+        self.tar_file = os.path.join(_source.tars_folder, "%s%s" % (self.tarname, self.payload_codec.extension))
         self.manifest_found = False
         self.restart = False
         self.can_connect = None
         self.bootstrap = False
 
+        # Remote metas found but not read, local copies are kept
+        self.metas_read_failed = False
+
+        # Binaries found on the host, None if not checked
+        self.remote_binaries = None
+
         self.updates = None
 
+        # Install paths of the apps sent as deltas
+        self.delta_apps = []
+
         self._app_sources = {}
 
     @staticmethod
@@ -102,13 +174,32 @@ class AppetiteHost(object):
 
     @property
     def to_dict(self):
-        """Convert application to to dict"""
-        return helpers.create_dict(self.__dict__)
+        """Convert host to dict"""
+        return {key: getattr(self, key) for key in self.FIELDS}
+
+    def __getstate__(self):
+        state = self.to_dict
+        state['_app_sources'] = self._app_sources
+        return state
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+
+    def set_payload_codec(self, codec):
+        """Set the codec of the host payload"""
+        self.tar_file = os.path.join(os.path.dirname(self.tar_file), "%s%s" % (self.tarname, codec.extension))
+        self.payload_codec = codec
+
+    def get_local_meta_file(self, meta_name):
+        """Local copy of the remote meta file for a profile"""
+        return os.path.join(self.local_meta_folder, "%s.json" % meta_name)
 
     @property
     def get_threaded_values(self):
         """Get values that would change during multithreading"""
-        return {'hostname': self.hostname, 'can_connect': self.can_connect, 'manifest_found': self.manifest_found}
+        return {'hostname': self.hostname, 'can_connect': self.can_connect, 'manifest_found': self.manifest_found,
+                'remote_binaries': self.remote_binaries, 'metas_read_failed': self.metas_read_failed}
 
     def from_dict(self, dict_in):
         """Load values in from dictionary"""
@@ -116,7 +207,7 @@ class AppetiteHost(object):
             return False
 
         for key, value in dict_in.items():
-            self.__dict__[key] = value
+            setattr(self, key, value)
 
         return True
 
@@ -137,42 +228,60 @@ class AppetiteHost(object):
 class AppetiteApp(object):
     """Class to store a application object
 
-       Stores values attributed to a application
+       Stores values attributed to a application.  Only the fields that were
+       set are serialized, matching the meta files already on hosts.
     """
 
+    FIELDS = ['app', 'app_clean', 'source_hostname', 'method_info', 'ref_commit_id',
+              'is_firstrun', 'track', 'status', 'updated', 'app_creation_datetime',
+              'content_type', 'commit_log', 'repo_source', 'default_commit_id']
+
+    __slots__ = FIELDS + ['_extra', '_unique_key', '_file_hashes']
+
     def __init__(self, _repo_mng, _deployment_mng, *args):
-        """Init of a application object"""
-        self.__repo_mng = _repo_mng
-        self.__deployment_mng = _deployment_mng
+        """Init of a application object
 
+        The managers are only used to create the app and are not kept.
+        """
         num_args = len(args)
 
         self.commit_log = None
         self.content_type = helpers.get_update_str(False)
         self.repo_source = None
 
+        # Values from meta files that are not app fields
+        self._extra = None
+
+        # Cached (app, commit_id, method_name), reset when they can change
+        self._unique_key = None
+
+        # Hashes of the built files, kept in the files meta and not the app meta
+        self._file_hashes = None
+
         if num_args > 0:
             if num_args == 1:
                 self.from_object(args[0])
             else:
-                self.from_params(*args)
+                self.from_params(_repo_mng, _deployment_mng, *args)
 
-    def from_params(self, _app, _app_clean, _method, _commit_id, _hostname, _is_firstrun=False):
+    def from_params(self, _repo_mng, _deployment_mng, _app, _app_clean, _method, _commit_id, _hostname,
+                    _is_firstrun=False):
         """populate application from params"""
 
-        self._deployment_method = self.__deployment_mng.get_deployment_method(_method)
+        deployment_method = _deployment_mng.get_deployment_method(_method)
 
-        if not self._deployment_method:
+        if not deployment_method:
             logger.errorout("Deployment method for app invalid", app=_app,
                             method=_method)
 
+        self._unique_key = None
         self.app = _app
         self.app_clean = _app_clean
         self.source_hostname = _hostname
-        self.method_info = self._deployment_method.data.copy()
+        self.method_info = deployment_method.create_method_info()
         self.ref_commit_id = None if _commit_id == 'N/A' or len(_commit_id) == 0 else _commit_id
         self.is_firstrun = _is_firstrun
-        self.track = self.__repo_mng.track
+        self.track = _repo_mng.track
         self.status = consts.META_APP_UNCHANGED
         self.updated = False
         self.app_creation_datetime = helpers.get_utc()
@@ -193,8 +302,14 @@ class AppetiteApp(object):
                                  trace=json.dumps(traceback.format_exc()))
                 sys.exit(1)
 
+        self._unique_key = None
         for key, value in loaded_obj.items():
-            self.__dict__[key] = value
+            if key in self.FIELDS:
+                setattr(self, key, value)
+            else:
+                if self._extra is None:
+                    self._extra = {}
+                self._extra[key] = value
 
         if self.commit_log:
             for key, value in consts.RENAME_COMMIT_LOG_KEYS.items():
@@ -210,7 +325,26 @@ class AppetiteApp(object):
     @property
     def to_dict(self):
         """Convert application into dict"""
-        return helpers.create_dict(self.__dict__)
+        app_dict = {key: getattr(self, key) for key in self.FIELDS if hasattr(self, key)}
+
+        if self._extra:
+            app_dict.update(self._extra)
+
+        if isinstance(app_dict.get('method_info'), deployment_methods.MethodInfo):
+            app_dict['method_info'] = self.method_info.to_dict
+
+        return app_dict
+
+    def __getstate__(self):
+        state = {key: getattr(self, key) for key in self.FIELDS if hasattr(self, key)}
+        state['_extra'] = self._extra
+        return state
+
+    def __setstate__(self, state):
+        self._unique_key = None
+        self._file_hashes = None
+        for key, value in state.items():
+            setattr(self, key, value)
 
     @property
     def to_json(self):
@@ -221,10 +355,7 @@ class AppetiteApp(object):
     @property
     def clone(self):
         """Clone current application object"""
-        cloned = AppetiteApp(self.__repo_mng, self.__deployment_mng)
-        cloned.from_object(self.to_json)
-
-        return cloned
+        return AppetiteApp(None, None, self.to_json)
 
     @property
     def commit_id(self):
@@ -369,33 +500,58 @@ class AppetiteApp(object):
 
         return self
 
-    def update_commit_log(self, commit_id=None):
+    def update_commit_log(self, repo_mng, commit_id=None):
         """Refresh the commit log with the provided or latest commit id"""
 
-        self.commit_log = self.__repo_mng.get_commit_log(commit_id)
+        self.set_commit_log(repo_mng.get_commit_log(commit_id))
+
+    def set_commit_log(self, commit_log):
+        """Set the commit log, the commit id follows it"""
+        self.commit_log = commit_log
+        self._unique_key = None
+
+    @property
+    def build_info(self):
+        """Info set while building the app"""
+        build_info = {'commit_log': self.commit_log}
+
+        if 'inclusions' in self.method_info:
+            build_info['inclusions'] = self.method_info['inclusions']
+
+        return build_info
+
+    def copy_build_info(self, build_info):
+        """Copy the info set while building an identical app"""
+        self.set_commit_log(build_info['commit_log'])
+        self._file_hashes = build_info.get('file_hashes')
+
+        if 'inclusions' in build_info:
+            self.method_info['inclusions'] = build_info['inclusions']
+
+    @property
+    def file_hashes(self):
+        """Hashes of the built files, None if the app was not built"""
+        return self._file_hashes
 
     def __eq__(self, other):
         """Operator =="""
-        if not self.check_names(other):
-            return False
-
-        if other.commit_id != self.commit_id:
-            return False
+        return self.unique_key == other.unique_key
 
-        return True
+    @property
+    def unique_key(self):
+        """Tuple (app, commit_id, method_name) defining uniqueness of app"""
+        if self._unique_key is None:
+            self._unique_key = (self.app, self.commit_id, self.method_name)
+        return self._unique_key
 
     @property
     def app_key(self):
         """App key to define uniqueness of app"""
-        return {
-            "app": self.app,
-            "commit_id": self.commit_id,
-            "method_name": self.method_name
-        }
+        return dict(zip(("app", "commit_id", "method_name"), self.unique_key))
 
     def __hash__(self):
         """Create unique hash based on app key"""
-        return hash(tuple([self.app_key[key] for key in self.app_key]))
+        return hash(self.unique_key)
 
     def check_names(self, other):
         """Check to see if app name and method match"""
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+#pylint: disable=relative-import,invalid-name
+"""BootstrapPlanner
+
+Plans which hosts are bootstrapped (firstrun) and how.
+
+The StartupBootstrap_ stanza and the reference host are resolved once per
+app class.  Each new host gets a plan that manifest row assignment reads.
+"""
+
+from collections import OrderedDict
+
+import helpers
+
+
+class BootstrapPlanner(object):
+    """Class to create the bootstrap plan for hosts"""
+
+    def __init__(self, startup_bootstrap, name_formatting):
+        """Init of the bootstrap planner
+        :param startup_bootstrap: StartupBootstrap_ stanzas from the deployment methods
+        :param name_formatting: Host name formatting
+        """
+        self.name_formatting = name_formatting
+
+        # ref_class -> stanza, the first stanza found for a class is used
+        self.stanzas = OrderedDict()
+        for su_bootstrap in startup_bootstrap:
+            self.stanzas.setdefault(su_bootstrap['ref_class'], su_bootstrap)
+
+    def get_stanza(self, host):
+        """Get the startup bootstrap stanza for a host"""
+        if not helpers.check_name_formatting(self.name_formatting, host.hostname):
+            return None
+
+        return self.stanzas.get(host.app_class)
+
+    def plan(self, appetite_hosts, hosts=None):
+        """Create the plan for hosts without a manifest (new app instance)
+
+        :param hosts: Hosts checked within the run, all hosts if None
+        :return: {hostname: {'stanza': stanza or None, 'ref_hostname': hostname of
+                  the class the apps are taken from}}
+        """
+        plans = OrderedDict()
+        ref_hostnames = {}
+
+        for host in appetite_hosts if hosts is None else hosts:
+            if host.manifest_found:
+                continue
+
+            stanza = self.get_stanza(host)
+            ref_hostname = None
+
+            if stanza:
+                # Reference host is the first host found for the class
+                if stanza['app_class'] not in ref_hostnames:
+                    ref_hosts = appetite_hosts.get_hosts('app_class', stanza['app_class'])
+                    ref_hostnames[stanza['app_class']] = ref_hosts[0].hostname if ref_hosts else ""
+                ref_hostname = ref_hostnames[stanza['app_class']]
+
+            plans[host.hostname] = {'stanza': stanza, 'ref_hostname': ref_hostname}
+
+        return plans
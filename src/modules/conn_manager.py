@@ -7,11 +7,14 @@ functions or restricted configuration files.
 """
 
 import os
+import socket
 import json
 import time
 import re
 import datetime
 import uuid
+import pipes
+import base64
 import paramiko
 from scp import SCPClient
 
@@ -27,10 +30,15 @@ CREDS = helpers.create_obj(
         "APP_DIR": "",
         "APP_BIN": "",
         "DRY_RUN": False,
-        "PK": ""
+        "PK": "",
+        "KEEP_CONNECTIONS": False
     }
 )
 
+# ssh hostname -> (pid, client) of the connections kept open for reuse
+SSH_CLIENTS = {}
+SSH_KEEPALIVE = 30
+
 COMMAND_RESTART_NAME = 'restart'
 COMMAND_MODULE_INIT = 'initization'
 COMMAND_MODULE_CUSTOM = 'custom_command'
@@ -50,6 +58,21 @@ SESSION_RESPONSE_TIMEOUT = 300
 CONNECTION_TIMEOUT = 10
 SESSION_SHELL_EXIT = uuid.uuid4().hex
 
+# Reads a remote file if its sha1 differs from the local copy, base64 keeps
+# the content the same through the pty
+PREFETCH_FILE_CMD = (
+    "if [ -f {file} ]; then s=$(sha1sum < {file} | cut -c1-40); echo {token} file {index} $s; "
+    "[ \"$s\" = {checksum} ] || base64 {file}; else echo {token} missing {index}; fi")
+
+# Stages the delta of an app next to it and swaps it in.  The staged app is
+# a hard linked copy, copied files replace the links so the installed app is
+# never changed until it is renamed.
+APPLY_DELTA_SCRIPT = (
+    "if test -d {app} && test -d {delta} && rm -rf {new} {old} && cp -al {app} {new} && "
+    "cp -a --remove-destination {delta}/. {new}/ && (cd {new} && xargs -0 rm -f -- < {delete}); then "
+    "mv {app} {old} && {{ mv {new} {app} || {{ mv {old} {app}; false; }}; }}; rc=$?; else rc=1; fi; "
+    "rm -rf {new} {old} {delta} {delete}; exit $rc")
+
 # Filtering for error ssh messasge.
 ERROR_MESSAGES = [
     'No such file or directory',
@@ -58,8 +81,11 @@ ERROR_MESSAGES = [
 ]
 
 
-def set_globals(user, keyfile, port, app_dir, app_bin, dry_run=False):
-    """Set global vars"""
+def set_globals(user, keyfile, port, app_dir, app_bin, dry_run=False, keep_connections=False):
+    """Set global vars
+
+    :param keep_connections: Reuse ssh connections to a host until closed
+    """
 
     CREDS.SSH_USER = user
     CREDS.SSH_KEYFILE = os.path.expanduser(keyfile)
@@ -68,6 +94,7 @@ def set_globals(user, keyfile, port, app_dir, app_bin, dry_run=False):
     CREDS.APP_DIR = app_dir
     CREDS.APP_BIN = app_bin
     CREDS.DRY_RUN = dry_run
+    CREDS.KEEP_CONNECTIONS = keep_connections
 
     if len(keyfile) < 1 or len(CREDS.SSH_USER) < 1:
         CREDS.DRY_RUN = True
@@ -339,7 +366,11 @@ class SshAppCommands(object):
         return self.get_cmd(ecommand, is_clean=True)["cmd"]
 
     def run_command(self, ecommand, host):
-        """Run single stored command"""
+        """Run single stored command
+
+        :return: True if the command ran, False if it failed and None if the
+                 host can not use the command
+        """
 
         command = ecommand['command']
 
@@ -351,7 +382,7 @@ class SshAppCommands(object):
                             hostname=host.hostname,
                             module=COMMAND_MODULE_INIT,
                             allowed_hosts=command.limit_to_hosts)
-            return False
+            return None
 
         # Call root is already taken applied in get_cmd
         ssh_run = SshRun(host.hostname, host.ssh_hostname, "",
@@ -377,7 +408,7 @@ class SshAppCommands(object):
                 cmd=self.get_cmd_clean(ecommand),
                 output=results,
                 module=COMMAND_MODULE_CUSTOM)
-        return True
+        return results['rc'] < 1
 
 
 class SshRun(object):
@@ -469,15 +500,23 @@ class SshRun(object):
         if CREDS.DRY_RUN:
             return True
 
+        if not self.ssh and CREDS.KEEP_CONNECTIONS:
+            self.ssh = get_kept_client(self.ssh_hostname)
+
         if not self.ssh:
             self.ssh = SshRun.get_ssh_client(self.hostname, self.ssh_hostname)
+
+            if self.ssh and CREDS.KEEP_CONNECTIONS:
+                self.ssh.get_transport().set_keepalive(SSH_KEEPALIVE)
+                SSH_CLIENTS[self.ssh_hostname] = (os.getpid(), self.ssh)
         return self.ssh
 
     def close_ssh_channel(self):
-        """Close ssh channel if already open"""
+        """Close ssh channel if already open, kept connections stay open"""
 
         if self.ssh and not CREDS.DRY_RUN:
-            self.ssh.close()
+            if not CREDS.KEEP_CONNECTIONS:
+                self.ssh.close()
             self.ssh = None
 
     def run(self):
@@ -552,10 +591,12 @@ class SshRun(object):
                 std_out, std_error, rc = send_command(channel, self._add_root(cmd))
             else:
                 stdin, stdout, stderr = ssh.exec_command(self._add_root(cmd), get_pty=True, timeout=SESSION_TIMEOUT)  # nosec
-                rc = stdout.channel.recv_exit_status()
 
+                # Output is read before waiting on the exit status, the command
+                # blocks once its output fills the channel window
                 std_out = stdout.read()
                 std_error = stderr.read()
+                rc = stdout.channel.recv_exit_status()
                 stdin.flush()
 
         return {"stdout": std_out,
@@ -564,6 +605,50 @@ class SshRun(object):
                 "rc": rc}
 
 
+def get_kept_client(ssh_hostname):
+    """Open ssh client kept for a host, None if not found or closed
+
+    Clients opened by a parent process are never used, the connection can
+    not be shared.
+    """
+    pid, client = SSH_CLIENTS.get(ssh_hostname, (None, None))
+    if client is None:
+        return None
+
+    transport = client.get_transport()
+    if pid == os.getpid() and transport and transport.is_active():
+        return client
+
+    del SSH_CLIENTS[ssh_hostname]
+    if pid == os.getpid():
+        client.close()
+    return None
+
+
+def release_connections():
+    """Drop the ssh connections inherited from the parent process
+
+    Used by pool workers, they only live for a single pass so their
+    connections are not kept.  Only the inherited socket handles are closed,
+    the parent's connections stay open.
+    """
+    for _pid, client in SSH_CLIENTS.values():
+        transport = client.get_transport()
+        if transport and isinstance(transport.sock, socket.socket):
+            transport.sock.close()
+    SSH_CLIENTS.clear()
+
+    CREDS.KEEP_CONNECTIONS = False
+
+
+def close_connections():
+    """Close the ssh connections kept open by this process"""
+    for pid, client in SSH_CLIENTS.values():
+        if pid == os.getpid():
+            client.close()
+    SSH_CLIENTS.clear()
+
+
 # Helper ssh function
 def copy_to_host(host, remote_file, local_file, is_root=False):
     """Copy file to remote host
@@ -648,7 +733,7 @@ def untar(host, location, is_root):
     _path, tar = os.path.split(host.tar_file)
     func_name = helpers.get_function_name()
     outcome = {'rc': 1}
-    tar_cmd = "tar -zxvf %s -C %s" % (tar, location)
+    tar_cmd = host.payload_codec.get_extract_cmd(tar, location)
 
     if copy_to_host(host, "./", host.tar_file, False):
 
@@ -670,7 +755,28 @@ def untar(host, location, is_root):
             location=location,
             module=COMMAND_MODULE_BUILTIN)
 
-    return True
+    return outcome['rc'] < 1
+
+
+def apply_delta(host, app_path, is_root=False):
+    """Apply the delta of an app extracted from the payload
+
+    The app is left as is if the delta can not be applied.
+    """
+
+    if not check_path(app_path):
+        return False
+
+    script = APPLY_DELTA_SCRIPT.format(app=pipes.quote(app_path),
+                                       delta=pipes.quote(app_path + consts.DELTA_DIR_POSTFIX),
+                                       delete=pipes.quote(app_path + consts.DELTA_DELETE_POSTFIX),
+                                       new=pipes.quote(app_path + consts.DELTA_NEW_POSTFIX),
+                                       old=pipes.quote(app_path + consts.DELTA_OLD_POSTFIX))
+
+    results = run_cmd(host, "sh -c %s" % pipes.quote(script), app_path,
+                      helpers.get_function_name(), is_root)
+
+    return results['rc'] < 1
 
 
 def delete(host, remote_object, is_root=False, app_path_check=True):
@@ -696,6 +802,118 @@ def check_connection(host):
     return results['rc'] < 1
 
 
+def prefetch(host, files, binaries=None, is_root=False):
+    """Check the connection, read files and find binaries in a single session
+
+    Remote files are only sent if they differ from the local copy.
+
+    :param files: [(remote file, local file)]
+    :param binaries: Binaries to look for in the path of the remote host
+    :return: {'can_connect': bool,
+              'files': {remote file: True if the local copy is current, False
+                        if not found and None if not read (dry run or read
+                        failed)},
+              'read_errors': [remote files found but not read],
+              'checksums': {remote file: sha1},
+              'binaries': [binaries found]}
+    """
+
+    binaries = binaries if binaries else []
+    result = {'can_connect': True,
+              'files': {remote_file: None for remote_file, _local_file in files},
+              'read_errors': [],
+              'checksums': {},
+              'binaries': list(binaries)}
+
+    if CREDS.DRY_RUN:
+        return result
+
+    local_checksums = [helpers.get_file_checksum(local_file) or "none" for _remote_file, local_file in files]
+
+    token = uuid.uuid4().hex
+    cmds = ["echo %s connected" % token]
+    for index, (remote_file, _local_file) in enumerate(files):
+        cmds.append(PREFETCH_FILE_CMD.format(token=token, index=index, file=pipes.quote(remote_file),
+                                             checksum=local_checksums[index]))
+    if binaries:
+        cmds.append("echo %s binaries; which %s || true" % (token, " ".join(binaries)))
+
+    output = run_cmd(host, "sh -c %s" % pipes.quote("; ".join(cmds)), "",
+                     helpers.get_function_name(), is_root, False)
+
+    # Output is split into sections by the token
+    sections = {}
+    section = None
+    for line in output['stdout'].replace('\r', '').split('\n'):
+        if line.startswith(token):
+            section = tuple(line.split()[1:])
+            sections[section] = []
+        elif section:
+            sections[section].append(line.strip())
+
+    result['can_connect'] = ('connected',) in sections
+    result['binaries'] = [binary for binary in binaries
+                          if binary in [os.path.basename(line) for line in sections.get(('binaries',), [])
+                                        if line.startswith('/')]]
+
+    if not result['can_connect']:
+        return result
+
+    for index, (remote_file, local_file) in enumerate(files):
+        if ('missing', str(index)) in sections:
+            result['files'][remote_file] = False
+            continue
+
+        # Output cut short, the file is kept as not read
+        section = next((section for section in sections if section[:2] == ('file', str(index))), None)
+        if not section:
+            _error_check("No output for file", remote_file, host.hostname, "prefetch")
+            result['read_errors'].append(remote_file)
+            continue
+
+        checksum = section[2] if len(section) > 2 else ""
+        result['checksums'][remote_file] = checksum
+
+        # Local copy is current
+        if checksum == local_checksums[index]:
+            result['files'][remote_file] = True
+            continue
+
+        try:
+            content = base64.b64decode(''.join(sections[section]))
+            json.loads(content)
+        except (TypeError, ValueError) as e:
+            _error_check(str(e), remote_file, host.hostname, "prefetch")
+            result['read_errors'].append(remote_file)
+            continue
+
+        helpers.create_path(local_file)
+        with open(local_file, 'wb') as f:
+            f.write(content)
+
+        result['files'][remote_file] = True
+
+    return result
+
+
+def find_binaries(host, binaries):
+    """Find which binaries are in the path of the remote host
+
+    Dry runs act as if every binary is found.
+    """
+
+    if CREDS.DRY_RUN:
+        return list(binaries)
+
+    results = run_cmd(host, "which %s" % " ".join(binaries))
+
+    # which only lists the binaries found
+    found = [os.path.basename(line.strip()) for line in results['stdout'].splitlines()
+             if line.strip().startswith('/')]
+
+    return [binary for binary in binaries if binary in found]
+
+
 def rotate_logs(host, log_path, retention, is_root=False):
     """Function to rotate appetite logs"""
 
@@ -6,6 +6,14 @@ VERSIONS_FILENAME = 'app_version'
 VERSIONS_FILENAME_EXT = ".json"
 APPS_METADATE_FILENAME = 'meta_'
 TMP_IGNORE_DIR = 'ignore_tmp'
+CACHE_DIR = 'cache'
+INVALID_META_DIR = 'invalid_metas'
+STATE_STORE_FILENAME = 'appetite_state.db'
+FILES_META_POSTFIX = '_files'
+DELTA_DIR_POSTFIX = '.appetite_delta'
+DELTA_DELETE_POSTFIX = '.appetite_delete'
+DELTA_NEW_POSTFIX = '.appetite_new'
+DELTA_OLD_POSTFIX = '.appetite_old'
 
 APP_MANIFEST_HEADERS = ['commitid', 'application', 'whitelist', 'blacklist', 'method']
 
@@ -58,6 +66,11 @@ NAME_FORMATTING_SPLIT_TOKEN = 11110000100001111
 DM_COMMANDS_SEQUENCE = ['run_first_script', 'commands', 'run_last_script']
 
 DEFAULT_THREAD_POOL_SIZE = 10
+DEFAULT_BUILD_POOL_SIZE = 0  # cpu count
+DEFAULT_PREFETCH_POOL_SIZE = 30
+DEFAULT_POLL_INTERVAL = 60
+DEFAULT_PAYLOAD_CACHE_SIZE = 1024  # MB
+DEFAULT_PAYLOAD_CODEC = "gzip"
 DEFAULT_LOG_RETENTION = 30  # days
 REMOTE_CMD_RUN_SLEEP_TIMER = 30  # seconds
 REMOTE_AUTH_RUN_SLEEP_TIMER = 5  # seconds
@@ -7,6 +7,8 @@ Manages data into and out of the deploymentmethods.conf file.
 
 import re
 import os
+import copy
+import collections
 
 import logger
 import consts
@@ -23,6 +25,19 @@ DM_BOOL_KEYS = ['delete_first', 'all_sites', 'restart', 'skip_templating', "no_a
 DM_STARTUP_PREFIX = 'StartupBootstrap_'
 
 
+class MethodInfoRemoved(object):
+    """Overlay value of a shared value removed from an application"""
+
+    __slots__ = []
+
+    def __reduce__(self):
+        # Same object once copied or unpickled
+        return 'METHOD_INFO_REMOVED'
+
+
+METHOD_INFO_REMOVED = MethodInfoRemoved()
+
+
 class SingleDeploymentMethod(object):
     """Class stores vars needed for a single deployment"""
     def __init__(self, _config, section, skip_check=False):
@@ -31,6 +46,9 @@ class SingleDeploymentMethod(object):
 
         self.data = {'name': section}
 
+        # Values shared by the method info of every application
+        self._shared_data = None
+
         for seq in consts.DM_COMMANDS_SEQUENCE:
             self.data[seq] = []
 
@@ -81,6 +99,91 @@ class SingleDeploymentMethod(object):
     def name(self):
         return self.data['name']
 
+    def create_method_info(self):
+        """Method info for an application, sharing the loaded values
+
+        Lists are shared as tuples so reading them never needs a copy.
+        """
+        if self._shared_data is None:
+            self._shared_data = {key: tuple(value) if isinstance(value, list) else value
+                                 for key, value in self.data.items()}
+
+        return MethodInfo(self._shared_data)
+
+
+class MethodInfo(collections.MutableMapping):
+    """Deployment method info used by an application
+
+    The values loaded from the deploymentmethods.conf are shared between all
+    applications using the method and are never modified, lists (commands,
+    install ignore) are shared as tuples.  Values set or removed for a single
+    application (inclusions, commands) are kept in an overlay.
+    """
+
+    __slots__ = ['_shared', '_overlay']
+
+    def __init__(self, shared, overlay=None):
+        """Init of the method info"""
+        self._shared = shared
+
+        # Only created when a value is set
+        self._overlay = overlay
+
+    def __getitem__(self, key):
+        if self._overlay and key in self._overlay:
+            value = self._overlay[key]
+            if value is METHOD_INFO_REMOVED:
+                raise KeyError(key)
+            return value
+
+        return self._shared[key]
+
+    def __setitem__(self, key, value):
+        if self._overlay is None:
+            self._overlay = {}
+        self._overlay[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+
+        if key in self._shared:
+            self[key] = METHOD_INFO_REMOVED
+        else:
+            del self._overlay[key]
+
+    def __contains__(self, key):
+        if self._overlay and key in self._overlay:
+            return self._overlay[key] is not METHOD_INFO_REMOVED
+        return key in self._shared
+
+    def __iter__(self):
+        for key in self._shared:
+            if key in self:
+                yield key
+        for key in self._overlay if self._overlay else []:
+            if key not in self._shared and key in self:
+                yield key
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __getstate__(self):
+        return self._shared, self._overlay
+
+    def __setstate__(self, state):
+        self._shared, self._overlay = state
+
+    def copy(self):
+        """Copy sharing the deployment method values"""
+        return MethodInfo(self._shared, copy.deepcopy(self._overlay) if self._overlay else None)
+
+    @property
+    def to_dict(self):
+        """Convert to a plain dict, shared tuples are lists again"""
+        return {key: list(value) if isinstance(value, tuple) else value
+                for key, value in self.items()}
+
 
 class DeploymentMethodsManager(object):
     """Class to manage list of deployments"""
@@ -99,6 +202,7 @@ class DeploymentMethodsManager(object):
                                                  _deployment_methods_file)
 
         self.deployment_methods = []
+        self.deployment_methods_by_name = {}
         self.boot_order = []
         self.startup_bootstrap = []
         self.default_setting = {}
@@ -123,10 +227,11 @@ class DeploymentMethodsManager(object):
                 su_bootstrap = SingleDeploymentMethod(self.config, section, True).data
                 self.startup_bootstrap.append(su_bootstrap)
             else:
-                self.deployment_methods.append(SingleDeploymentMethod(self.config, section))
+                deployment_method = SingleDeploymentMethod(self.config, section)
+                self.deployment_methods.append(deployment_method)
+                self.deployment_methods_by_name.setdefault(deployment_method.name, deployment_method)
 
     def get_deployment_method(self, deployment_method_name):
         """Get deployment methods based on names"""
 
-        return next((dm for dm in self.deployment_methods if dm.name == deployment_method_name),
-                    None)
+        return self.deployment_methods_by_name.get(deployment_method_name)
@@ -8,13 +8,19 @@ import uuid
 import datetime
 import time
 import re
+import sre_parse
+import sre_constants
 import imp
 import json
+import hashlib
 import traceback
 import shlex
 import shutil
+import collections
 import ConfigParser
 import fcntl
+import tarfile
+import tempfile
 from subprocess import Popen, STDOUT, PIPE # nosec
 from jinja2 import Environment, FileSystemLoader, Template, meta
 import yaml
@@ -26,9 +32,18 @@ import version
 DM_FILTER_COMMANDS = re.compile(r"-auth.* ", re.IGNORECASE)
 REDIRECT_COMMANDS = ['&&', '&', '>', '1>', '2>', '>>', '1>>', '2>>', '<', '&>', '|', "||"]
 REMOVE_LAST_FOLDER = re.compile(r"[^/]+/?$")
+BACKREFERENCE_CHECK = re.compile(r"\\[1-9]|\(\?P=")
+DEFAULT_REGEX_FLAGS = re.compile("").flags
+MAX_REGEX_PREFIXES = 64
 APPETITE_LOCKFILE = "appetite_lock"
 LOCK_PATH = "/tmp/%s" % APPETITE_LOCKFILE # nosec
 
+# Compiled name formattings
+NAME_FORMATS = {}
+NAME_FORMATTING_TOKEN_STEP = 100000000
+NAME_FORMATTING_SAMPLES = [{"appclass": "cls", "site": "0", "num": 7},
+                           {"appclass": "cls", "site": "east", "num": 3}]
+
 
 def create_path(path, is_dir=False):
     """Create Path"""
@@ -45,7 +60,9 @@ def create_path(path, is_dir=False):
 def delete_path(path):
     """Delete path including content"""
     try:
-        if os.path.exists(path):
+        if os.path.isfile(path) or os.path.islink(path):
+            os.remove(path)
+        elif os.path.exists(path):
             shutil.rmtree(path)
     except Exception as e:
         logger.exception("Problem deleting folder", e, path=path)
@@ -53,6 +70,44 @@ def delete_path(path):
     return True
 
 
+def link_tree(src_path, dest_path):
+    """Hard link the files within a directory into another directory
+
+    Existing files are replaced.
+    """
+    for path, _dirs, files in os.walk(src_path):
+        dest_dir = os.path.normpath(os.path.join(dest_path, os.path.relpath(path, src_path)))
+        create_path(dest_dir, True)
+
+        for filename in files:
+            dest_file = os.path.join(dest_dir, filename)
+            if os.path.lexists(dest_file):
+                os.remove(dest_file)
+            os.link(os.path.join(path, filename), dest_file)
+
+
+def copy_tree(src_path, dest_path):
+    """Copy the files within a directory into another directory
+
+    Modes and times are kept, links are copied as their target.  Existing
+    files are replaced.
+    """
+    for path, _dirs, files in os.walk(src_path, followlinks=True):
+        dest_dir = os.path.normpath(os.path.join(dest_path, os.path.relpath(path, src_path)))
+        create_path(dest_dir, True)
+        shutil.copymode(path, dest_dir)
+
+        for filename in files:
+            src_file = os.path.join(path, filename)
+            dest_file = os.path.join(dest_dir, filename)
+            if os.path.lexists(dest_file):
+                os.remove(dest_file)
+
+            # Links without a target are left out
+            if os.path.exists(src_file):
+                shutil.copy2(src_file, dest_file)
+
+
 def check_path(path, file_name=None):
     """Check path to see if it has the correct permissions to write"""
     if not os.path.exists(path):
@@ -76,6 +131,27 @@ def check_file(filepath):
     return True
 
 
+def get_blob_id(filepath):
+    """Git blob id of a file (same as git hash-object)"""
+    with open(filepath, 'rb') as f:
+        content = f.read()
+
+    return hashlib.sha1("blob %d\0%s" % (len(content), content)).hexdigest()  # nosec
+
+
+def get_file_checksum(filepath):
+    """Sha1 of a file (same as sha1sum) or None if not found"""
+    if not os.path.isfile(filepath):
+        return None
+
+    file_hash = hashlib.sha1()  # nosec
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
 def get_uid():
     """Generate a uid string"""
     return str(uuid.uuid1())
@@ -371,6 +447,146 @@ def check_host(hostname, black_list, white_list):
     return False
 
 
+def compile_host_regexes(host_regexes):
+    """Compile a list of host regexes into a single regex
+
+    Patterns are or'ed together so a single search is needed per hostname.
+    Patterns using backreferences can not be combined since group numbers
+    shift, and inline flags, i.e. (?i), would apply to every pattern.  Those
+    are kept as a list of compiled patterns.  The same is done if the
+    combined regex does not compile, i.e. repeated group names or too many
+    groups.
+    """
+    if len(host_regexes) < 1:
+        return []
+
+    compiled_regexes = [re.compile(host_regex) for host_regex in host_regexes]
+
+    if next((True for host_regex in host_regexes if BACKREFERENCE_CHECK.search(host_regex)), False) or \
+            next((True for compiled_regex in compiled_regexes
+                  if compiled_regex.flags != DEFAULT_REGEX_FLAGS), False):
+        return compiled_regexes
+
+    try:
+        return [re.compile("|".join("(?:%s)" % host_regex for host_regex in host_regexes))]
+    except (re.error, AssertionError):
+        return compiled_regexes
+
+
+def _get_literal_prefixes(items):
+    """Literal strings a parsed regex starts with
+
+    :return: (set of prefixes, True if the whole regex was literal)
+    """
+    prefixes = set([""])
+
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            options = [(set([unichr(av)]), True)]
+        elif op == sre_constants.IN and all(in_op == sre_constants.LITERAL for in_op, _in_av in av):
+            options = [(set([unichr(in_av)]), True) for _in_op, in_av in av]
+        elif op == sre_constants.SUBPATTERN:
+            options = [_get_literal_prefixes(av[-1])]
+        elif op == sre_constants.BRANCH:
+            options = [_get_literal_prefixes(branch) for branch in av[1]]
+        else:
+            return prefixes, False
+
+        new_prefixes = set(prefix + option for option_prefixes, _complete in options
+                           for option in option_prefixes for prefix in prefixes)
+
+        if len(new_prefixes) > MAX_REGEX_PREFIXES:
+            return prefixes, False
+
+        prefixes = new_prefixes
+
+        if not all(complete for _option_prefixes, complete in options):
+            return prefixes, False
+
+    return prefixes, True
+
+
+def get_regex_prefixes(host_regex):
+    """Literal prefixes of a host regex, i.e. 'splunk-(cm|ds).*' starts with
+    'splunk-cm' or 'splunk-ds'
+
+    :return: (set of prefixes, True if anchored with ^) or None if the regex
+             has no literal prefix
+    """
+    try:
+        if re.compile(host_regex).flags & re.IGNORECASE:
+            return None
+        items = list(sre_parse.parse(host_regex))
+    except (re.error, AssertionError):
+        return None
+
+    is_anchored = bool(items) and items[0] == (sre_constants.AT, sre_constants.AT_BEGINNING)
+    if is_anchored:
+        items = items[1:]
+
+    prefixes = _get_literal_prefixes(items)[0]
+
+    if "" in prefixes:
+        return None
+
+    return prefixes, is_anchored
+
+
+class HostMatcher(object):
+    """Precompiled white and black list matcher for a manifest row
+
+    Same logic as check_host, but the regexes are compiled once and the
+    result is cached per hostname.
+    """
+
+    def __init__(self, white_list, black_list):
+        """Init HostMatcher
+        :param white_list: list of regexes for hosts to include
+        :param black_list: list of regexes for hosts to exclude
+        """
+        # Short blacklist entries are ignored (same as check_host)
+        self.__black_regexes = compile_host_regexes([host_regex for host_regex in black_list
+                                                     if len(host_regex) > 1])
+        self.__white_regexes = compile_host_regexes(white_list)
+        self.__white_list = white_list
+        self.__results = {}
+
+    def get_white_prefixes(self):
+        """Literal prefixes a hostname needs to be white listed
+
+        :return: [(set of prefixes, True if anchored with ^)] or None if a
+                 white list regex has no literal prefix
+        """
+        white_prefixes = [get_regex_prefixes(host_regex) for host_regex in self.__white_list]
+
+        if not white_prefixes or None in white_prefixes:
+            return None
+
+        return white_prefixes
+
+    def check(self, hostname):
+        """Check hostname against the white and black list
+        :param hostname: hostname to check
+        :return: True | False
+        """
+        result = self.__results.get(hostname)
+
+        if result is None:
+            result = False
+            for host_regex in self.__black_regexes:
+                if host_regex.search(hostname):
+                    break
+            else:
+                for host_regex in self.__white_regexes:
+                    if host_regex.search(hostname):
+                        result = True
+                        break
+
+            self.__results[hostname] = result
+
+        return result
+
+
 def get_stanza(filename, stanza_name):
     """Get Information from a stanza in a configuration file"""
 
@@ -415,22 +631,140 @@ def split_naming(naming_format):
 
 def check_name_formatting(naming_format, hostname):
     """Very basic check to see if the pre and postfix match"""
-    naming_struct = split_naming(naming_format)
+    return get_name_format(naming_format).check(hostname)
 
-    return (hostname.endswith(naming_struct['postfix']) and
-            hostname.startswith(naming_struct['prefix']))
+
+class NameFormat(object):
+    """Compiled host name formatting
+
+    The name formatting is rendered once with a token for each field to find
+    the literal parts around them.  Host names are then parsed with a single
+    regex using named groups and built by joining the parts.  If the
+    formatting can not be compiled, the jinja2 functions are used.
+    """
+
+    def __init__(self, naming_format):
+        """Init of the name formatting"""
+        self.naming_format = naming_format
+        self.naming_struct = split_naming(naming_format)
+        self.parts = None
+        self.regex = None
+        self.num_width = 1
+
+        try:
+            self._compile()
+        except Exception as e:  # pylint: disable=broad-except
+            logger.debug("Name formatting not compiled, using jinja2",
+                         name_formatting=naming_format, error=str(e))
+            self.parts = None
+            self.regex = None
+
+    def _compile(self):
+        """Create the parts and regex from the name formatting"""
+        tokens = {}
+        fillers = {}
+        for index, name_format in enumerate(consts.NAME_FORMATTING):
+            token = consts.NAME_FORMATTING_SPLIT_TOKEN + index * NAME_FORMATTING_TOKEN_STEP
+            tokens[str(token)] = name_format
+            fillers[name_format['name']] = str(token) if name_format['format_type'] == 'str' else token
+
+        rendered = render_template(self.naming_format, fillers)
+
+        # Literal parts and fields alternate, starting and ending with a literal
+        parts = []
+        last_end = 0
+        for token_match in re.finditer("|".join(tokens), rendered):
+            parts.append(rendered[last_end:token_match.start()])
+            parts.append(tokens[token_match.group(0)])
+            last_end = token_match.end()
+        parts.append(rendered[last_end:])
+
+        field_names = sorted(field['name'] for field in parts[1::2])
+        if field_names != sorted(name_format['name'] for name_format in consts.NAME_FORMATTING):
+            raise ValueError("Each field has to be used once")
+
+        self.parts = parts
+
+        # Width of the zero padded number, i.e. '%03d'
+        zero_host = render_template(self.naming_format, {
+            name_format['name']: 'x' if name_format['format_type'] == 'str' else 0
+            for name_format in consts.NAME_FORMATTING})
+        zero_match = self._create_regex(".+?").match(zero_host)
+        if not zero_match:
+            raise ValueError("Zero host does not match")
+
+        num_name = next(name_format['name'] for name_format in consts.NAME_FORMATTING
+                        if name_format['format_type'] != 'str')
+        self.num_width = len(zero_match.group(num_name))
+        self.regex = self._create_regex()
+
+        # Has to give the same results as jinja2
+        for sample in NAME_FORMATTING_SAMPLES:
+            sample_host = render_template(self.naming_format, sample)
+            if self.build(sample) != sample_host or \
+                    self.parse(sample_host) != {key: int(value) if str(value).isdigit() else value
+                                                for key, value in sample.items()}:
+                raise ValueError("Compiled name formatting does not match jinja2")
+
+    def _create_regex(self, str_pattern=".+"):
+        """Regex with a named group for each field"""
+        pattern = ""
+        for index, part in enumerate(self.parts):
+            if index % 2 == 0:
+                pattern += re.escape(part)
+            elif part['format_type'] == 'str':
+                pattern += "(?P<%s>%s)" % (part['name'], str_pattern)
+            else:
+                pattern += r"(?P<%s>\d{%d,})" % (part['name'], self.num_width)
+
+        return re.compile("^%s$" % pattern)
+
+    def check(self, hostname):
+        """Very basic check to see if the pre and postfix match"""
+        return (hostname.endswith(self.naming_struct['postfix']) and
+                hostname.startswith(self.naming_struct['prefix']))
+
+    def parse(self, hostname):
+        """Pull the data from the host name"""
+        if self.regex:
+            host_match = self.regex.match(hostname)
+            if host_match:
+                return {name: int(value) if value.isdigit() else value
+                        for name, value in host_match.groupdict().items()}
+
+        return pull_data_from_host(self.naming_format, hostname, {})
+
+    def build(self, values):
+        """Build a host name from the field values"""
+        if not self.parts:
+            return render_template(self.naming_format, values)
+
+        return "".join(part if index % 2 == 0 else
+                       str(values[part['name']]).zfill(self.num_width) if part['format_type'] != 'str' else
+                       str(values[part['name']])
+                       for index, part in enumerate(self.parts))
+
+
+def get_name_format(naming_format):
+    """Get the compiled name formatting, compiled once per format"""
+    if naming_format not in NAME_FORMATS:
+        NAME_FORMATS[naming_format] = NameFormat(naming_format)
+
+    return NAME_FORMATS[naming_format]
 
 
 def pull_class_from_host(naming_format, hostname, app_classes):
     """Pull the class from the host name based on the """
 
-    host_data = pull_data_from_host(naming_format, hostname, {})
+    name_format = get_name_format(naming_format)
 
     # Check to see if the pre-post fixes are the same as the
     # naming formating
-    if not check_name_formatting(naming_format, hostname):
+    if not name_format.check(hostname):
         return None
 
+    host_data = name_format.parse(hostname)
+
     return next((host_data for app_class in app_classes if host_data[consts.NAME_FORMATTING[0]['name']] == app_class), None)
 
 
@@ -476,13 +810,15 @@ def pull_data_from_host(naming_format, hostname, already_found):
 def build_hostname(naming_format, s_class, host_num):
     """Build a hostname based on class and num given"""
 
-    name = render_template(naming_format, {
+    name_format = get_name_format(naming_format)
+
+    name = name_format.build({
         consts.NAME_FORMATTING[0]['name']: s_class,  # class
         consts.NAME_FORMATTING[1]['name']: "0",      # site
         consts.NAME_FORMATTING[2]['name']: host_num  # host index
     })
 
-    if len(get_template_vars(name)) > 1:
+    if not name_format.parts and len(get_template_vars(name)) > 1:
         logger.errorout("Host name not templated correctly")
 
     return name
@@ -595,7 +931,7 @@ def content_process(apps_meta, status_types, hostname, track, isupdate):
             # Preserve sequence order and remove dups
             source[seq] = []
             [source[seq].append(commands) for app in changed_content # pylint: disable=expression-not-assigned
-             if isinstance(app.method_info, dict) and seq in app.method_info
+             if isinstance(app.method_info, collections.Mapping) and seq in app.method_info
              for commands in app.method_info[seq] if commands not in source[seq]]
         source['restart'] = next((True for app in changed_content
                                   if app.method_info['restart']), False)
@@ -605,6 +941,30 @@ def content_process(apps_meta, status_types, hostname, track, isupdate):
     return source
 
 
+def merge_content_updates(updates):
+    """Merge updates from multiple profiles into a single update
+
+    Commands keep their sequence order and dups are removed, the host only
+    needs to restart once.
+    """
+    if len(updates) == 1:
+        return updates[0]
+
+    merged = updates[0].copy()
+    merged['content'] = [content for update in updates for content in update['content']]
+    merged['change_count'] = sum(update['change_count'] for update in updates)
+    merged['restart'] = next((True for update in updates if update['restart']), False)
+
+    for seq in consts.DM_COMMANDS_SEQUENCE:
+        merged[seq] = []
+        for update in updates:
+            for command in update.get(seq, []):
+                if command not in merged[seq]:
+                    merged[seq].append(command)
+
+    return merged
+
+
 def content_wrapper(apps_meta, status_types, hostname, track, isupdate=False):
     """Wrapper for content
 
@@ -682,6 +1042,78 @@ def template_directory(app_path, templating_values, regex_file_filter):
                 logger.error('Error templating file', file=file_path, error=str(err))
 
 
+def get_files_template_vars(files):
+    """Get all templated keys used by files
+
+    :param files: (file path, content) of the files that are templated
+    :return: set of keys or None if the templates can not be checked
+    """
+    template_vars = set()
+
+    env = Environment(autoescape=True)
+    for _file_path, content in files:
+        try:
+            parsed_content = env.parse(content.decode('utf-8'))
+        except Exception: # pylint: disable=broad-except
+            return None
+
+        # Included templates are not followed
+        if next(meta.find_referenced_templates(parsed_content), False) is not False:
+            return None
+
+        template_vars.update(meta.find_undeclared_variables(parsed_content))
+
+    return template_vars
+
+
+def create_tar_fragment(fragments, source_path, arcname, end_archive=False):
+    """Create compressed tar fragments
+
+    Compressed frames and tar entries can both be appended.  Fragments
+    created without the end of archive marker are concatenated in front of
+    one that has it, with the same codec, to create a complete payload.
+
+    Entries are added in sorted order and the codecs add no name or time so
+    the same content creates the same fragment.
+
+    :param fragments: [(fragment path, payload codec)], the tar is only
+                      created once for all of them
+    """
+    tar_buffer = tempfile.TemporaryFile()
+    try:
+        tar = tarfile.open(fileobj=tar_buffer, mode='w')
+
+        add_paths = [(source_path, arcname)]
+        while add_paths:
+            path, path_arcname = add_paths.pop()
+            tar.add(path, arcname=path_arcname, recursive=False)
+
+            if os.path.isdir(path) and not os.path.islink(path):
+                # Reversed since paths are popped from the end
+                add_paths += [(os.path.join(path, name), os.path.join(path_arcname, name))
+                              for name in sorted(os.listdir(path), reverse=True)]
+
+        tar_size = tar.offset
+        tar.close()
+
+        if end_archive:
+            tar_size = tar_buffer.tell()
+
+        for fragment_path, codec in fragments:
+            tar_buffer.seek(0)
+            codec.compress(tar_buffer, tar_size, fragment_path)
+    finally:
+        tar_buffer.close()
+
+
+def concat_files(dest_path, src_paths):
+    """Concatenate files into a single file"""
+    with open(dest_path, 'wb') as dest_file:
+        for src_path in src_paths:
+            with open(src_path, 'rb') as src_file:
+                shutil.copyfileobj(src_file, dest_file)
+
+
 def move_regexed_files(regex_lines, src_path, dest_path): # pylint: disable=too-many-locals
     """Move files based on a regex filter
 
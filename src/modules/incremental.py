@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#pylint: disable=relative-import,invalid-name,too-many-arguments
+"""Incremental
+
+Limits a run to the hosts affected by the manifest changes since the last
+completed run.
+
+The push commit id of the last completed run is kept in the scratch dir.
+Manifest rows that were added, removed or changed since that commit are
+matched against the hosts.  Rows without a commit id follow the branch, so
+they also count as changed when files within their app changed.  Anything
+that can change every host (deploymentmethods.conf, templating values,
+profiles) falls back to a full run.
+"""
+
+import os
+import json
+import hashlib
+
+import consts
+import helpers
+import logger
+import manifest as Manifest
+
+INCREMENTAL_STATE_VERSION = 1
+INCREMENTAL_STATE_FILENAME = "incremental.json"
+
+
+def get_state_path(scratch_location):
+    """Location of the incremental state file"""
+    return os.path.join(scratch_location, consts.CACHE_DIR, INCREMENTAL_STATE_FILENAME)
+
+
+def get_settings_key(settings):
+    """Hash of the settings that affect every host"""
+    return hashlib.sha1(json.dumps(settings, sort_keys=True)).hexdigest()  # nosec
+
+
+def load_state(state_path):
+    """Load the state of the last completed run"""
+    if not os.path.isfile(state_path):
+        return None
+
+    try:
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+    except Exception as e:
+        logger.warn("Problem reading incremental state", path=state_path, error=str(e))
+        return None
+
+    if state.get('version') != INCREMENTAL_STATE_VERSION:
+        return None
+
+    return state
+
+
+def write_state(state_path, commit_id, settings_key, pending_hostnames):
+    """Store the state of a completed run
+
+    :param pending_hostnames: Hosts that were not fully updated, always
+                              included in the next run
+    """
+    helpers.create_path(state_path)
+
+    tmp_state_path = "%s.tmp" % state_path
+    with open(tmp_state_path, 'w') as f:
+        json.dump({'version': INCREMENTAL_STATE_VERSION,
+                   'commit_id': commit_id,
+                   'settings_key': settings_key,
+                   'pending_hosts': sorted(pending_hostnames)},
+                  f, separators=(',', ':'))
+
+    # Rename so a partial state file is never read
+    os.rename(tmp_state_path, state_path)
+
+
+def get_changed_rows(repo_manager, profile, prev_commit_id, changed_files, name_filter):
+    """Manifest rows that changed since the previous commit
+
+    :return: [ManifestRow] or None if the previous manifest could not be loaded
+    """
+    repo_path = repo_manager.paths['repo_path']
+    manifest_file = os.path.relpath(profile.manifest_path, repo_path)
+
+    rows = profile.manifest['rows']
+
+    if manifest_file in changed_files:
+        prev_content = repo_manager.get_file_content(prev_commit_id, manifest_file)
+        if prev_content is None:
+            return None
+
+        prev_rows = Manifest.parse_manifest_lines(prev_content.splitlines(), name_filter)['rows']
+        changed_rows = Manifest.diff_rows(prev_rows, rows)
+    else:
+        changed_rows = []
+
+    # Rows without a commit id use the latest app content
+    apps_folder = os.path.relpath(profile.apps_folder, repo_path)
+    changed_apps = set(changed_file[len(apps_folder) + 1:].split('/')[0] for changed_file in changed_files
+                       if changed_file.startswith(apps_folder + '/'))
+
+    changed_keys = set(row.row_key for row in changed_rows)
+    changed_rows += [row for row in rows if row.app in changed_apps and
+                     (len(row.commit_id) == 0 or row.commit_id == 'N/A') and
+                     row.row_key not in changed_keys]
+
+    return changed_rows
+
+
+def get_affected_hosts(repo_manager, deployment_manager, profiles, hosts,
+                       state, settings_key):
+    """Hosts affected by the changes since the last completed run
+
+    :return: [hosts] or None if a full run is needed
+    """
+    if not state:
+        logger.info("Incremental run not possible, no previous run found")
+        return None
+
+    if state['settings_key'] != settings_key:
+        logger.info("Incremental run not possible, settings changed")
+        return None
+
+    changed_files = repo_manager.get_changed_files(state['commit_id'])
+    if changed_files is None:
+        return None
+
+    dm_file = os.path.relpath(deployment_manager.paths['dm_filepath'], repo_manager.paths['repo_path'])
+    if dm_file in changed_files:
+        logger.info("Incremental run not possible, deployment methods changed", file=dm_file)
+        return None
+
+    changed_rows = []
+    for profile in profiles:
+        profile_rows = get_changed_rows(repo_manager, profile, state['commit_id'],
+                                        changed_files, deployment_manager.name_filter)
+        if profile_rows is None:
+            logger.info("Incremental run not possible, previous manifest not found",
+                        manifest=profile.apps_manifest)
+            return None
+        changed_rows += profile_rows
+
+    pending_hostnames = set(state['pending_hosts'])
+
+    affected_hosts = []
+    for host in hosts:
+        # Hosts without a local meta need a full check (new host or cleaned metas)
+        metas_found = all(os.path.isfile(host.get_local_meta_file(profile.meta_name))
+                          for profile in profiles)
+
+        if not metas_found or host.hostname in pending_hostnames or \
+                next((True for row in changed_rows if row.host_matcher.check(host.hostname)), False):
+            affected_hosts.append(host)
+
+    logger.info("Incremental run", prev_commit_id=state['commit_id'], changed_rows=len(changed_rows),
+                hosts=len(affected_hosts), total_hosts=len(hosts))
+
+    return affected_hosts
+
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+#pylint: disable=relative-import,invalid-name,too-many-arguments
+"""Manifest
+
+Parses and validates the app manifest (csv).
+
+Parsed manifests are cached in the scratch dir.  The cache is keyed by the
+git blob id of the manifest and the hash of the deploymentmethods.conf, runs
+where neither changed skip parsing and validation.
+"""
+
+import os
+import csv
+import re
+import json
+import hashlib
+
+import consts
+import helpers
+import logger
+
+MANIFEST_CACHE_VERSION = 1
+
+
+class ManifestRow(object):
+    """Class to store a single parsed manifest row"""
+
+    def __init__(self, commit_id, app, app_clean, deployment, white_list, black_list):
+        """Init of a manifest row"""
+        self.commit_id = commit_id
+        self.app = app
+        self.app_clean = app_clean
+        self.deployment = deployment
+        self.white_list = white_list
+        self.black_list = black_list
+
+        # Compiled once per row, results cached per hostname
+        self.host_matcher = helpers.HostMatcher(white_list, black_list)
+
+    @property
+    def row_key(self):
+        """Key used to compare rows between manifests"""
+        return (self.commit_id, self.app, self.deployment,
+                tuple(self.white_list), tuple(self.black_list))
+
+    @property
+    def to_list(self):
+        """Compact representation used for caching"""
+        return [self.commit_id, self.app, self.app_clean, self.deployment,
+                self.white_list, self.black_list]
+
+    @staticmethod
+    def from_list(values):
+        """Create row from the compact representation"""
+        return ManifestRow(*values)
+
+
+def get_column_headers(header_row):
+    """Get indexes for the needed columns from the header row"""
+
+    # Defines column headers in manifest
+    column_headers = {col_name: -1 for col_name in consts.DEFAULT_COLUMN_HEADER}
+
+    num_columns = len(header_row)
+    for k in column_headers:
+        value_index = next((index for index in range(0, num_columns)
+                            if header_row[index].lower() == k), -1)
+        if value_index < 0:
+            logger.errorout("Manifest header is missing", header=k)
+        column_headers[k] = value_index
+
+    return column_headers
+
+
+def parse_manifest(manifest_path, name_filter):
+    """Parse and validate the manifest
+
+    :return: {'column_headers': {}, 'rows': [ManifestRow], 'invalid_commit_ids': []}
+    """
+    helpers.check_file(manifest_path)
+
+    with open(manifest_path, 'rU') as csvfile:
+        return parse_manifest_lines(csvfile, name_filter)
+
+
+def parse_manifest_lines(lines, name_filter):
+    """Parse and validate manifest content
+
+    :param lines: Iterable of csv lines, file or content from the repo
+    :return: {'column_headers': {}, 'rows': [ManifestRow], 'invalid_commit_ids': []}
+    """
+    column_headers = None
+    rows = []
+    invalid_commit_ids = []
+
+    mreader = csv.reader(lines, delimiter=',', quotechar='"')
+
+    # Go though each app
+    for row in mreader:
+        # First row defines column headers in manifest
+        if column_headers is None:
+            column_headers = get_column_headers(row)
+            continue
+
+        if len(row) > 1:
+            app = row[column_headers['application']]
+            commit_id = row[column_headers['commitid']]
+
+            rows.append(ManifestRow(commit_id,
+                                    app,
+                                    name_filter.sub("", app),
+                                    row[column_headers['deploymentmethod']],
+                                    row[column_headers['whitelist']].split(','),
+                                    row[column_headers['blacklist']].split(',')))
+
+            if len(commit_id) > 0 and re.match(consts.COMMIT_ID_REGEX_CHECK, commit_id) is None:
+                invalid_commit_ids.append(commit_id)
+
+    return {'column_headers': column_headers if column_headers else {},
+            'rows': rows,
+            'invalid_commit_ids': invalid_commit_ids}
+
+
+def diff_rows(old_rows, new_rows):
+    """Rows that were added, removed or changed between two manifests
+
+    Removed rows are included since hosts matching them need the app removed.
+    """
+    old_keys = set(row.row_key for row in old_rows)
+    new_keys = set(row.row_key for row in new_rows)
+
+    return [row for row in old_rows if row.row_key not in new_keys] + \
+           [row for row in new_rows if row.row_key not in old_keys]
+
+
+def get_cache_key(manifest_path, dm_filepath):
+    """Key used to check if a cached manifest is still valid"""
+    with open(dm_filepath, 'rb') as f:
+        dm_hash = hashlib.sha1(f.read()).hexdigest()  # nosec
+
+    return "%s:%s" % (helpers.get_blob_id(manifest_path), dm_hash)
+
+
+def load_cache(cache_path, cache_key):
+    """Load parsed manifest if the key matches"""
+    if not os.path.isfile(cache_path):
+        return None
+
+    try:
+        with open(cache_path, 'r') as f:
+            cached = json.load(f)
+    except Exception as e:
+        logger.warn("Problem reading manifest cache", path=cache_path, error=str(e))
+        return None
+
+    if cached.get('version') != MANIFEST_CACHE_VERSION or cached.get('key') != cache_key:
+        return None
+
+    return {'column_headers': cached['column_headers'],
+            'rows': [ManifestRow.from_list(values) for values in cached['rows']],
+            'invalid_commit_ids': cached['invalid_commit_ids']}
+
+
+def write_cache(cache_path, cache_key, manifest):
+    """Store parsed manifest"""
+    helpers.create_path(cache_path)
+
+    tmp_cache_path = "%s.tmp" % cache_path
+    with open(tmp_cache_path, 'w') as f:
+        json.dump({'version': MANIFEST_CACHE_VERSION,
+                   'key': cache_key,
+                   'column_headers': manifest['column_headers'],
+                   'rows': [row.to_list for row in manifest['rows']],
+                   'invalid_commit_ids': manifest['invalid_commit_ids']},
+                  f, separators=(',', ':'))
+
+    # Rename so a partial cache file is never read
+    os.rename(tmp_cache_path, cache_path)
+
+
+def load_manifest(manifest_path, dm_filepath, name_filter, cache_path=None):
+    """Get parsed manifest, using the cache when possible
+
+    :return: {'column_headers': {}, 'rows': [ManifestRow], 'invalid_commit_ids': [], 'cached': bool}
+    """
+    cache_key = None
+    manifest = None
+
+    if cache_path:
+        helpers.check_file(manifest_path)
+        cache_key = get_cache_key(manifest_path, dm_filepath)
+        manifest = load_cache(cache_path, cache_key)
+
+    cached = manifest is not None
+
+    if not cached:
+        manifest = parse_manifest(manifest_path, name_filter)
+
+        if cache_path:
+            write_cache(cache_path, cache_key, manifest)
+
+    for commit_id in manifest['invalid_commit_ids']:
+        logger.critical("Commit ID does not match regex check: %s" % consts.COMMIT_ID_REGEX_CHECK,
+                        commit_id=commit_id)
+
+    manifest['cached'] = cached
+
+    return manifest
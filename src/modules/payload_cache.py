@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+#pylint: disable=relative-import,invalid-name
+"""PayloadCache
+
+Content addressed cache of packaged apps.
+
+Each app build (PayloadGroups) is packaged into a tar fragment keyed by
+everything used to build it: app, commit id, deployment method and the
+values of the variables its templates reference.  A host payload is the fragments of its
+apps concatenated with the host meta fragment, so hosts and runs that need
+the same app build share the fragment.  Fragments are stored per payload
+codec, the build info is shared by all of them.  Changed apps sent as a
+delta are keyed by the build and the remote files they replace.
+
+Fragments are kept in the scratch dir between runs.  When the cache is
+over its size cap, the least recently used files are evicted.
+"""
+
+import os
+import json
+import hashlib
+
+import logger
+
+PAYLOAD_CACHE_VERSION = 1
+INFO_EXT = ".json"
+REFS_EXT = ".refs"
+
+
+def get_template_key(template_refs, templating_values):
+    """Values of the variables referenced by the templates
+
+    :param templating_values: Dicts searched in order for each variable
+    """
+    template_key = []
+    for ref in sorted(template_refs):
+        value = next((values[ref] for values in templating_values if ref in values), None)
+        template_key.append([ref, value])
+    return template_key
+
+
+def get_delta_key(key, base_key):
+    """Cache key of an app build sent as a delta
+
+    :param base_key: Hash of the remote files, None for the whole app
+    """
+    return hash_key([key, base_key]) if base_key else key
+
+
+def hash_key(key):
+    """Hash of a json serializable key"""
+    return hashlib.sha1(json.dumps(key, sort_keys=True, default=str)).hexdigest()  # nosec
+
+
+class PayloadCache(object):
+    """Class to store and lookup app fragments"""
+
+    def __init__(self, cache_folder, size_cap, build_settings):
+        """Init of the payload cache
+        :param cache_folder: Location of the fragments
+        :param size_cap: Max size of the cache in bytes, 0 for no eviction
+        :param build_settings: Settings used to build every app
+        """
+        self.cache_folder = cache_folder
+        self.size_cap = size_cap
+        self.build_settings = [PAYLOAD_CACHE_VERSION, build_settings]
+
+        self.hits = 0
+        self.misses = 0
+
+    def get_path(self, key, ext):
+        """Location of a cache file"""
+        return os.path.join(self.cache_folder, "%s%s" % (key, ext))
+
+    def get_key(self, build_key, commit_id, template_key):
+        """Cache key of an app build"""
+        return hash_key([self.build_settings, build_key, commit_id, template_key])
+
+    def get_refs(self, build_key, commit_id):
+        """Stored template variables referenced by an app build
+
+        :return: list of variables or None if not stored
+        """
+        return self._load(self.get_path(hash_key([self.build_settings, build_key, commit_id]), REFS_EXT))
+
+    def set_refs(self, build_key, commit_id, template_refs):
+        """Store template variables referenced by an app build"""
+        self._write(self.get_path(hash_key([self.build_settings, build_key, commit_id]), REFS_EXT),
+                    sorted(template_refs))
+
+    def get(self, key, fragment_ext):
+        """Get the build info of a cached fragment
+
+        :param fragment_ext: Fragment extension of the payload codec
+        :return: build info or None if not cached
+        """
+        fragment_path = self.get_path(key, fragment_ext)
+        info_path = self.get_path(key, INFO_EXT)
+
+        build_info = self._load(info_path) if os.path.isfile(fragment_path) else None
+
+        if build_info is None:
+            self.misses += 1
+            return None
+
+        # Used to evict least recently used fragments
+        os.utime(fragment_path, None)
+        os.utime(info_path, None)
+
+        self.hits += 1
+        return build_info
+
+    def add(self, key, fragments, build_info):
+        """Move packaged fragments into the cache
+
+        The build info is written last, a fragment is only used once it is
+        found.
+
+        :param fragments: [(fragment path, fragment extension)]
+        """
+        for fragment_path, fragment_ext in fragments:
+            os.rename(fragment_path, self.get_path(key, fragment_ext))
+        self._write(self.get_path(key, INFO_EXT), build_info)
+
+    def evict(self):
+        """Remove least recently used files until the cache is below its size cap"""
+        if self.size_cap < 1 or not os.path.isdir(self.cache_folder):
+            return
+
+        cache_files = []
+        for filename in os.listdir(self.cache_folder):
+            file_path = os.path.join(self.cache_folder, filename)
+            file_stat = os.stat(file_path)
+            cache_files.append((file_stat.st_mtime, file_stat.st_size, file_path))
+
+        cache_size = sum(file_size for _mtime, file_size, _path in cache_files)
+        if cache_size <= self.size_cap:
+            return
+
+        evicted = 0
+        for _mtime, file_size, file_path in sorted(cache_files):
+            if cache_size <= self.size_cap:
+                break
+            os.remove(file_path)
+            cache_size -= file_size
+            evicted += 1
+
+        logger.info("Payload cache evicted", files=evicted, size=cache_size, size_cap=self.size_cap)
+
+    @staticmethod
+    def _load(file_path):
+        """Load a json cache file"""
+        if not os.path.isfile(file_path):
+            return None
+
+        try:
+            with open(file_path, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warn("Problem reading payload cache", path=file_path, error=str(e))
+            return None
+
+    @staticmethod
+    def _write(file_path, content):
+        """Write a json cache file"""
+        tmp_file_path = "%s.tmp" % file_path
+        with open(tmp_file_path, 'w') as f:
+            json.dump(content, f, separators=(',', ':'))
+
+        # Rename so a partial file is never read
+        os.rename(tmp_file_path, file_path)
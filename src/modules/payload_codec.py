@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#pylint: disable=relative-import,invalid-name
+"""PayloadCodec
+
+Compression used for the payloads sent to hosts.
+
+Codecs are formatted as 'name' or 'name:level' (gzip, zstd, lz4 or none).
+Gzip is done within python, zstd and lz4 use their command line tools.
+Compressed fragments of every codec can be concatenated, the remote tar
+decompresses the payload with the same tool.
+
+Gzip is always available on hosts since tar uses it, hosts without the
+tool of the selected codec get gzip payloads.
+"""
+
+import gzip
+from distutils.spawn import find_executable
+from subprocess import Popen, PIPE # nosec
+
+import logger
+
+FALLBACK_CODEC = "gzip"
+CHUNK_SIZE = 1024 * 1024
+
+# name -> extension, tool needed on both ends, default level, max level
+CODECS = {
+    'gzip': {'extension': ".tar.gz", 'binary': None, 'level': 9, 'max_level': 9},
+    'zstd': {'extension': ".tar.zst", 'binary': "zstd", 'level': 3, 'max_level': 19},
+    'lz4': {'extension': ".tar.lz4", 'binary': "lz4", 'level': 1, 'max_level': 12},
+    'none': {'extension': ".tar", 'binary': None, 'level': 0, 'max_level': 0}
+}
+
+# Remote commands to extract a payload, older tars have no zstd or lz4 flag
+EXTRACT_CMDS = {
+    'gzip': "tar -zxvf {tar} -C {location}",
+    'zstd': "tar -I zstd -xvf {tar} -C {location}",
+    'lz4': "tar -I lz4 -xvf {tar} -C {location}",
+    'none': "tar -xvf {tar} -C {location}"
+}
+
+
+class PayloadCodec(object):
+    """Class for a single codec and level"""
+
+    def __init__(self, name, level=None):
+        """Init of a payload codec
+        :param name: Codec name
+        :param level: Compression level, codec default if None
+        """
+        self.name = name
+        self.level = CODECS[name]['level'] if level is None else level
+
+    def __str__(self):
+        return "%s:%s" % (self.name, self.level) if CODECS[self.name]['max_level'] else self.name
+
+    @property
+    def extension(self):
+        """Payload file extension"""
+        return CODECS[self.name]['extension']
+
+    @property
+    def fragment_ext(self):
+        """Fragment file extension, fragments differ by level"""
+        return ".%s%s" % (self.level, self.extension) if CODECS[self.name]['max_level'] else self.extension
+
+    @property
+    def binary(self):
+        """Tool needed on both ends, None if tar can use the codec on its own"""
+        return CODECS[self.name]['binary']
+
+    def get_extract_cmd(self, tar, location):
+        """Remote command to extract a payload"""
+        return EXTRACT_CMDS[self.name].format(tar=tar, location=location)
+
+    def compress(self, src_file, size, dest_path):
+        """Compress size bytes of a file into a new fragment
+
+        Output only depends on the content so fragments stay the same.
+        """
+        with open(dest_path, 'wb') as dest_file:
+            if self.name == 'none':
+                copy_bytes(src_file, dest_file, size)
+            elif self.name == 'gzip':
+                gzip_file = gzip.GzipFile('', 'wb', self.level, dest_file, 0)
+                try:
+                    copy_bytes(src_file, gzip_file, size)
+                finally:
+                    gzip_file.close()
+            else:
+                proc = Popen([self.binary, '-q', '-c', '-%d' % self.level], # nosec
+                             shell=False, stdin=PIPE, stdout=dest_file)
+                try:
+                    copy_bytes(src_file, proc.stdin, size)
+                finally:
+                    proc.stdin.close()
+                    if proc.wait() > 0:
+                        logger.errorout("Problem compressing payload", codec=str(self), path=dest_path)
+
+
+def copy_bytes(src_file, dest_file, size):
+    """Copy size bytes between files"""
+    while size > 0:
+        chunk = src_file.read(min(size, CHUNK_SIZE))
+        if not chunk:
+            break
+        dest_file.write(chunk)
+        size -= len(chunk)
+
+
+def get_codec(codec_str):
+    """Get codec from a 'name[:level]' string, errors out if not valid"""
+    name, _sep, level = codec_str.strip("'\"").partition(':')
+
+    if name not in CODECS:
+        logger.errorout("Unknown payload codec", codec=codec_str, codecs=sorted(CODECS))
+
+    try:
+        codec = PayloadCodec(name, int(level) if level else None)
+    except ValueError:
+        logger.errorout("Payload codec level is not a number", codec=codec_str)
+
+    if not 0 <= codec.level <= CODECS[name]['max_level']:
+        logger.errorout("Payload codec level out of range", codec=codec_str,
+                        max_level=CODECS[name]['max_level'])
+
+    if codec.binary and not find_executable(codec.binary):
+        logger.errorout("Payload codec not found", codec=codec_str, binary=codec.binary)
+
+    return codec
+
+
+def get_host_codec(codec, remote_binaries, hostname):
+    """Codec used for a host based on the binaries found on it"""
+    if not codec.binary or codec.binary in remote_binaries:
+        return codec
+
+    logger.warn("Payload codec not found on host, using fallback", hostname=hostname,
+                codec=str(codec), fallback=FALLBACK_CODEC)
+
+    return PayloadCodec(FALLBACK_CODEC)
+
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#pylint: disable=relative-import,invalid-name
+"""PayloadGroups
+
+Groups identical app builds of every host.
+
+Apps are grouped by their payload cache key: app, commit id, install method
+and the values of the variables their templates reference.  Each group is
+built and packaged once for every payload codec and remote version of its
+hosts, the other apps of the group copy the build info.  Apps that can not
+be cached, i.e. templates that can not be checked, get a group of their
+own.
+"""
+
+import os
+from collections import OrderedDict
+
+
+def get_build_key(profile, app):
+    """Key of everything used to build the app, besides templating"""
+    method_info = app.method_info
+    install_ignore = method_info.get('install_ignore') if not app.is_added else None
+
+    return [profile.apps_folder,
+            app.name,
+            app.app_clean,
+            method_info['path'],
+            app.update_method_is_copy,
+            method_info.get('skip_templating'),
+            method_info.get('no_appetite_changes'),
+            install_ignore]
+
+
+def get_build_apps(apps_meta):
+    """Apps that need to be built, in build order"""
+    return sorted([app for app in apps_meta if app.updated], key=lambda app: app.app)
+
+
+class PayloadGroups(object):
+    """Class to group identical app builds"""
+
+    def __init__(self):
+        """Init of the payload groups"""
+
+        # build id -> group
+        self.groups = OrderedDict()
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __contains__(self, cache_key):
+        return cache_key in self.groups
+
+    def add(self, cache_key, codec, base_key, base_files, host, profile, app, apps_meta):
+        """Add an app to the group of its build
+
+        The first app added to a group is the one built.
+
+        :param base_key: Key of the remote files the app is sent as a delta
+                         against, None for the whole app
+        :return: (build id, base key, codec name) replaced by the fragment
+                 once built
+        """
+        build_id = cache_key if cache_key else len(self.groups)
+
+        group = self.groups.get(build_id)
+        if not group:
+            group = self.groups[build_id] = {'cache_key': cache_key,
+                                             'apps': [],
+                                             'codecs': OrderedDict(),
+                                             'bases': OrderedDict()}
+
+        group['apps'].append((host, profile, app, apps_meta))
+        group['codecs'][str(codec)] = codec
+        group['bases'][base_key] = base_files
+
+        return build_id, base_key, str(codec)
+
+    def get_commit_paths(self):
+        """Paths of the apps built from each commit id
+
+        :return: OrderedDict commit id -> [app paths]
+        """
+        commit_paths = OrderedDict()
+
+        for group in self.groups.values():
+            _host, profile, app, _apps_meta = group['apps'][0]
+            commit_paths.setdefault(app.commit_id, []).append(os.path.join(profile.apps_folder, app.name))
+
+        return commit_paths
@@ -5,6 +5,10 @@
 Handle function associated with the appetite repository.
 """
 import os
+import re
+import tarfile
+import binascii
+from subprocess import Popen, PIPE # nosec
 import helpers
 import consts
 import logger
@@ -23,19 +27,150 @@ COMMIT_KEYS = {
     'commit_notes': "%N"
 }
 
+# Fields of the commit log are read in a single call, the separators around
+# the fields keep their whitespace
+COMMIT_LOG_SEPARATOR = "\x1e"
+COMMIT_LOG_FORMAT = "%%x1e%s%%x1e" % "%x1e".join(COMMIT_KEYS.values())
+
+# Commit ids that can be memoized, branches and HEAD can move
+COMMIT_ID_REGEX = re.compile(r'^[0-9a-f]{4,40}$')
+
+# Commit logs and resolved ids memoized, a memo is cleared once full
+MAX_MEMOIZED_COMMITS = 4096
+
+# Missing blobs fetched at once from a partial clone
+FETCH_BLOBS_CHUNK = 1000
+
+# First git version able to fetch without writing FETCH_HEAD
+GIT_NO_WRITE_FETCH_HEAD_VERSION = (2, 29)
+GIT_VERSION_REGEX = re.compile(r'(\d+)\.(\d+)')
+
+# Tree entry modes of regular files and folders
+BLOB_MODES = ['100644', '100755']
+TREE_MODE = '40000'
+
+# Links followed within a link target before giving up (same as SYMLOOP_MAX)
+MAX_LINK_DEPTH = 8
+
+
+def add_memo(memo, key, value):
+    """Memoize a value, clears the memo first if it is full"""
+    if len(memo) >= MAX_MEMOIZED_COMMITS:
+        memo.clear()
+    memo[key] = value
+
+
+class GitObjectReader(object):
+    """Reads objects from a repo through a single git process
+
+    A `git cat-file --batch` process is started on first use and kept for
+    every later read, objects are read without a process for each call.
+    """
+
+    def __init__(self, repo_path):
+        """Git object reader init
+        :param repo_path: Location of the repo
+        """
+        self.repo_path = repo_path
+        self._proc = None
+
+    def __getstate__(self):
+        # Each process starts its own reader
+        return {'repo_path': self.repo_path, '_proc': None}
+
+    def read(self, rev):
+        """Read an object
+
+        :param rev: Object name (commit id, 'commit:path', 'branch^{commit}')
+        :return: (object id, type, content) or None if not found
+        """
+        if '\n' in rev:
+            return None
+
+        if self._proc is None:
+            with open(os.devnull, 'w') as devnull:
+                self._proc = Popen(['git', 'cat-file', '--batch'], # nosec
+                                   shell=False, stdin=PIPE, stdout=PIPE, stderr=devnull, cwd=self.repo_path)
+
+        try:
+            self._proc.stdin.write("%s\n" % rev)
+            self._proc.stdin.flush()
+
+            header = self._proc.stdout.readline().split()
+            if len(header) != 3:
+                # Missing or ambiguous
+                return None
+
+            object_id, object_type, size = header
+            content = self._proc.stdout.read(int(size))
+            self._proc.stdout.read(1)
+        except (IOError, ValueError) as e:
+            self.close()
+            logger.errorout("Problem reading git object", rev=rev, error=str(e), path=self.repo_path)
+
+        return object_id, object_type, content
+
+    def resolve(self, rev):
+        """Object id of a rev or None if not found"""
+        git_object = self.read(rev)
+        return git_object[0] if git_object else None
+
+    def read_tree(self, rev):
+        """Entries of a tree
+
+        :return: [(mode, name, object id)] or None if not a tree
+        """
+        git_object = self.read(rev)
+        if not git_object or git_object[1] != 'tree':
+            return None
+
+        content = git_object[2]
+        entries = []
+        index = 0
+        while index < len(content):
+            name_end = content.index('\0', index)
+            mode, name = content[index:name_end].split(' ', 1)
+            entries.append((mode, name, binascii.hexlify(content[name_end + 1:name_end + 21])))
+            index = name_end + 21
+
+        return entries
+
+    def walk_blobs(self, rev, path=""):
+        """Regular files within a tree, in repo order
+
+        :return: generator of (path relative to the tree, object id)
+        """
+        for mode, name, object_id in self.read_tree(rev) or []:
+            entry_path = os.path.join(path, name)
+            if mode == TREE_MODE:
+                for blob in self.walk_blobs(object_id, entry_path):
+                    yield blob
+            elif mode in BLOB_MODES:
+                yield entry_path, object_id
+
+    def close(self):
+        """Stop the git process, refs read after a pull are current"""
+        if self._proc is not None:
+            self._proc.stdin.close()
+            self._proc.stdout.close()
+            self._proc.wait()
+            self._proc = None
+
 
 class RepoManager(object):
     """Main class to handle appetite repos
     """
     def __init__(self, _reponame, _repo_url, _repo_branch,
-                 _repo_path, _scratch_folder, _manifest):
+                 _repo_path, _scratch_folder, _manifest, _partial_clone=False, _sparse_paths=None):
         """Repo Manager init
         :param _reponame: Name of repo
         :param _repo_url: URL of repo
         :param _repo_branch: Repo branch
         :param _repo_path: Local location of repo
         :param _scratch_folder: Abs path of scratch folder
-        :param _manifest: Manifest to monitor and parse
+        :param _manifest: Manifest(s) to monitor and parse
+        :param _partial_clone: Clone without blobs, fetched when needed
+        :param _sparse_paths: Paths checked out with a partial clone
         """
         self.paths = {
             'scratch_path': _scratch_folder,
@@ -44,13 +179,15 @@ class RepoManager(object):
 
         self.paths['repo_path'] = os.path.join(self.paths['absolute_path'],
                                                _reponame)
+        self.manifest = _manifest if isinstance(_manifest, list) else [_manifest]
+
         self.paths['manifest_repo'] = os.path.join(self.paths['repo_path'],
                                                    consts.CONFIG_PATH_NAME,
-                                                   _manifest)
-
-        self.manifest = _manifest
+                                                   self.manifest[0])
         self.url = _repo_url
         self.branch = _repo_branch
+        self.partial_clone = _partial_clone
+        self.sparse_paths = _sparse_paths if _sparse_paths else [consts.CONFIG_PATH_NAME]
 
         self.track = helpers.get_track()
 
@@ -58,6 +195,17 @@ class RepoManager(object):
         self.reponame = ""
         self.prev_commit = ""
 
+        # Full commit id -> commit log and abbreviated commit id -> full commit id
+        self._commit_logs = {}
+        self._commit_aliases = {}
+
+        # Full commit id -> (location, repo paths) of the paths exported once
+        self._staged_commits = {}
+
+        self._git_version = None
+
+        self.object_reader = GitObjectReader(self.paths['repo_path'])
+
         repo_split = _repo_url.split('/')
         if len(repo_split) > 1:
             self.project = repo_split[-2]
@@ -73,19 +221,31 @@ class RepoManager(object):
                 self.delete_repo()
 
             if not os.path.exists(self.paths['repo_path']):
-                logger.info("Starting Repo Cloning", track=self.track)
+                logger.info("Starting Repo Cloning", track=self.track, partial_clone=self.partial_clone)
+
+                # Partial clones only have the trees, blobs are fetched when needed
+                clone_options = "--filter=blob:none --sparse " if self.partial_clone else ""
 
                 output, rc = helpers.run(
-                    "git clone -b %s %s" % (self.branch, self.url),
+                    "git clone %s-b %s %s" % (clone_options, self.branch, self.url),
                     self.paths['absolute_path'])
 
                 if rc > 0:
                     self.delete_repo()
                     logger.error("Pulling_repo", error=output, path=self.paths['repo_path'])
                     return -1
-                return 1
+                repo_status = 1
             else:
-                return 0
+                repo_status = 0
+
+            # Only configs and the apps folders are checked out
+            if self.partial_clone:
+                output, rc = self.run_command(['git', 'sparse-checkout', 'set'] + self.sparse_paths)
+                if rc > 0:
+                    logger.error("Problem setting sparse checkout", error=output, paths=self.sparse_paths)
+                    return -1
+
+            return repo_status
         except Exception as e:
             logger.errorout("Pulling_repo", err_msg=e.message,
                             error="Error pulling repo", path=self.paths['repo_path'])
@@ -155,44 +315,329 @@ class RepoManager(object):
 
         return True
 
+    def resolve_commit_id(self, commit_id=None):
+        """Full commit id of the provided commit id or the branch"""
+        if commit_id in self._commit_aliases:
+            return self._commit_aliases[commit_id]
+
+        checkout_id = self.get_checkout_id(commit_id)
+
+        output = self.object_reader.resolve('%s^{commit}' % checkout_id)
+
+        if not output:
+            logger.errorout("resolve_commit_id", desc="Problem resolving commit id",
+                            commit_id=checkout_id, path=self.paths['repo_path'],
+                            track=self.track)
+
+        if commit_id and COMMIT_ID_REGEX.match(commit_id) and output.startswith(commit_id):
+            add_memo(self._commit_aliases, commit_id, output)
+
+        return output
+
+    def archive(self, commit_id, rel_paths):
+        """Entries of paths at a commit id, read from the object database
+
+        No checkout is done so apps at different commit ids can be read by
+        parallel processes.
+
+        :return: generator of (tar, tarinfo), nothing if a path is not found
+        """
+
+        # Same file permissions as a checkout
+        proc = Popen(['git', '-c', 'tar.umask=user', 'archive', '--format=tar', commit_id, '--'] + rel_paths, # nosec
+                     shell=False, stdout=PIPE, stderr=PIPE, cwd=self.paths['repo_path'])
+        try:
+            try:
+                tar = tarfile.open(fileobj=proc.stdout, mode='r|')
+            except tarfile.ReadError:
+                # Nothing is archived if a path is not found
+                return
+
+            for tarinfo in tar:
+                yield tar, tarinfo
+        finally:
+            proc.stdout.close()
+            proc.stderr.close()
+            proc.wait()
+
+    def archive_path(self, commit_id, path):
+        """Entries of a path at a commit id
+
+        :return: generator of (tar, tarinfo) with names relative to the path,
+                 nothing if the path is not found
+        """
+        rel_path = os.path.relpath(path, self.paths['repo_path'])
+        prefix = "%s/" % rel_path
+
+        for tar, tarinfo in self.archive(commit_id, [rel_path]):
+            if not tarinfo.name.startswith(prefix):
+                continue
+
+            tarinfo.name = tarinfo.name[len(prefix):]
+            yield tar, tarinfo
+
+    def extract(self, commit_id, tar, tarinfo, repo_name, dest_path, _depth=0):
+        """Extract an archive entry
+
+        Links are replaced by a copy of their target at the commit id, the
+        same as copying a checkout.  Targets outside of the repo or not
+        found are left out.
+
+        :param repo_name: Path of the entry in the repo
+        """
+        if not tarinfo.issym():
+            tar.extract(tarinfo, dest_path)
+            return
+
+        target = os.path.normpath(os.path.join(os.path.dirname(repo_name), tarinfo.linkname))
+        target_found = False
+
+        if _depth < MAX_LINK_DEPTH and not os.path.isabs(target) and \
+                target != '..' and not target.startswith('../'):
+            self.fetch_blobs(commit_id, [target])
+
+            prefix = "%s/" % target
+            link_name = tarinfo.name
+
+            for target_tar, target_tarinfo in self.archive(commit_id, [target]):
+                target_repo_name = target_tarinfo.name
+
+                if target_repo_name == target:
+                    target_tarinfo.name = link_name
+                elif target_repo_name.startswith(prefix):
+                    target_tarinfo.name = os.path.join(link_name, target_repo_name[len(prefix):])
+                else:
+                    continue
+
+                self.extract(commit_id, target_tar, target_tarinfo, target_repo_name, dest_path, _depth + 1)
+                target_found = True
+
+        if not target_found:
+            logger.warn("Link target not found in the repo, link left out",
+                        path=repo_name, target=tarinfo.linkname, commit_id=commit_id, track=self.track)
+
+    def get_git_version(self):
+        """Version of the git client as (major, minor), (0, 0) if unknown"""
+        if self._git_version is None:
+            output, rc = helpers.run(['git', '--version'])
+            version_match = GIT_VERSION_REGEX.search(output) if rc < 1 else None
+            self._git_version = tuple(int(num) for num in version_match.groups()) if version_match else (0, 0)
+
+        return self._git_version
+
+    def fetch_blobs(self, commit_id, rel_paths):
+        """Fetch the blobs of paths at a commit id missing from a partial clone
+
+        Missing blobs are fetched together instead of one at a time when
+        they are read.
+        """
+        if not self.partial_clone or not rel_paths:
+            return
+
+        output, rc = self.run_command(['git', 'rev-list', '--objects', '--no-walk', '--missing=print',
+                                       commit_id, '--'] + rel_paths)
+        if rc > 0:
+            logger.warn("Problem listing missing blobs", commit_id=commit_id, error=output, track=self.track)
+            return
+
+        missing_ids = [line[1:].strip() for line in output.splitlines() if line.startswith('?')]
+
+        # Blob fetches leave FETCH_HEAD to the branch fetch where git allows it
+        fetch_options = ['--no-tags', '--recurse-submodules=no', '--filter=blob:none']
+        if self.get_git_version() >= GIT_NO_WRITE_FETCH_HEAD_VERSION:
+            fetch_options.append('--no-write-fetch-head')
+
+        for index in range(0, len(missing_ids), FETCH_BLOBS_CHUNK):
+            output, rc = self.run_command(['git', '-c', 'fetch.negotiationAlgorithm=noop', 'fetch', 'origin'] +
+                                          fetch_options + missing_ids[index:index + FETCH_BLOBS_CHUNK])
+            if rc > 0:
+                logger.warn("Problem fetching blobs", commit_id=commit_id, error=output, track=self.track)
+                return
+
+        if missing_ids:
+            logger.info("Blobs fetched", commit_id=commit_id, blobs=len(missing_ids))
+
+    def stage_commit(self, commit_id, paths, stage_folder):
+        """Export the paths needed from a commit id once
+
+        Paths are read with a single archive of the commit, later exports of
+        the paths are copied from the stage.  Paths not found in the commit
+        are left out.
+
+        :param stage_folder: Folder of the staged commits
+        :return: Number of paths found
+        """
+        full_commit_id = self.resolve_commit_id(commit_id)
+        self.get_commit_log(full_commit_id)
+
+        rel_paths = sorted(set(os.path.relpath(path, self.paths['repo_path']) for path in paths))
+
+        found_paths = [rel_path for rel_path in rel_paths
+                       if self.object_reader.resolve('%s:%s' % (full_commit_id, rel_path))]
+
+        self.fetch_blobs(full_commit_id, found_paths)
+
+        stage_path = os.path.join(stage_folder, full_commit_id)
+        if found_paths:
+            for tar, tarinfo in self.archive(full_commit_id, found_paths):
+                self.extract(full_commit_id, tar, tarinfo, tarinfo.name, stage_path)
+
+        self._staged_commits[full_commit_id] = (stage_path, set(rel_paths))
+
+        return len(found_paths)
+
+    def clear_staged_commits(self):
+        """Forget the staged commits, their stage folder was deleted"""
+        self._staged_commits = {}
+
+    def export_path(self, commit_id, path, dest_path):
+        """Copy a path of the repo at a commit id without a checkout
+
+        :return: (commit log of the commit id, True if the path was found)
+        """
+        full_commit_id = self.resolve_commit_id(commit_id)
+        commit_log = self.get_commit_log(full_commit_id)
+
+        rel_path = os.path.relpath(path, self.paths['repo_path'])
+        stage_path, staged_paths = self._staged_commits.get(full_commit_id, (None, ()))
+
+        if rel_path in staged_paths:
+            staged_path = os.path.join(stage_path, rel_path)
+            if not os.path.isdir(staged_path):
+                return commit_log, False
+
+            helpers.copy_tree(staged_path, dest_path)
+            return commit_log, True
+
+        path_found = False
+        for tar, tarinfo in self.archive_path(full_commit_id, path):
+            self.extract(full_commit_id, tar, tarinfo, os.path.join(rel_path, tarinfo.name), dest_path)
+            path_found = True
+
+        return commit_log, path_found
+
+    def read_files(self, commit_id, path, name_regex):
+        """Content of the files within a path at a commit id without a checkout
+
+        :return: generator of (file path, content) for files with a name
+                 matching the regex
+        """
+        rel_path = os.path.relpath(path, self.paths['repo_path'])
+        full_commit_id = self.resolve_commit_id(commit_id)
+
+        self.fetch_blobs(full_commit_id, [rel_path])
+
+        for file_path, object_id in self.object_reader.walk_blobs('%s:%s' % (full_commit_id, rel_path)):
+            if re.search(name_regex, os.path.basename(file_path)):
+                yield file_path, self.object_reader.read(object_id)[2]
+
     def get_commit_log(self, commit_id=None):
-        """Get the current commit log
+        """Get the commit log of the provided commit id or the current one
+
+        Each commit is only read once, later lookups use the memoized log.
         """
+        is_commit_id = commit_id and COMMIT_ID_REGEX.match(commit_id)
+        full_commit_id = commit_id if is_commit_id and len(commit_id) == 40 else \
+            self._commit_aliases.get(commit_id)
+
+        if full_commit_id in self._commit_logs:
+            return dict(self._commit_logs[full_commit_id])
+
         try:
-            log_object = {}
-            for key, value in COMMIT_KEYS.items():
-                git_command = ['git', 'log', '-1', '--pretty=\'%s\'' % value]
-                if commit_id:
-                    git_command.insert(2, commit_id)
+            git_command = ['git', 'log', '-1', '--pretty=format:%s' % COMMIT_LOG_FORMAT]
+            if commit_id:
+                git_command.insert(2, commit_id)
+
+            stdout, rc = helpers.run(git_command,
+                                     self.paths['repo_path'])
 
-                stdout, _rc = helpers.run(git_command,
-                                          self.paths['repo_path'])
+            values = stdout.split(COMMIT_LOG_SEPARATOR)[1:-1]
+            if rc > 0 or len(values) != len(COMMIT_KEYS):
+                logger.errorout("get_commit_log", error="Problem getting commit log",
+                                error_msg=stdout, commit_id=commit_id, track=self.track)
 
-                output = helpers.filter_content(stdout)
+            log_object = {}
+            for key, value in zip(COMMIT_KEYS.keys(), values):
+                # Same output as the quoted format of a single key
+                output = helpers.filter_content("'%s'" % value)
                 if key in consts.RENAME_COMMIT_LOG_KEYS:
                     key = consts.RENAME_COMMIT_LOG_KEYS[key]
                 log_object[key] = output
 
             log_object['project'] = self.project
             log_object['reponame'] = self.reponame
-
-            return log_object
         except Exception as e:
             logger.errorout("get_commit_log", error="Problem getting commit log",
                             error_msg=e.message, track=self.track)
 
+        full_commit_id = log_object['app_commit_id']
+        add_memo(self._commit_logs, full_commit_id, log_object)
+        if is_commit_id and full_commit_id.startswith(commit_id):
+            add_memo(self._commit_aliases, commit_id, full_commit_id)
+
+        return dict(log_object)
+
+    def get_file_content(self, commit_id, file_path):
+        """Get the content of a file at a commit id without checking it out
+
+        :return: content or None if the file or commit is not found
+        """
+        git_object = self.object_reader.read('%s:%s' % (commit_id, file_path))
+
+        if not git_object or git_object[1] != 'blob':
+            logger.warn("Problem getting file from repo", commit_id=commit_id,
+                        path=file_path, track=self.track)
+            return None
+
+        return git_object[2]
+
+    def get_changed_files(self, from_commit_id, to_commit_id=None):
+        """List of files changed between two commit ids
+
+        :return: list of file paths relative to the repo or None if the diff failed
+        """
+        output, rc = self.run_command(['git', 'diff', '--name-only', from_commit_id,
+                                       self.get_checkout_id(to_commit_id)])
+
+        if rc > 0:
+            logger.warn("Problem getting changed files from repo", commit_id=from_commit_id,
+                        error=output, track=self.track)
+            return None
+
+        return [line for line in output.splitlines() if line]
+
     def check_for_update(self, dry_run=False):
         """Checks for updates to the repo and if the manifest has changed
         """
         self.set_commit_id()
 
+        prev_manifest_ids = self.get_manifest_ids()
+
         # If dry run do not pull from external repo
-        stdout, _rc = helpers.run(
-            "git pull",
-            self.paths['repo_path'],
-            dry_run)
+        if self.partial_clone:
+            stdout, rc = helpers.run(['git', 'fetch', 'origin', self.branch],
+                                     self.paths['repo_path'],
+                                     dry_run)
+
+            if rc < 1 and not dry_run:
+                output, rc = self.run_command(['git', 'reset', '-q', '--hard', 'FETCH_HEAD'])
+            else:
+                output = stdout
+
+            if rc > 0:
+                logger.error("Pulling_repo", error=output, branch=self.branch, path=self.paths['repo_path'])
+                return {'triggered': False, 'failed': True, 'output': helpers.filter_content(output)}
+        else:
+            stdout, _rc = helpers.run(
+                "git pull",
+                self.paths['repo_path'],
+                dry_run)
 
-        manifest_found = next((True for manifest_file in self.manifest if manifest_file in stdout), False)
+        # Objects are read again with the pulled refs
+        self.object_reader.close()
+
+        # Manifests changed if their blobs changed
+        manifest_found = self.get_manifest_ids() != prev_manifest_ids
 
         commit_log = self.get_commit_log()
         self.track["push_commit_id"] = commit_log['app_commit_id']
@@ -200,10 +645,16 @@ class RepoManager(object):
 
         filtered_output = helpers.filter_content(stdout)
 
-        return {'triggered': manifest_found, 'output': filtered_output}
+        return {'triggered': manifest_found, 'failed': False, 'output': filtered_output}
+
+    def get_manifest_ids(self):
+        """Blob ids of the manifests at the current commit, None if not found"""
+        return [self.object_reader.resolve("HEAD:%s/%s" % (consts.CONFIG_PATH_NAME, manifest_file))
+                for manifest_file in self.manifest]
 
     def delete_repo(self):
         """Deletes repo
         """
         logger.info('delete', path=self.paths['repo_path'], track=self.track)
+        self.object_reader.close()
         helpers.delete_path(self.paths['repo_path'])
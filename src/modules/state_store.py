@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+#pylint: disable=relative-import,invalid-name
+"""StateStore
+
+Local state of the fleet kept in a single sqlite file within the meta folder.
+
+The local copies of the remote metas are synced into the store, the apps
+installed on each host are indexed by host, app, method and commit id.
+Metas are only parsed when their file changed since the last sync, every
+change of the installed apps is kept as history.
+
+The meta files stay the source of truth since they are compared against
+the hosts, the store can be deleted at any time.
+"""
+
+import os
+import json
+import sqlite3
+
+import consts
+import helpers
+import logger
+from appetite_core import AppetiteHost
+
+STATE_STORE_VERSION = 1
+
+SCHEMA = [
+    "CREATE TABLE metas (hostname TEXT, meta_name TEXT, size INTEGER, mtime REAL, checksum TEXT, "
+    "PRIMARY KEY (hostname, meta_name))",
+    "CREATE TABLE apps (hostname TEXT, meta_name TEXT, position INTEGER, app TEXT, method_name TEXT, "
+    "commit_id TEXT, path TEXT, meta TEXT)",
+    "CREATE INDEX apps_host ON apps (hostname, meta_name, position)",
+    "CREATE INDEX apps_app ON apps (app, commit_id)",
+    "CREATE TABLE history (id INTEGER PRIMARY KEY, timestamp TEXT, hostname TEXT, meta_name TEXT, "
+    "app TEXT, method_name TEXT, commit_id TEXT, status TEXT)",
+    "CREATE INDEX history_host ON history (hostname)",
+    "CREATE INDEX history_app ON history (app)"
+]
+
+APP_COLUMNS = ['hostname', 'meta_name', 'app', 'method_name', 'commit_id', 'path']
+HISTORY_COLUMNS = ['timestamp', 'hostname', 'meta_name', 'app', 'method_name', 'commit_id', 'status']
+
+
+def get_store_path(meta_folder):
+    """Location of the state store"""
+    return os.path.join(meta_folder, consts.STATE_STORE_FILENAME)
+
+
+def get_meta_rows(metas_content):
+    """Indexed values of the apps in a meta
+
+    :return: [(app, method name, commit id, path, meta json)]
+    """
+    rows = []
+    for meta_data in metas_content:
+        meta_json = json.dumps(meta_data, sort_keys=True)
+        app = AppetiteHost.create_app_from_object(None, None, meta_data)
+        method_info = app.method_info if app.method_info else {}
+        rows.append((app.app, method_info.get('name'), app.commit_id, method_info.get('path'), meta_json))
+    return rows
+
+
+def get_changes(old_rows, new_rows):
+    """Changes between two versions of the apps installed on a host
+
+    Apps are matched in order by app and method like AppDiff.
+
+    :return: [(app, method name, commit id, status)]
+    """
+    old_apps = {}
+    for app, method_name, commit_id in old_rows:
+        old_apps.setdefault((app, method_name), []).append(commit_id)
+
+    changes = []
+    for app, method_name, commit_id, _path, _meta_json in new_rows:
+        old_commit_ids = old_apps.get((app, method_name))
+        if not old_commit_ids:
+            changes.append((app, method_name, commit_id, consts.META_APP_ADDED))
+        elif old_commit_ids.pop(0) != commit_id:
+            changes.append((app, method_name, commit_id, consts.META_APP_CHANGED))
+
+    for (app, method_name), commit_ids in sorted(old_apps.items()):
+        changes.extend((app, method_name, commit_id, consts.META_APP_DELETED) for commit_id in commit_ids)
+
+    return changes
+
+
+class StateStore(object):
+    """Class to sync and query the local fleet state"""
+
+    def __init__(self, store_path):
+        """Init of the state store
+        :param store_path: Location of the sqlite file, created if needed
+        """
+        self.store_path = store_path
+        self._conn = None
+
+    def __getstate__(self):
+        # Connections are not shared with the host processes
+        return {'store_path': self.store_path, '_conn': None}
+
+    @property
+    def conn(self):
+        """Connection to the store, the schema is recreated if outdated"""
+        if self._conn is None:
+            helpers.create_path(self.store_path)
+            self._conn = sqlite3.connect(self.store_path, timeout=30)
+
+            if self._conn.execute("PRAGMA user_version").fetchone()[0] != STATE_STORE_VERSION:
+                with self._conn:
+                    for table in ['metas', 'apps', 'history']:
+                        self._conn.execute("DROP TABLE IF EXISTS %s" % table)
+                    for statement in SCHEMA:
+                        self._conn.execute(statement)
+                    self._conn.execute("PRAGMA user_version = %d" % STATE_STORE_VERSION)
+        return self._conn
+
+    def close(self):
+        """Close the connection to the store"""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def sync_meta(self, hostname, meta_name, meta_file):
+        """Sync the local copy of a remote meta into the store
+
+        The meta is only parsed if the file changed since the last sync.
+
+        :return: Number of app changes recorded
+        """
+        conn = self.conn
+
+        if not os.path.isfile(meta_file):
+            with conn:
+                self._clear_meta(hostname, meta_name)
+            return 0
+
+        file_stat = os.stat(meta_file)
+        stored = conn.execute("SELECT size, mtime, checksum FROM metas WHERE hostname = ? AND meta_name = ?",
+                              (hostname, meta_name)).fetchone()
+
+        if stored and stored[:2] == (file_stat.st_size, file_stat.st_mtime):
+            return 0
+
+        checksum = helpers.get_file_checksum(meta_file)
+
+        if stored and stored[2] == checksum:
+            with conn:
+                conn.execute("UPDATE metas SET size = ?, mtime = ? WHERE hostname = ? AND meta_name = ?",
+                             (file_stat.st_size, file_stat.st_mtime, hostname, meta_name))
+            return 0
+
+        try:
+            with open(meta_file) as f:
+                metas_master = json.load(f)
+            new_rows = get_meta_rows(metas_master['content'] if 'content' in metas_master else metas_master)
+        except Exception as exception:
+            logger.error("Problems loading meta file",
+                         error=str(exception),
+                         path=meta_file)
+            with conn:
+                self._clear_meta(hostname, meta_name)
+            return 0
+
+        old_rows = conn.execute("SELECT app, method_name, commit_id FROM apps "
+                                "WHERE hostname = ? AND meta_name = ? ORDER BY position",
+                                (hostname, meta_name)).fetchall()
+
+        changes = get_changes(old_rows, new_rows)
+        timestamp = helpers.get_utc()
+
+        with conn:
+            self._clear_meta(hostname, meta_name)
+            conn.execute("INSERT INTO metas VALUES (?, ?, ?, ?, ?)",
+                         (hostname, meta_name, file_stat.st_size, file_stat.st_mtime, checksum))
+            conn.executemany("INSERT INTO apps VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             [(hostname, meta_name, position) + row for position, row in enumerate(new_rows)])
+            conn.executemany("INSERT INTO history (timestamp, hostname, meta_name, app, method_name, commit_id, "
+                             "status) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             [(timestamp, hostname, meta_name) + change for change in changes])
+
+        return len(changes)
+
+    def _clear_meta(self, hostname, meta_name):
+        """Remove the synced meta of a host, history is kept"""
+        self.conn.execute("DELETE FROM metas WHERE hostname = ? AND meta_name = ?", (hostname, meta_name))
+        self.conn.execute("DELETE FROM apps WHERE hostname = ? AND meta_name = ?", (hostname, meta_name))
+
+    def get_metas(self, hostname, meta_name):
+        """Apps installed on a host in meta order
+
+        :return: list of meta objects or None if the host has no meta
+        """
+        if not self.conn.execute("SELECT 1 FROM metas WHERE hostname = ? AND meta_name = ?",
+                                 (hostname, meta_name)).fetchone():
+            return None
+
+        return [json.loads(meta_json) for (meta_json,) in self.conn.execute(
+            "SELECT meta FROM apps WHERE hostname = ? AND meta_name = ? ORDER BY position",
+            (hostname, meta_name))]
+
+    def find_hosts(self, app, commit_id=None):
+        """Hosts with an app installed, optionally at a commit id (or its prefix)"""
+        rows = self.conn.execute("SELECT %s FROM apps WHERE app = ? ORDER BY hostname, meta_name, position" %
+                                 ", ".join(APP_COLUMNS), (app,))
+
+        return [dict(zip(APP_COLUMNS, row)) for row in rows
+                if not commit_id or (row[4] or "").startswith(commit_id)]
+
+    def get_history(self, app=None, hostname=None):
+        """Recorded changes of the installed apps, oldest first"""
+        where = [(column, value) for column, value in [('app', app), ('hostname', hostname)] if value]
+        query = "SELECT %s FROM history" % ", ".join(HISTORY_COLUMNS)
+        if where:
+            query += " WHERE %s" % " AND ".join("%s = ?" % column for column, _value in where)
+
+        return [dict(zip(HISTORY_COLUMNS, row)) for row in self.conn.execute(
+            query + " ORDER BY id", [value for _column, value in where])]
@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+# pylint: disable=invalid-name,no-self-use,missing-returns-doc,missing-type-doc,wrong-import-position
+"""Appetite benchmarks
+
+Micro benchmarks for the parts of appetite that scale with the size of the
+fleet and the manifest.  These do not use ssh or repo calls.
+
+Use:
+python benchmark.py
+python benchmark.py host_matching
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import random
+import resource
+import subprocess  # nosec
+from distutils.spawn import find_executable
+
+TEST_PATH = os.path.dirname(os.path.realpath(__file__))
+SCRIPT_PATH = TEST_PATH.replace('/tests', '/src')
+
+sys.path.insert(0, SCRIPT_PATH)
+
+import modules.helpers as Helpers  # nosec
+import modules.consts as Consts  # nosec
+import modules.app_diff as AppDiff  # nosec
+import modules.payload_codec as PayloadCodec  # nosec
+from modules.appetite_core import AppetiteHosts, AppetiteApp  # nosec
+from modules.deployment_methods import DeploymentMethodsManager  # nosec
+
+HOST_CLASSES = ["lm", "cm", "ds", "idx", "dcm", "scm", "shm", "sha", "scs"]
+NUM_SITES = 4
+NAME_FORMATTING = "splunk-{{appclass}}{{'%03d'%num}}-{{site}}c"
+
+# (rows, hosts) combinations to benchmark
+SCALE_STEPS = [(50, 500), (100, 1000), (200, 2000), (400, 4000)]
+
+# Payload codecs compared and the link speed used for the send time
+PAYLOAD_CODECS = ["none", "gzip", "gzip:6", "zstd", "zstd:9", "lz4"]
+LINK_BYTES_PER_SEC = 1000 * 1000 * 1000 / 8
+
+
+def create_hostnames(num_hosts):
+    """Create hostnames matching the test name formatting"""
+    return ["splunk-%s%03d-%dc" % (HOST_CLASSES[i % len(HOST_CLASSES)], i, i % NUM_SITES)
+            for i in range(0, num_hosts)]
+
+
+def create_rows(num_rows):
+    """Create manifest like white/black lists"""
+    rows = []
+    for i in range(0, num_rows):
+        host_class = HOST_CLASSES[i % len(HOST_CLASSES)]
+        rows.append({
+            "white_list": ["splunk-%s.*%dc$" % (host_class, i % NUM_SITES), "splunk-(cm|lm|ds)00%d.*c$" % (i % 10)],
+            "black_list": ["splunk-idx.*-%dc$" % ((i + 1) % NUM_SITES), ""]
+        })
+    return rows
+
+
+def timed(funct, *args):
+    """Time a function call in seconds"""
+    start_time = time.time()
+    result = funct(*args)
+    return time.time() - start_time, result
+
+
+def assign_check_host(rows, hostnames, ref_hostname):
+    """Assignment using raw pattern strings
+
+    Each host is also checked against the bootstrap reference host like
+    a firstrun install.
+    """
+    return sum(1 for row in rows for hostname in hostnames
+               for check_hostname in (hostname, ref_hostname)
+               if Helpers.check_host(check_hostname, row["black_list"], row["white_list"]))
+
+
+def assign_host_matcher(rows, hostnames, ref_hostname):
+    """Assignment using a precompiled matcher per row"""
+    matchers = [Helpers.HostMatcher(row["white_list"], row["black_list"]) for row in rows]
+    return sum(1 for matcher in matchers for hostname in hostnames
+               for check_hostname in (hostname, ref_hostname)
+               if matcher.check(check_hostname))
+
+
+def benchmark_host_matching():
+    """Host assignment time based on rows x hosts"""
+
+    print "%8s %8s %12s %14s %14s %8s" % ("rows", "hosts", "pairs", "check_host(s)", "matcher(s)", "speedup")
+
+    for num_rows, num_hosts in SCALE_STEPS:
+        rows = create_rows(num_rows)
+        hostnames = create_hostnames(num_hosts)
+
+        raw_time, raw_count = timed(assign_check_host, rows, hostnames, hostnames[0])
+        compiled_time, compiled_count = timed(assign_host_matcher, rows, hostnames, hostnames[0])
+
+        if raw_count != compiled_count:
+            raise Exception("Host matching mismatch; check_host: %s matcher: %s" % (raw_count, compiled_count))
+
+        print "%8d %8d %12d %14.3f %14.3f %7.1fx" % (num_rows, num_hosts, num_rows * num_hosts,
+                                                      raw_time, compiled_time,
+                                                      raw_time / max(compiled_time, 0.000001))
+
+
+class BenchmarkSource(object):
+    """Minimal appetite object needed to create hosts"""
+    meta_folder = "/tmp/appetite_benchmark/meta"
+    tars_folder = "/tmp/appetite_benchmark/tars"
+
+
+def create_host_data(hostname):
+    """Host data like pulled from the name formatting"""
+    split_name = hostname.split('-')
+    return {"appclass": split_name[1][:-3], "num": int(split_name[1][-3:]), "site": split_name[2]}
+
+
+def build_registry(hostnames):
+    """Build the host registry and lookup each host by name and class"""
+    appetite_hosts = AppetiteHosts()
+    source = BenchmarkSource()
+
+    for hostname in hostnames:
+        appetite_hosts.add_host(source, hostname, create_host_data(hostname))
+
+    return sum(1 for hostname in hostnames if appetite_hosts.get_host(hostname) and
+               appetite_hosts.get_hosts('app_class', appetite_hosts.get_host(hostname).app_class))
+
+
+def build_linear(hostnames):
+    """Same as build_registry using list scans"""
+    hosts = []
+    for hostname in hostnames:
+        if next((False for host in hosts if host["hostname"] == hostname), True):
+            host = create_host_data(hostname)
+            host["hostname"] = hostname
+            hosts.append(host)
+
+    return sum(1 for hostname in hostnames
+               if next((True for host in hosts if host["hostname"] == hostname), False) and
+               next((True for host in hosts if host["appclass"] == hostname.split('-')[1][:-3]), False))
+
+
+def benchmark_host_registry():
+    """Host registry build and lookups based on the number of hosts"""
+
+    print "%8s %14s %14s %8s" % ("hosts", "linear(s)", "indexed(s)", "speedup")
+
+    for _num_rows, num_hosts in SCALE_STEPS:
+        hostnames = create_hostnames(num_hosts)
+
+        linear_time, linear_count = timed(build_linear, hostnames)
+        indexed_time, indexed_count = timed(build_registry, hostnames)
+
+        if linear_count != indexed_count:
+            raise Exception("Host registry mismatch; linear: %s indexed: %s" % (linear_count, indexed_count))
+
+        print "%8d %14.3f %14.3f %7.1fx" % (num_hosts, linear_time, indexed_time,
+                                            linear_time / max(indexed_time, 0.000001))
+
+
+def parse_jinja(hostnames):
+    """Parse host names rendering the name formatting for each field"""
+    return [Helpers.pull_data_from_host(NAME_FORMATTING, hostname, {}) for hostname in hostnames
+            if Helpers.check_name_formatting(NAME_FORMATTING, hostname)]
+
+
+def parse_compiled(hostnames):
+    """Parse host names with the compiled name formatting"""
+    name_format = Helpers.get_name_format(NAME_FORMATTING)
+    return [name_format.parse(hostname) for hostname in hostnames if name_format.check(hostname)]
+
+
+def benchmark_hostname_parsing():
+    """Host name parsing based on the number of hosts"""
+
+    print "%8s %14s %14s %8s" % ("hosts", "jinja2(s)", "compiled(s)", "speedup")
+
+    for num_hosts in [1000, 10000]:
+        hostnames = create_hostnames(num_hosts)
+
+        jinja_time, jinja_data = timed(parse_jinja, hostnames)
+        compiled_time, compiled_data = timed(parse_compiled, hostnames)
+
+        if jinja_data != compiled_data:
+            raise Exception("Host name parsing mismatch")
+
+        print "%8d %14.3f %14.3f %7.1fx" % (num_hosts, jinja_time, compiled_time,
+                                            jinja_time / max(compiled_time, 0.000001))
+
+
+DEPLOYMENT_METHODS_CONF = """[default]
+app_name_filter = "\\.[a-zA-Z0-9]*$"
+install_inclusion_file = "install_inclusion"
+
+[StandAlone]
+path = etc/apps
+update_method = copy
+restart = True
+
+[ClusterMaster]
+path = etc/master-apps
+update_method = copy
+command = "apply_cluster_bundle"
+
+[DeploymentServer]
+path = etc/deployment-apps
+update_method = copy
+command = "reload_ds"
+"""
+
+
+class BenchmarkRepoManager(object):
+    """Minimal repo manager needed to create apps"""
+    track = {"version": "1.0"}
+
+
+def create_deployment_manager(tmp_dir):
+    """Deployment methods manager loaded from a temp deploymentmethods.conf"""
+    config_dir = os.path.join(tmp_dir, "repo", Consts.CONFIG_PATH_NAME)
+    os.makedirs(config_dir)
+
+    with open(os.path.join(config_dir, Consts.DEPLOYMENT_METHODS_FILENAME), 'w') as f:
+        f.write(DEPLOYMENT_METHODS_CONF)
+
+    return DeploymentMethodsManager("repo", "", tmp_dir, Consts.DEPLOYMENT_METHODS_FILENAME)
+
+
+def create_apps(deployment_manager, hostnames, num_apps):
+    """Create apps for each host like populate_apps_to_hosts"""
+    repo_manager = BenchmarkRepoManager()
+    methods = [dm.name for dm in deployment_manager.deployment_methods]
+
+    return [AppetiteApp(repo_manager, deployment_manager, "App%03d" % i, "App%03d" % i,
+                        methods[i % len(methods)], "12968e1", hostname, False)
+            for hostname in hostnames for i in range(0, num_apps)]
+
+
+def copy_method_info(apps):
+    """Per app copy of the deployment method values, as done before they were shared"""
+    for app in apps:
+        app.method_info = app.method_info._shared.copy()  # pylint: disable=protected-access
+    return apps
+
+
+def benchmark_app_graph():
+    """App creation time based on hosts x apps"""
+
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        deployment_manager = create_deployment_manager(tmp_dir)
+
+        print "%8s %8s %10s %14s %14s" % ("hosts", "apps", "total", "shared(s)", "copied(s)")
+
+        for num_apps, num_hosts in SCALE_STEPS[:3]:
+            hostnames = create_hostnames(num_hosts)
+
+            shared_time, apps = timed(create_apps, deployment_manager, hostnames, num_apps)
+            copy_time, _apps = timed(copy_method_info, apps)
+
+            print "%8d %8d %10d %14.3f %14.3f" % (num_hosts, num_apps, len(apps),
+                                                  shared_time, shared_time + copy_time)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def app_memory_child(num_hosts, num_apps):
+    """Build the host x app graph and print the RSS before and after (KB)"""
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        deployment_manager = create_deployment_manager(tmp_dir)
+        repo_manager = BenchmarkRepoManager()
+        methods = [dm.name for dm in deployment_manager.deployment_methods]
+        appetite_hosts = AppetiteHosts()
+        source = BenchmarkSource()
+
+        start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        for hostname in create_hostnames(num_hosts):
+            host = appetite_hosts.add_host(source, hostname, create_host_data(hostname))
+            for i in range(0, num_apps):
+                host.add_app("benchmark", AppetiteApp(repo_manager, deployment_manager,
+                                                      "App%03d" % i, "App%03d" % i,
+                                                      methods[i % len(methods)], "12968e1",
+                                                      hostname, False))
+
+        print "%d %d" % (start_rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def benchmark_app_memory():
+    """Peak RSS of the host x app graph (300 apps per host)"""
+
+    print "%8s %8s %10s %12s %12s %10s" % ("hosts", "apps", "total", "peak(MB)", "graph(MB)", "bytes/app")
+
+    for num_hosts in [1000, 5000]:
+        num_apps = 300
+
+        # Separate process so the peak RSS is only from this graph
+        output = subprocess.check_output([sys.executable, os.path.realpath(__file__),  # nosec
+                                          "app_memory_child", str(num_hosts), str(num_apps)])
+        start_rss, peak_rss = [int(value) for value in output.split()[-2:]]
+
+        num_total = num_hosts * num_apps
+        print "%8d %8d %10d %12.1f %12.1f %10d" % (num_hosts, num_apps, num_total,
+                                                   peak_rss / 1024.0, (peak_rss - start_rss) / 1024.0,
+                                                   (peak_rss - start_rss) * 1024 / num_total)
+
+
+def create_diff_apps(deployment_manager, num_apps):
+    """Apps for a host and its remote meta
+
+    A tenth of the apps are added and the remote meta has a tenth of apps
+    that were removed from the manifest.
+    """
+    repo_manager = BenchmarkRepoManager()
+    methods = [dm.name for dm in deployment_manager.deployment_methods]
+
+    apps = [AppetiteApp(repo_manager, deployment_manager, "App%05d" % i, "App%05d" % i,
+                        methods[i % len(methods)], "12968e1", "splunk-idx001-0c", False)
+            for i in range(0, num_apps)]
+
+    remote_metas = []
+    for i, app in enumerate(apps):
+        if i % 10 == 1:
+            continue
+        remote_metas.append(app.clone)
+
+    remote_metas += [AppetiteApp(repo_manager, deployment_manager, "Removed%05d" % i, "Removed%05d" % i,
+                                 methods[0], "12968e1", "splunk-idx001-0c", False)
+                     for i in range(0, num_apps / 10)]
+
+    return apps, remote_metas
+
+
+def diff_apps_scan(apps, remote_metas):
+    """Diff using list scans, as done before the indexed diff"""
+    apps_meta = []
+    remote_metas = list(remote_metas)
+
+    for app in apps:
+        app.refresh_version_info("benchmark", Consts.META_APP_UNCHANGED)
+        remote_meta = next((rmeta for rmeta in remote_metas if app.check_names(rmeta)), None)
+
+        if remote_meta:
+            if remote_meta.commit_id.startswith(app.commit_id) or app.commit_id.startswith(remote_meta.commit_id):
+                meta_to_append = app.clone
+                meta_to_append.update_app_version(app)
+            else:
+                meta_to_append = app.set_status_changed()
+            remote_metas.remove(remote_meta)
+        else:
+            meta_to_append = app.set_status_added()
+
+        apps_meta.append(meta_to_append)
+
+    delete_list = []
+    for deleted_app in remote_metas:
+        deleted_app.set_status_deleted()
+        added_app_found = next((app for app in apps_meta if app.status == Consts.META_APP_ADDED and
+                                app.name == deleted_app.name and
+                                app.method_info['path'] == deleted_app.method_info['path']), None)
+        if added_app_found:
+            added_app_found.set_status_changed()
+        else:
+            delete_list.append(deleted_app)
+
+    return apps_meta + delete_list
+
+
+def summarize_diff(apps_meta):
+    """Status per app used to compare diffs"""
+    return [(app.app, app.status) for app in apps_meta]
+
+
+def benchmark_app_diff():
+    """Remote meta diff time based on the number of apps on a host"""
+
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        deployment_manager = create_deployment_manager(tmp_dir)
+
+        print "%8s %14s %14s %8s" % ("apps", "scan(s)", "indexed(s)", "speedup")
+
+        for num_apps in [300, 1000, 3000, 6000]:
+            apps, remote_metas = create_diff_apps(deployment_manager, num_apps)
+            scan_time, scan_meta = timed(diff_apps_scan, apps, remote_metas)
+
+            apps, remote_metas = create_diff_apps(deployment_manager, num_apps)
+            indexed_time, indexed_meta = timed(AppDiff.diff_apps, apps, remote_metas,
+                                               "benchmark", "splunk-idx001-0c")
+
+            if summarize_diff(scan_meta) != summarize_diff(indexed_meta):
+                raise Exception("App diff mismatch")
+
+            print "%8d %14.3f %14.3f %7.1fx" % (num_apps, scan_time, indexed_time,
+                                                scan_time / max(indexed_time, 0.000001))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def create_payload_app(app_path, num_files):
+    """Create an app of conf like text files and a few binary files"""
+    words = ["index", "sourcetype", "disabled", "true", "false", "stanza", "props", "TRANSFORMS",
+             "REPORT", "maxDataSize", "frozenTimePeriodInSecs", "coldPath", "homePath", "thawedPath"]
+    rand = random.Random(num_files)
+
+    for i in range(0, num_files):
+        file_dir = os.path.join(app_path, "default" if i % 4 else "lookups", str(i % 10))
+        if not os.path.isdir(file_dir):
+            os.makedirs(file_dir)
+
+        with open(os.path.join(file_dir, "file%d.conf" % i), 'wb') as f:
+            if i % 20 == 0:
+                f.write(os.urandom(64 * 1024))
+            else:
+                for j in range(0, 400):
+                    f.write("[%s_%d]\n%s = %s\n" % (rand.choice(words), j, rand.choice(words),
+                                                     rand.choice(words)))
+
+
+def extract_payload(codec, payload, extract_path):
+    """Extract a payload with the remote command"""
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.call(codec.get_extract_cmd(payload, extract_path), shell=True, stdout=devnull)  # nosec
+
+
+def benchmark_payload_codec():
+    """Payload size, pack, send and extract time per payload codec"""
+
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        app_path = os.path.join(tmp_dir, "app")
+        create_payload_app(app_path, 400)
+
+        print "%8s %10s %8s %9s %9s %11s %9s" % ("codec", "size(kb)", "ratio", "pack(s)", "send(s)",
+                                                  "extract(s)", "total(s)")
+
+        raw_size = 0
+        for codec_str in PAYLOAD_CODECS:
+            name, _sep, level = codec_str.partition(':')
+            codec = PayloadCodec.PayloadCodec(name, int(level) if level else None)
+
+            if codec.binary and not find_executable(codec.binary):
+                print "%8s %10s" % (codec_str, "not found")
+                continue
+
+            payload = os.path.join(tmp_dir, "payload%s" % codec.extension)
+            pack_time, _result = timed(Helpers.create_tar_fragment, [(payload, codec)], app_path,
+                                       "app", True)
+
+            payload_size = os.path.getsize(payload)
+            if codec.name == "none":
+                raw_size = payload_size
+
+            extract_path = os.path.join(tmp_dir, "extract")
+            os.makedirs(extract_path)
+            extract_time, return_code = timed(extract_payload, codec, payload, extract_path)
+            shutil.rmtree(extract_path)
+            os.remove(payload)
+
+            if return_code:
+                raise Exception("Payload extract failed for %s" % codec_str)
+
+            send_time = float(payload_size) / LINK_BYTES_PER_SEC
+
+            print "%8s %10d %8s %9.3f %9.3f %11.3f %9.3f" % (codec_str, payload_size / 1024,
+                                                             "%.2fx" % (float(raw_size) / payload_size),
+                                                             pack_time, send_time, extract_time,
+                                                             pack_time + send_time + extract_time)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+BENCHMARKS = {
+    "app_diff": benchmark_app_diff,
+    "app_memory": benchmark_app_memory,
+    "app_graph": benchmark_app_graph,
+    "host_matching": benchmark_host_matching,
+    "host_registry": benchmark_host_registry,
+    "hostname_parsing": benchmark_hostname_parsing,
+    "payload_codec": benchmark_payload_codec
+}
+
+
+def main():
+    """Run all or selected benchmarks"""
+    if len(sys.argv) > 1 and sys.argv[1] == "app_memory_child":
+        app_memory_child(int(sys.argv[2]), int(sys.argv[3]))
+        return
+
+    selected = sys.argv[1:] if len(sys.argv) > 1 else sorted(BENCHMARKS)
+
+    for name in selected:
+        if name not in BENCHMARKS:
+            print "Unknown benchmark: %s" % name
+            sys.exit(1)
+
+        print "*********** %s: %s" % (name, BENCHMARKS[name].__doc__)
+        BENCHMARKS[name]()
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
 #!/usr/bin/env
-# pylint: disable=invalid-name,no-self-use,missing-returns-doc,missing-type-doc
+# pylint: disable=invalid-name,no-self-use,missing-returns-doc,missing-type-doc,wrong-import-position
 """Appetite test
 
 Unit test to externally test the internal functionality and logic of appetite.
@@ -13,6 +13,7 @@ import unittest
 import shutil
 import shlex
 import json
+import csv
 
 MAX_THREADS = 1
 SILENT = False
@@ -22,9 +23,19 @@ REPO_BASE_FOLDER = "repo"
 TEST_PATH = os.path.dirname(os.path.realpath(__file__))
 SCRIPT_PATH = TEST_PATH.replace('/tests', '/src')
 
+sys.path.insert(0, SCRIPT_PATH)
+
+import modules.helpers as Helpers  # nosec
+import modules.consts as Consts  # nosec
+import modules.payload_groups as PayloadGroups  # nosec
+from modules.appetite_core import AppetiteApp  # nosec
+from modules.deployment_methods import DeploymentMethodsManager  # nosec
+
 LOG_DIR = os.path.join(TEST_PATH, '.test_log')
 TMP_DIR = os.path.join(TEST_PATH, REPO_BASE_FOLDER, 'tmp')
 META_DIR = os.path.join(TEST_PATH, REPO_BASE_FOLDER, 'meta')
+CACHE_DIR = os.path.join(TEST_PATH, REPO_BASE_FOLDER, 'cache')
+APPS_REPO_DIR = os.path.join(TEST_PATH, REPO_BASE_FOLDER, 'appetite')
 LOG_FILE = os.path.join(LOG_DIR, 'appetite_repo.log')
 
 
@@ -120,6 +131,7 @@ def clean_tmp_folders():
     delete_log_dir()
     delete_path(TMP_DIR)
     delete_path(META_DIR)
+    delete_path(CACHE_DIR)
     delete_file("appetite_lock")
 
 
@@ -158,6 +170,36 @@ def get_entry(*args):
         raise
 
 
+def get_manifest_commit(manifest, app):
+    """Commit id of an app in a manifest of the apps repo"""
+
+    with open(os.path.join(APPS_REPO_DIR, "configs", manifest), 'rb') as f:
+        return next(row['CommitID'] for row in csv.DictReader(f) if row['Application'] == app)
+
+
+def get_app_changes(app, from_manifest, to_manifest):
+    """Files of an app changed in the apps repo between two manifests
+
+    :return: (changed files, deleted files) relative to the app
+    """
+
+    app_folder = "base_apps/%s/" % app
+    output = subprocess.check_output(["git", "diff", "--no-renames", "--name-status",
+                                      get_manifest_commit(from_manifest, app),
+                                      get_manifest_commit(to_manifest, app),
+                                      "--", app_folder],
+                                     cwd=APPS_REPO_DIR, shell=False) # nosec
+
+    changed_files = []
+    deleted_files = []
+    for line in output.splitlines():
+        status, file_path = line.split("\t", 1)
+        file_path = file_path[len(app_folder):]
+        (deleted_files if status == "D" else changed_files).append(file_path)
+
+    return changed_files, deleted_files
+
+
 def find_entry(filepath, *args):
     """Find strings in files"""
 
@@ -267,13 +309,16 @@ class Test02AppetiteStateChecks(unittest.TestCase):
     def test_02_find_dups(self):
         """Check for dups"""
 
+        # Dups for all hosts are in a single entry
+        dups = get_entry("Dup app found")['log']['dups']
+
         # Should find 2 occurances of shm
-        shm = get_entry("Dup app found", "splunk-shm")['log']
+        shm = next(dup for dup in dups if dup['hostname'].startswith("splunk-shm"))
         self.assertEquals(shm['app_info']['app'], "App01")
         self.assertEquals(shm['occurences'], 2)
 
         # Should find 3 occurances of sha
-        sha = get_entry("Dup app found", "splunk-sha")['log']
+        sha = next(dup for dup in dups if dup['hostname'].startswith("splunk-sha"))
         self.assertEquals(sha['app_info']['app'], "App01")
         self.assertEquals(sha['occurences'], 3)
 
@@ -295,5 +340,199 @@ class Test02AppetiteStateChecks(unittest.TestCase):
         self.assertTrue(changes_found)
         self.assertTrue(os.path.isfile(file_location))
 
+    def test_05_app_delta(self):
+        """Changed apps only send the files that changed"""
+
+        changed_files, deleted_files = get_app_changes("App06", "manifest_00_fullinstall.csv", "manifest_01.csv")
+        delta_stat = get_entry('"msg": "App delta"', '"app": "App06"')['log']
+
+        # Templated files can change with the commit, files changed in the repo always do
+        self.assertGreaterEqual(delta_stat['changed'], len(changed_files))
+        self.assertLess(delta_stat['changed'], delta_stat['files'])
+        self.assertEquals(delta_stat['deleted'], len(deleted_files))
+
+        files_meta_location = os.path.join(TMP_DIR, "hosts/splunk-ds001-0c/appetite/meta_repo_files.json")
+        with open(files_meta_location) as f:
+            files_meta = json.load(f)
+
+        app_files = files_meta["App06:DeploymentServer"]["files"]
+        for changed_file in changed_files:
+            self.assertIn(changed_file, app_files)
+        for deleted_file in deleted_files:
+            self.assertNotIn(deleted_file, app_files)
+
+    def test_06_find_app(self):
+        """Find hosts running an app from the local state store"""
+
+        app_version = "App06:%s" % get_manifest_commit("manifest_01.csv", "App06")
+        output = subprocess.check_output(list(COMMON_CMD) + ["--silent", "--find-app", app_version],
+                                         cwd=SCRIPT_PATH, shell=False) # nosec
+        found = json.loads(output)
+
+        self.assertEquals([host['hostname'] for host in found['hosts']], ["splunk-ds001-0c"])
+        self.assertEquals([change['status'] for change in found['history']
+                           if change['hostname'] == "splunk-ds001-0c"], ["added", "changed"])
+
+class Test03MultipleProfiles(unittest.TestCase):
+    """ Tests deploying multiple manifests within a single run
+    """
+
+    def test_00_multiple_profiles_run(self):
+        """Run two manifests as profiles in a single appetite run"""
+
+        clean_tmp_folders()
+
+        cmd_appetite("manifest_00_fullinstall.csv",
+                     " --firstrun --templating --profiles "
+                     "repo:manifest_00_fullinstall.csv:base_apps "
+                     "repo_01:manifest_01.csv:base_apps", MAX_THREADS, True)
+
+    def test_01_single_payload(self):
+        """Each host gets a single payload with the meta of each profile"""
+
+        host_meta = os.path.join(TMP_DIR, "hosts/splunk-cm001-0c/appetite")
+
+        self.assertTrue(os.path.isfile(os.path.join(host_meta, "meta_repo.json")))
+        self.assertTrue(os.path.isfile(os.path.join(host_meta, "meta_repo_01.json")))
+
+        tars = os.listdir(os.path.join(TMP_DIR, "tars"))
+        self.assertEquals(len(tars), len(set(tars)))
+        self.assertIn("splunk-cm001-0c.tar.gz", tars)
+
+    def test_02_single_restart(self):
+        """Hosts are restarted once even if both profiles need a restart"""
+
+        with open(LOG_FILE, 'r') as f:
+            restarts = [line for line in f if '"command": "restart"' in line and
+                        '"SSH Finished"' in line and "splunk-cm001-0c" in line]
+
+        self.assertEquals(len(restarts), 1)
+
+class Test04IncrementalRuns(unittest.TestCase):
+    """ Tests limiting runs to hosts affected by changes
+    """
+
+    def test_00_full_run(self):
+        """Clean appetite run storing the run state"""
+
+        clean_tmp_folders()
+
+        cmd_appetite("manifest_00_fullinstall.csv",
+                     " --firstrun --templating", MAX_THREADS, True)
+
+        self.assertTrue(os.path.isfile(os.path.join(CACHE_DIR, "incremental.json")))
+
+    def test_01_no_hosts_affected(self):
+        """Nothing changed since the last run, no hosts are checked"""
+
+        cmd_appetite("manifest_00_fullinstall.csv",
+                     " --firstrun --templating --incremental", MAX_THREADS, True)
+
+        self.assertIsNotNone(get_entry("No hosts affected by changes"))
+        self.assertFalse(get_entry("Appetite complete")['log']['changes'])
+
+    def test_02_host_without_meta(self):
+        """Hosts without a local meta are always checked"""
+
+        delete_path(os.path.join(META_DIR, "splunk-ds001-0c"))
+
+        cmd_appetite("manifest_00_fullinstall.csv",
+                     " --firstrun --templating --incremental", MAX_THREADS, True)
+
+        self.assertEquals(get_entry('"msg": "Incremental run"')['log']['hosts'], 1)
+        self.assertIsNotNone(get_entry('"msg": "Changes found"', "splunk-ds001-0c"))
+        self.assertIsNone(get_entry('"msg": "Changes found"', "splunk-cm001-0c"))
+
+    def test_03_settings_changed(self):
+        """Changing the manifest used falls back to a full run"""
+
+        cmd_appetite("manifest_01.csv", " --incremental", MAX_THREADS, True)
+
+        self.assertIsNotNone(get_entry("Incremental run not possible, settings changed"))
+        self.assertIsNotNone(get_entry('"msg": "Changes found"', "splunk-ds001-0c", '"app": "App06"'))
+
+class Test05HostMatching(unittest.TestCase):
+    """ Tests the precompiled host matcher against check_host
+    """
+
+    HOSTNAMES = ["splunk-cm001-0c", "SPLUNK-CM001-0c", "splunk-idx001-1c", "SPLUNK-IDX002-1c",
+                 "splunk-DS001-0c", "splunk-ds001-0c", "splunk-scm001-0c", "splunk-ss001-0c"]
+
+    def assert_same_hosts(self, white_list, black_list):
+        """HostMatcher selects the same hosts as check_host"""
+
+        host_matcher = Helpers.HostMatcher(white_list, black_list)
+
+        for hostname in self.HOSTNAMES:
+            self.assertEquals(host_matcher.check(hostname),
+                              Helpers.check_host(hostname, black_list, white_list),
+                              "hostname: %s white list: %s black list: %s" % (hostname, white_list, black_list))
+
+    def test_00_plain_patterns(self):
+        """Patterns combined into a single regex"""
+
+        self.assert_same_hosts(["splunk-cm", "idx.*1c$"], ["-ds"])
+
+    def test_01_inline_flags(self):
+        """Inline flags only apply to their own pattern"""
+
+        self.assert_same_hosts(["(?i)SPLUNK-IDX", "splunk-cm"], [""])
+        self.assert_same_hosts([".*"], ["(?i)IDX", "ds"])
+        self.assert_same_hosts(["splunk-(?i)cm"], ["(?x) d s"])
+
+    def test_02_backreferences(self):
+        """Backreferences keep their group numbers"""
+
+        self.assert_same_hosts([r"(s)\1", "splunk-cm"], [r"(?P<c>c)(?P=c)"])
+        self.assert_same_hosts([".*"], [r"(\d)\1\1", "ds"])
+
+    def test_03_named_groups(self):
+        """Group names repeated between patterns"""
+
+        self.assert_same_hosts(["(?P<app_class>cm)", "(?P<app_class>idx)"], [""])
+        self.assert_same_hosts([".*"], ["(?P<site>0c)", "(?P<site>-ds)"])
+
+    def test_04_short_black_list(self):
+        """Black list entries of one character are ignored"""
+
+        self.assert_same_hosts([".*"], ["s", ""])
+        self.assert_same_hosts(["splunk"], ["i", "ds"])
+
+class Test06SharedMethodInfo(unittest.TestCase):
+    """ Tests apps sharing the values of their deployment method
+    """
+
+    class RepoManager(object):
+        """Minimal repo manager needed to create apps"""
+        track = {"version": "1.0"}
+
+    class Profile(object):
+        """Minimal profile needed to build apps"""
+        apps_folder = "base_apps"
+
+    def test_00_shared_after_packaging(self):
+        """Reading values on the packaging path does not copy them"""
+
+        deployment_manager = DeploymentMethodsManager("appetite", "", os.path.join(TEST_PATH, REPO_BASE_FOLDER),
+                                                      Consts.DEPLOYMENT_METHODS_FILENAME)
+        apps = [AppetiteApp(self.RepoManager(), deployment_manager, app_name, app_name,
+                            "StandAlone", "12968e1", "splunk-sha001-0c", False)
+                for app_name in ["App01", "App02"]]
+
+        for app in apps:
+            app.status = Consts.META_APP_CHANGED
+            app.updated = True
+            PayloadGroups.get_build_key(self.Profile(), app)
+        Helpers.content_process(apps, None, "splunk-sha001-0c", self.RepoManager.track, True)
+
+        method_infos = [app.method_info for app in apps]
+
+        self.assertIs(method_infos[0]._shared, method_infos[1]._shared)  # pylint: disable=protected-access
+        for key in ["install_ignore"] + Consts.DM_COMMANDS_SEQUENCE:
+            self.assertIs(method_infos[0][key], method_infos[1][key])
+            self.assertNotIn(key, method_infos[0]._overlay or {})  # pylint: disable=protected-access
+
+        self.assertEquals(method_infos[0].to_dict['install_ignore'], ["lookups/", "local/"])
+
 if __name__ == '__main__':
     unittest.main()